@@ -1,8 +1,8 @@
 # encoding: utf-8
 
 import os
-import io
 import csv
+import json
 import logging
 from flask import Flask
 from flask import jsonify, request, redirect, send_from_directory, Response
@@ -25,6 +25,7 @@ except Exception:
     import sys
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
     from db import conn
+from fetchers.SourceCache import cache_file_path as source_cache_path, load_entries as load_source_cache, source_key
 
 STATIC_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'frontend', 'deployment')
 DEFAULT_RAW_SOURCES_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'sources', 'raw_sources.txt')
@@ -108,6 +109,8 @@ def _runtime_config_snapshot():
         validate_keyword=config_module.VALIDATE_KEYWORD,
         validate_timeout=config_module.VALIDATE_TIMEOUT,
         validate_max_fails=config_module.VALIDATE_MAX_FAILS,
+        validate_result_batch_size=config_module.VALIDATE_RESULT_BATCH_SIZE,
+        validate_result_flush_ms=config_module.VALIDATE_RESULT_FLUSH_MS,
         raw_sources_file=_sources_file_path(),
         raw_sources_timeout=_safe_int(os.getenv('RAW_SOURCES_TIMEOUT', '8'), 8, 1, 120)
     )
@@ -115,6 +118,38 @@ def _runtime_config_snapshot():
 
 ############# 以下API可用于获取代理 ################
 
+class FetchOptionError(ValueError):
+    pass
+
+
+@app.errorhandler(FetchOptionError)
+def fetch_option_error(e):
+    return _err(str(e))
+
+
+def _fetch_options():
+    """
+    解析获取代理的接口共用的参数：
+    max_latency : 只返回p95延迟不超过该值(毫秒)的代理
+    prefer=fast : 从延迟最低的一批代理中选择
+    返回 : 传给conn.getValidatedRandom、conn.get_by_protocol的关键字参数
+    """
+    options = dict(max_latency=None, prefer_fast=False)
+    max_latency = request.args.get('max_latency', '').strip()
+    if max_latency != '':
+        try:
+            options['max_latency'] = int(max_latency)
+        except ValueError:
+            raise FetchOptionError('max_latency必须是整数(毫秒)')
+        if options['max_latency'] <= 0:
+            raise FetchOptionError('max_latency必须大于0')
+    prefer = request.args.get('prefer', '').strip().lower()
+    if prefer not in ('', 'random', 'fast'):
+        raise FetchOptionError('prefer必须是fast或random')
+    options['prefer_fast'] = prefer == 'fast'
+    return options
+
+
 # 可用于测试API状态
 @app.route('/ping', methods=['GET'])
 def ping():
@@ -124,7 +159,7 @@ def ping():
 # 随机获取一个可用代理，如果没有可用代理则返回空白
 @app.route('/fetch_random', methods=['GET'])
 def fetch_random():
-    proxies = conn.getValidatedRandom(1)
+    proxies = conn.getValidatedRandom(1, **_fetch_options())
     if len(proxies) > 0:
         p = proxies[0]
         return f'{p.protocol}://{p.ip}:{p.port}'
@@ -134,7 +169,7 @@ def fetch_random():
 # api 获取协议为http的一条结果
 @app.route('/fetch_http', methods=['GET'])
 def fetch_http():
-    proxies = conn.get_by_protocol('http', 1)
+    proxies = conn.get_by_protocol('http', 1, **_fetch_options())
     if len(proxies) > 0:
         p = proxies[0]
         return f'{p.protocol}://{p.ip}:{p.port}'
@@ -144,7 +179,7 @@ def fetch_http():
 # api 获取协议为http的全部结果
 @app.route('/fetch_http_all', methods=['GET'])
 def fetch_http_all():
-    proxies = conn.get_by_protocol('http', -1)
+    proxies = conn.get_by_protocol('http', -1, **_fetch_options())
     if len(proxies) == 1:
         p = proxies[0]
         return f'{p.protocol}://{p.ip}:{p.port}'
@@ -159,7 +194,7 @@ def fetch_http_all():
 # api 获取协议为https的一条结果
 @app.route('/fetch_https', methods=['GET'])
 def fetch_https():
-    proxies = conn.get_by_protocol('https', 1)
+    proxies = conn.get_by_protocol('https', 1, **_fetch_options())
     if len(proxies) > 0:
         p = proxies[0]
         return f'{p.protocol}://{p.ip}:{p.port}'
@@ -169,7 +204,7 @@ def fetch_https():
 # api 获取协议为https的全部结果
 @app.route('/fetch_https_all', methods=['GET'])
 def fetch_https_all():
-    proxies = conn.get_by_protocol('https', -1)
+    proxies = conn.get_by_protocol('https', -1, **_fetch_options())
     if len(proxies) == 1:
         p = proxies[0]
         return f'{p.protocol}://{p.ip}:{p.port}'
@@ -184,7 +219,7 @@ def fetch_https_all():
 # api 获取协议为socks4的一条结果
 @app.route('/fetch_socks4', methods=['GET'])
 def fetch_socks4():
-    proxies = conn.get_by_protocol('socks4', 1)
+    proxies = conn.get_by_protocol('socks4', 1, **_fetch_options())
     if len(proxies) > 0:
         p = proxies[0]
         return f'{p.protocol}://{p.ip}:{p.port}'
@@ -194,7 +229,7 @@ def fetch_socks4():
 # api 获取协议为socks4的全部结果
 @app.route('/fetch_socks4_all', methods=['GET'])
 def fetch_socks4_all():
-    proxies = conn.get_by_protocol('socks4', -1)
+    proxies = conn.get_by_protocol('socks4', -1, **_fetch_options())
     if len(proxies) == 1:
         p = proxies[0]
         return f'{p.protocol}://{p.ip}:{p.port}'
@@ -209,7 +244,7 @@ def fetch_socks4_all():
 # api 获取协议为socks5的一条结果
 @app.route('/fetch_socks5', methods=['GET'])
 def fetch_socks5():
-    proxies = conn.get_by_protocol('socks5', 1)
+    proxies = conn.get_by_protocol('socks5', 1, **_fetch_options())
     if len(proxies) > 0:
         p = proxies[0]
         return f'{p.protocol}://{p.ip}:{p.port}'
@@ -219,7 +254,7 @@ def fetch_socks5():
 # api 获取协议为socks5的全部结果
 @app.route('/fetch_socks5_all', methods=['GET'])
 def fetch_socks5_all():
-    proxies = conn.get_by_protocol('socks5', -1)
+    proxies = conn.get_by_protocol('socks5', -1, **_fetch_options())
     if len(proxies) == 1:
         p = proxies[0]
         return f'{p.protocol}://{p.ip}:{p.port}'
@@ -234,7 +269,7 @@ def fetch_socks5_all():
 # 获取所有可用代理，如果没有可用代理则返回空白
 @app.route('/fetch_all', methods=['GET'])
 def fetch_all():
-    proxies = conn.getValidatedRandom(-1)
+    proxies = conn.getValidatedRandom(-1, **_fetch_options())
     proxies = [f'{p.protocol}://{p.ip}:{p.port}' for p in proxies]
     return ','.join(proxies)
 
@@ -338,19 +373,53 @@ def fetcher_enable():
 
 @app.route('/admin/proxies', methods=['GET'])
 def admin_proxies():
+    """
+    两种分页方式：
+    1. page=页码，按页码跳过前面的记录，翻到很深的页时会比较慢
+    2. after=游标，第一页传空字符串，之后传上一页返回的next_after，耗时与翻到第几页无关
+    total_mode : exact(默认，准确总数)，approx(带关键字时使用缓存的总数)，none(不返回总数)
+    """
     protocol = request.args.get('protocol')
     fetcher_name = request.args.get('fetcher_name')
     validated = _normalize_validated(request.args.get('validated'))
     keyword = request.args.get('keyword', '')
     page = _safe_int(request.args.get('page', 1), 1, 1)
     page_size = _safe_int(request.args.get('page_size', 50), 50, 1, 500)
+    after = request.args.get('after')
+    total_mode = request.args.get('total_mode', 'exact')
+    if total_mode not in ('exact', 'approx', 'none'):
+        return _err('total_mode必须是exact、approx或none')
+
+    total = None
+    if total_mode != 'none':
+        total = conn.countProxies(
+            protocol=protocol,
+            fetcher_name=fetcher_name,
+            validated=validated,
+            keyword=keyword,
+            approximate=(total_mode == 'approx')
+        )
+
+    if after is not None:
+        try:
+            proxies, next_after = conn.queryProxiesAfter(
+                protocol=protocol,
+                fetcher_name=fetcher_name,
+                validated=validated,
+                keyword=keyword,
+                after=after,
+                page_size=page_size
+            )
+        except ValueError as e:
+            return _err(str(e))
+        return _ok(
+            items=[p.to_dict() for p in proxies],
+            total=total,
+            total_mode=total_mode,
+            next_after=next_after,
+            page_size=page_size
+        )
 
-    total = conn.countProxies(
-        protocol=protocol,
-        fetcher_name=fetcher_name,
-        validated=validated,
-        keyword=keyword
-    )
     proxies = conn.queryProxies(
         protocol=protocol,
         fetcher_name=fetcher_name,
@@ -363,68 +432,133 @@ def admin_proxies():
     return _ok(
         items=[p.to_dict() for p in proxies],
         total=total,
+        total_mode=total_mode,
         page=page,
         page_size=page_size
     )
 
 
-@app.route('/admin/proxies/export.csv', methods=['GET'])
-def admin_proxies_export_csv():
-    protocol = request.args.get('protocol')
-    fetcher_name = request.args.get('fetcher_name')
-    validated = _normalize_validated(request.args.get('validated'))
-    keyword = request.args.get('keyword', '')
+EXPORT_COLUMNS = [
+    'protocol', 'ip', 'port', 'fetcher_name',
+    'validated', 'latency', 'validate_date',
+    'to_validate_date', 'validate_failed_cnt'
+]
+# 导出时每次从数据库取出的代理数量，也是每次发送给客户端的行数
+EXPORT_BATCH_SIZE = 1000
 
-    total = conn.countProxies(
-        protocol=protocol,
-        fetcher_name=fetcher_name,
-        validated=validated,
-        keyword=keyword
-    )
-    page_size = max(1, min(total if total > 0 else 1, 50000))
-    proxies = conn.queryProxies(
-        protocol=protocol,
-        fetcher_name=fetcher_name,
-        validated=validated,
-        keyword=keyword,
-        page=1,
-        page_size=page_size
+
+def _export_filters():
+    return dict(
+        protocol=request.args.get('protocol'),
+        fetcher_name=request.args.get('fetcher_name'),
+        validated=_normalize_validated(request.args.get('validated')),
+        keyword=request.args.get('keyword', '')
     )
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        'protocol', 'ip', 'port', 'fetcher_name',
-        'validated', 'latency', 'validate_date',
-        'to_validate_date', 'validate_failed_cnt'
-    ])
-    for p in proxies:
-        item = p.to_dict()
-        writer.writerow([
-            item['protocol'], item['ip'], item['port'], item['fetcher_name'],
-            item['validated'], item['latency'], item['validate_date'],
-            item['to_validate_date'], item['validate_failed_cnt']
-        ])
 
-    csv_text = output.getvalue()
-    output.close()
+def _export_chunks(format_line, header=None):
+    """
+    按游标分批读取符合筛选条件的代理，每一批拼接为一个字符串产生，内存占用与代理数量无关
+    format_line : 将一个代理转换为一行文本的函数
+    """
+    filters = _export_filters()
 
+    def generate():
+        lines = [] if header is None else [header]
+        for p in conn.iterProxies(batch_size=EXPORT_BATCH_SIZE, **filters):
+            lines.append(format_line(p))
+            if len(lines) >= EXPORT_BATCH_SIZE:
+                yield ''.join(lines)
+                lines = []
+        if len(lines) > 0:
+            yield ''.join(lines)
+    return generate()
+
+
+class _CsvLine(object):
+    """
+    csv.writer的输出对象，writerow直接返回格式化之后的一行，而不是写入缓冲区
+    """
+    def write(self, line):
+        return line
+
+
+def _export_response(chunks, mimetype, filename):
     return Response(
-        csv_text,
-        mimetype='text/csv',
-        headers={'Content-Disposition': 'attachment; filename=proxies.csv'}
+        chunks,
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
     )
 
 
+@app.route('/admin/proxies/export.csv', methods=['GET'])
+def admin_proxies_export_csv():
+    writer = csv.writer(_CsvLine())
+
+    def format_line(p):
+        item = p.to_dict()
+        return writer.writerow([item[k] for k in EXPORT_COLUMNS])
+    return _export_response(_export_chunks(format_line, writer.writerow(EXPORT_COLUMNS)), 'text/csv', 'proxies.csv')
+
+
+@app.route('/admin/proxies/export.ndjson', methods=['GET'])
+def admin_proxies_export_ndjson():
+    def format_line(p):
+        item = p.to_dict()
+        return json.dumps({k: item[k] for k in EXPORT_COLUMNS}, ensure_ascii=False) + '\n'
+    return _export_response(_export_chunks(format_line), 'application/x-ndjson', 'proxies.ndjson')
+
+
+# 每行一个代理，格式为protocol://ip:port
+@app.route('/admin/proxies/export.txt', methods=['GET'])
+def admin_proxies_export_txt():
+    def format_line(p):
+        return f'{p.protocol}://{p.ip}:{p.port}\n'
+    return _export_response(_export_chunks(format_line), 'text/plain', 'proxies.txt')
+
+
+def _source_cache_stats(lines):
+    """
+    每个代理源的缓存命中统计(见fetchers/SourceCache.py)，按配置文件中的顺序返回
+    """
+    entries = load_source_cache(source_cache_path())
+    stats = []
+    for line in lines:
+        text = line.strip()
+        if text == '' or text.startswith('#'):
+            continue
+        if ',' in text:
+            protocol, url = text.split(',', 1)
+            protocol, url = protocol.strip().lower(), url.strip()
+        else:
+            protocol, url = 'http', text
+        entry = entries.get(source_key(protocol, url), {})
+        hits = entry.get('hits', 0)
+        misses = entry.get('misses', 0)
+        stats.append(dict(
+            protocol=protocol,
+            url=url,
+            hits=hits,
+            misses=misses,
+            hit_ratio=round(hits / (hits + misses), 4) if hits + misses > 0 else None,
+            last_result=entry.get('last_result'),
+            last_proxies_cnt=entry.get('last_proxies_cnt', 0),
+            last_fetch_date=entry.get('last_fetch_date'),
+            last_error=entry.get('last_error'),
+            last_ms=entry.get('last_ms')
+        ))
+    return stats
+
+
 @app.route('/admin/sources', methods=['GET'])
 def admin_sources_get():
     path = _sources_file_path()
     if not os.path.exists(path):
-        return _ok(file_path=path, lines=[])
+        return _ok(file_path=path, lines=[], source_stats=[])
 
     with open(path, 'r', encoding='utf-8') as f:
         lines = [line.rstrip('\n') for line in f]
-    return _ok(file_path=path, lines=lines)
+    return _ok(file_path=path, lines=lines, source_stats=_source_cache_stats(lines))
 
 
 @app.route('/admin/sources', methods=['PUT'])
@@ -488,6 +622,26 @@ def admin_health():
     )
 
 
+def _validator_concurrency(runtime_stats):
+    """
+    验证器当前同时验证的代理数量以及最近的调整，见proc/concurrency.py
+    有多个验证进程(validator-0、validator-1...)时，limit为各进程之和，processes为各进程的统计
+    """
+    processes = {
+        name: stats['concurrency'] for name, stats in runtime_stats.items()
+        if (name == 'validator' or name.startswith('validator-')) and stats.get('concurrency') is not None
+    }
+    if len(processes) == 0:
+        return None
+    if len(processes) == 1:
+        return list(processes.values())[0]
+    return dict(
+        limit=sum(item['limit'] for item in processes.values()),
+        last_decision=processes[sorted(processes)[0]].get('last_decision'),
+        processes=processes
+    )
+
+
 @app.route('/admin/summary', methods=['GET'])
 def admin_summary():
     status = conn.getProxiesStatus()
@@ -501,12 +655,15 @@ def admin_summary():
         fetcher['in_db_cnt'] = stats['in_db_cnt']
         fetcher['validated_cnt'] = stats['validated_cnt']
 
+    runtime_stats = conn.getRuntimeStats()
     return _ok(
         status=status,
         protocol_stats=protocol_stats,
         fetchers=fetchers,
         recent_errors=recent_errors,
-        runtime_config=_runtime_config_snapshot()
+        runtime_config=_runtime_config_snapshot(),
+        runtime_stats=runtime_stats,
+        validator_concurrency=_validator_concurrency(runtime_stats)
     )
 
 
@@ -550,8 +707,8 @@ app.after_request(after_request)
 def main(proc_lock):
     if proc_lock is not None:
         conn.set_proc_lock(proc_lock)
-    # 因为默认sqlite3中，同一个数据库连接不能在多线程环境下使用，所以这里需要禁用flask的多线程
-    app.run(host=API_HOST, port=API_PORT, threaded=False)
+    # db.conn使用连接池，每个请求线程都会使用独立的数据库连接，因此可以开启flask的多线程
+    app.run(host=API_HOST, port=API_PORT, threaded=True)
 
 
 if __name__ == '__main__':
@@ -22,25 +22,59 @@ def _get_str_env(name, default):
         return default
     return value
 
+def _get_bool_env(name, default):
+    value = os.getenv(name)
+    if value is None or value.strip() == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
 # 数据库文件路径
 DATABASE_PATH = _get_str_env(
     'DATABASE_PATH',
     os.path.join(os.path.dirname(__file__), 'data.db')
 )
 
+# 数据库参数
+# 默认使用WAL模式，读操作不会被写事务阻塞
+DATABASE_JOURNAL_MODE = _get_str_env('DATABASE_JOURNAL_MODE', 'WAL').upper()
+# WAL模式下NORMAL已经可以保证数据库不会损坏，只是断电时可能丢失最近的少量提交
+DATABASE_SYNCHRONOUS = _get_str_env('DATABASE_SYNCHRONOUS', 'NORMAL').upper()
+DATABASE_CACHE_SIZE = _get_int_env('DATABASE_CACHE_SIZE', 32 * 1024) # 页缓存大小，单位KB
+DATABASE_MMAP_SIZE = _get_int_env('DATABASE_MMAP_SIZE', 256 * 1024 * 1024) # 内存映射大小，单位字节
+DATABASE_BUSY_TIMEOUT = _get_int_env('DATABASE_BUSY_TIMEOUT', 10 * 1000) # 数据库被锁定时的最长等待时间，单位毫秒
+DATABASE_POOL_SIZE = _get_int_env('DATABASE_POOL_SIZE', 16) # 每个进程最多保留多少个空闲的数据库连接
+# 管理后台代理列表使用近似总数时，带关键字的计数结果的缓存时间，单位秒
+PROXY_COUNT_CACHE_SECONDS = _get_int_env('PROXY_COUNT_CACHE_SECONDS', 30)
+
 # API监听配置
 # 出于安全考虑，默认仅监听本地回环地址，避免误暴露到局域网/公网
 API_HOST = _get_str_env('API_HOST', '127.0.0.1')
 API_PORT = _get_int_env('API_PORT', 5000)
+# 获取代理的接口指定prefer=fast时，从p95延迟最低的多少个代理中随机选择(要求返回的数量更多时为该数量)
+FETCH_FAST_TIER_SIZE = _get_int_env('FETCH_FAST_TIER_SIZE', 20)
 
 # 每次运行所有爬取器之后，睡眠多少时间，单位秒
 PROC_FETCHER_SLEEP = _get_int_env('PROC_FETCHER_SLEEP', 5 * 60)
+# 所有爬取器共用的HTTP会话中，同一个主机最多同时使用多少个连接(超过时等待空闲的连接)，见fetchers/FetcherSession.py
+FETCHER_POOL_PER_HOST = _get_int_env('FETCHER_POOL_PER_HOST', 4)
 
-# 验证器每次睡眠的时间，单位秒
+# 验证器在没有任何事件(验证结果写入数据库、爬取器写入新的代理、下一个代理到期等)时最长等待的时间，单位秒
+# 用于及时发现其他验证进程租约过期的代理，以及不是由爬取器写入的代理
 PROC_VALIDATOR_SLEEP = _get_int_env('PROC_VALIDATOR_SLEEP', 5)
 
 # 验证器的配置参数
 VALIDATE_THREAD_NUM = _get_int_env('VALIDATE_THREAD_NUM', 200) # 验证线程数量
+# 验证进程的数量，多于1个时每个进程只验证一部分代理(按protocol、ip、port的哈希值划分)，
+# 每个进程都有自己的验证线程(或事件循环)，因此总的并发数量也会乘以进程数量
+VALIDATE_PROCESS_NUM = _get_int_env('VALIDATE_PROCESS_NUM', 1)
+# 验证方式，可选：thread(每个代理占用一个线程，使用requests)、asyncio(在一个事件循环中同时验证大量代理)
+VALIDATE_MODE = _get_str_env('VALIDATE_MODE', 'thread').lower()
+VALIDATE_ASYNC_CONCURRENCY = _get_int_env('VALIDATE_ASYNC_CONCURRENCY', 2000) # asyncio方式下同时验证的代理数量
+# 两阶段验证：先用很短的超时时间与代理建立TCP连接(SOCKS代理还会进行握手)，无法连接的代理直接记为验证失败，
+# 只有能连接的代理才会进行完整的验证(访问VALIDATE_URL)
+VALIDATE_PREFILTER = _get_bool_env('VALIDATE_PREFILTER', True)
+VALIDATE_CONNECT_TIMEOUT = _get_int_env('VALIDATE_CONNECT_TIMEOUT', 3) # 第一阶段的超时时间，单位s
+VALIDATE_PREFILTER_CONCURRENCY = _get_int_env('VALIDATE_PREFILTER_CONCURRENCY', 1000) # 第一阶段同时检查的代理数量
 # 验证器的逻辑是：
 # 使用代理访问 VALIDATE_URL 网站，超时时间设置为 VALIDATE_TIMEOUT
 # 如果没有超时：
@@ -53,3 +87,42 @@ VALIDATE_HEADER = _get_str_env('VALIDATE_HEADER', 'location') # 仅用于HEAD验
 VALIDATE_KEYWORD = _get_str_env('VALIDATE_KEYWORD', 'Example Domain')
 VALIDATE_TIMEOUT = _get_int_env('VALIDATE_TIMEOUT', 5) # 超时时间，单位s
 VALIDATE_MAX_FAILS = _get_int_env('VALIDATE_MAX_FAILS', 3)
+# GET验证方式逐段读取响应体，找到 VALIDATE_KEYWORD 之后立即停止读取；
+# 读取了 VALIDATE_MAX_BODY_BYTES 字节仍然没有找到关键字时也停止读取，认为本次验证失败
+VALIDATE_MAX_BODY_BYTES = _get_int_env('VALIDATE_MAX_BODY_BYTES', 256 * 1024)
+# 验证一个代理最多花费的时间(包括所有尝试)，单位s，默认为 VALIDATE_TIMEOUT * VALIDATE_MAX_FAILS
+VALIDATE_PROXY_BUDGET = _get_int_env('VALIDATE_PROXY_BUDGET', VALIDATE_TIMEOUT * VALIDATE_MAX_FAILS)
+# 自动调整同时验证的代理数量(AIMD)：验证正常并且并发已经用满时每 VALIDATE_AIMD_INTERVAL 秒增加 VALIDATE_AIMD_STEP，
+# 超时比例或者延迟明显升高、出现本地socket错误时乘以0.7，始终在 [VALIDATE_CONCURRENCY_MIN, VALIDATE_CONCURRENCY_MAX] 之间
+# 实际的并发由验证流水线的容量(线程数量或者VALIDATE_ASYNC_CONCURRENCY，加上第一阶段的并发数量)决定，
+# 因此 VALIDATE_CONCURRENCY_MAX 不会超过这个容量，为0时就等于这个容量，AIMD只能在负载过高时减少并发；
+# 关闭时同时领取的代理数量固定为容量的2倍，多出来的代理在流水线的队列中等待
+VALIDATE_AIMD = _get_bool_env('VALIDATE_AIMD', True)
+VALIDATE_CONCURRENCY_MIN = _get_int_env('VALIDATE_CONCURRENCY_MIN', 10)
+VALIDATE_CONCURRENCY_MAX = _get_int_env('VALIDATE_CONCURRENCY_MAX', 0)
+VALIDATE_AIMD_STEP = _get_int_env('VALIDATE_AIMD_STEP', 20)
+VALIDATE_AIMD_INTERVAL = _get_int_env('VALIDATE_AIMD_INTERVAL', 5) # 单位s
+# 是否同时进行一个代理的多次尝试：每隔 VALIDATE_RACE_STAGGER_MS 毫秒(或者上一次尝试失败之后立即)开始下一次尝试，
+# 最多 VALIDATE_MAX_FAILS 次，任意一次成功之后取消其余的尝试；所有尝试共用同一个截止时间，
+# 即 min(VALIDATE_PROXY_BUDGET, VALIDATE_TIMEOUT * 2) 秒，而不是依次尝试时的 VALIDATE_TIMEOUT * 2 * VALIDATE_MAX_FAILS 秒
+VALIDATE_RACE = _get_bool_env('VALIDATE_RACE', False)
+VALIDATE_RACE_STAGGER_MS = _get_int_env('VALIDATE_RACE_STAGGER_MS', 500)
+# 根据每次验证的结果决定下次验证时间的策略(见db/schedule.py)，可选：
+# adaptive(默认)：根据代理的验证历史(连续成功次数、可用率)调整，稳定的代理验证间隔逐渐变长，直到 VALIDATE_SCHEDULE_MAX_MINUTES 分钟，
+#                 时好时坏的代理间隔较短，不少于 VALIDATE_SCHEDULE_MIN_MINUTES 分钟
+# fixed：原来的策略，验证成功之后10~60分钟再次验证，失败之后 连续失败次数 * 10 分钟再次验证
+VALIDATE_SCHEDULE_POLICY = _get_str_env('VALIDATE_SCHEDULE_POLICY', 'adaptive').lower()
+VALIDATE_SCHEDULE_MIN_MINUTES = _get_int_env('VALIDATE_SCHEDULE_MIN_MINUTES', 10)
+VALIDATE_SCHEDULE_MAX_MINUTES = _get_int_env('VALIDATE_SCHEDULE_MAX_MINUTES', 240)
+# 验证器从数据库中取出待验证的代理时，会为这些代理设置租约，租约过期之前不会被其他验证器取出，单位秒
+# 如果验证器在验证过程中退出，其持有的代理会在租约过期之后重新被验证
+VALIDATE_LEASE_SECONDS = _get_int_env('VALIDATE_LEASE_SECONDS', 10 * 60)
+
+# 验证结果批量写入数据库：攒够 VALIDATE_RESULT_BATCH_SIZE 个结果，或者最早的结果已经等待了 VALIDATE_RESULT_FLUSH_MS 毫秒，
+# 或者 VALIDATE_RESULT_IDLE_MS 毫秒内没有新的结果，就把这些结果放在同一个事务中提交
+VALIDATE_RESULT_BATCH_SIZE = _get_int_env('VALIDATE_RESULT_BATCH_SIZE', 200)
+VALIDATE_RESULT_FLUSH_MS = _get_int_env('VALIDATE_RESULT_FLUSH_MS', 500)
+VALIDATE_RESULT_IDLE_MS = _get_int_env('VALIDATE_RESULT_IDLE_MS', 20)
+
+# 各进程将运行统计写入数据库的间隔，单位秒，可在网页的系统页面中查看
+STATS_REPORT_INTERVAL = _get_int_env('STATS_REPORT_INTERVAL', 30)
@@ -1,7 +1,20 @@
 # encoding: utf-8
 
 import datetime
-import random
+import zlib
+from .schedule import get_policy
+from . import latency as latency_hist
+
+# 更新uptime_ewma和latency_ewma时本次结果所占的权重
+HISTORY_ALPHA = 0.3
+
+def shard_key(protocol, ip, port):
+    """
+    代理所在分片的哈希值，多个验证进程按 shard_key % 进程数量 划分代理，见conn.getToValidate
+    数据库中已经保存了这个值，因此算法不能修改
+    """
+    return zlib.crc32(f'{protocol}://{ip}:{port}'.encode('utf-8'))
+
 class Proxy(object):
     """
     代理，用于表示数据库中的一个记录
@@ -23,13 +36,19 @@ class Proxy(object):
     )
     """,
     """
-    CREATE INDEX IF NOT EXISTS proxies_fetcher_name_index
-    ON proxies(fetcher_name)
-    """,
-    """
     CREATE INDEX IF NOT EXISTS proxies_to_validate_date_index
     ON proxies(to_validate_date ASC)
     """]
+    # 之后新增的字段和索引见migrations.py
+
+    # 与Proxy对象的属性对应的字段，顺序与params()以及decode()一致
+    # lease_owner和lease_expire_date表示哪个验证器正在验证这个代理，以及这个租约的过期时间，不属于Proxy对象
+    columns = (
+        'fetcher_name', 'protocol', 'ip', 'port', 'validated', 'latency',
+        'validate_date', 'to_validate_date', 'validate_failed_cnt',
+        'success_streak', 'uptime_ewma', 'latency_ewma',
+        'latency_hist', 'latency_p50', 'latency_p95'
+    )
 
     def __init__(self):
         self.fetcher_name = None
@@ -41,6 +60,12 @@ class Proxy(object):
         self.validate_date = None
         self.to_validate_date = datetime.datetime.now()
         self.validate_failed_cnt = 0
+        self.success_streak = 0 # 已经连续验证成功了多少次
+        self.uptime_ewma = None # 验证结果(成功为1，失败为0)的指数加权平均，即近期的可用率，None表示还没有验证过
+        self.latency_ewma = None # 验证成功时延迟的指数加权平均，单位毫秒
+        self.latency_hist = None # 近期延迟的直方图，见latency.py
+        self.latency_p50 = None # 由latency_hist估计的延迟中位数，单位毫秒
+        self.latency_p95 = None # 由latency_hist估计的延迟95分位数，单位毫秒，用于按延迟筛选代理
     
     def params(self):
         """
@@ -50,7 +75,9 @@ class Proxy(object):
             self.fetcher_name,
             self.protocol, self.ip, self.port,
             self.validated, self.latency,
-            self.validate_date, self.to_validate_date, self.validate_failed_cnt
+            self.validate_date, self.to_validate_date, self.validate_failed_cnt,
+            self.success_streak, self.uptime_ewma, self.latency_ewma,
+            self.latency_hist, self.latency_p50, self.latency_p95
         )
     
     def to_dict(self):
@@ -66,7 +93,12 @@ class Proxy(object):
             'latency': self.latency,
             'validate_date': str(self.validate_date) if self.validate_date is not None else None,
             'to_validate_date': str(self.to_validate_date) if self.to_validate_date is not None else None,
-            'validate_failed_cnt': self.validate_failed_cnt
+            'validate_failed_cnt': self.validate_failed_cnt,
+            'success_streak': self.success_streak,
+            'uptime_ewma': round(self.uptime_ewma, 4) if self.uptime_ewma is not None else None,
+            'latency_ewma': round(self.latency_ewma, 1) if self.latency_ewma is not None else None,
+            'latency_p50': self.latency_p50,
+            'latency_p95': self.latency_p95
         }
     
     @staticmethod
@@ -75,7 +107,7 @@ class Proxy(object):
         将sqlite返回的一行解析为Proxy
         row : sqlite返回的一行
         """
-        assert len(row) == 9
+        assert len(row) == len(Proxy.columns)
         p = Proxy()
         p.fetcher_name = row[0]
         p.protocol = row[1]
@@ -86,30 +118,51 @@ class Proxy(object):
         p.validate_date = row[6]
         p.to_validate_date = row[7]
         p.validate_failed_cnt = row[8]
+        p.success_streak = row[9]
+        p.uptime_ewma = row[10]
+        p.latency_ewma = row[11]
+        p.latency_hist = row[12]
+        p.latency_p50 = row[13]
+        p.latency_p95 = row[14]
         return p
     
-    def validate(self, success, latency):
+    def validate(self, success, latency, policy=None):
         """
-        传入一次验证结果，根据验证结果调整自身属性，并返回是否删除这个代理
+        传入一次验证结果，根据验证结果调整自身属性(包括验证历史)，并返回是否删除这个代理
         success : True/False，表示本次验证是否成功
+        policy : 决定下次验证时间的策略，见schedule.py，默认为配置中的VALIDATE_SCHEDULE_POLICY
         返回 : True/False，True表示这个代理太差了，应该从数据库中删除
         """
+        if policy is None:
+            policy = get_policy()
         self.latency = latency
+        self.validate_date = datetime.datetime.now()
+        sample = 1 if success else 0
+        if self.uptime_ewma is None:
+            self.uptime_ewma = sample
+        else:
+            self.uptime_ewma = HISTORY_ALPHA * sample + (1 - HISTORY_ALPHA) * self.uptime_ewma
+
         if success: # 验证成功
             self.validated = True
-            self.validate_date = datetime.datetime.now()
             self.validate_failed_cnt = 0
-            #self.to_validate_date = datetime.datetime.now() + datetime.timedelta(minutes=30)  # 30分钟之后继续验证
-            self.to_validate_date = datetime.datetime.now() + datetime.timedelta(minutes=random.randint(10, 60))  # 10·60分钟之后继续验证
+            self.success_streak = self.success_streak + 1
+            if latency is not None:
+                if self.latency_ewma is None:
+                    self.latency_ewma = latency
+                else:
+                    self.latency_ewma = HISTORY_ALPHA * latency + (1 - HISTORY_ALPHA) * self.latency_ewma
+                counts = latency_hist.add_sample(latency_hist.decode_hist(self.latency_hist), latency)
+                self.latency_hist = latency_hist.encode_hist(counts)
+                self.latency_p50 = latency_hist.percentile(counts, 0.5)
+                self.latency_p95 = latency_hist.percentile(counts, 0.95)
+            self.to_validate_date = self.validate_date + policy.next_delay(self, success)
             return False
         else:
             self.validated = False
-            self.validate_date = datetime.datetime.now()
             self.validate_failed_cnt = self.validate_failed_cnt + 1
-
-            # 验证失败的次数越多，距离下次验证的时间越长
-            delay_minutes = self.validate_failed_cnt * 10
-            self.to_validate_date = datetime.datetime.now() + datetime.timedelta(minutes=delay_minutes)
+            self.success_streak = 0
+            self.to_validate_date = self.validate_date + policy.next_delay(self, success)
 
             if self.validate_failed_cnt >= 6:
                 return True
@@ -0,0 +1,16 @@
+# encoding: utf-8
+
+class RuntimeStats(object):
+    """
+    各进程的运行统计，以JSON的形式储存，供网页端查看
+    """
+
+    ddls = ["""
+    CREATE TABLE IF NOT EXISTS runtime_stats
+    (
+        name VARCHAR(255) NOT NULL,
+        stats TEXT NOT NULL,
+        updated_at TIMESTAMP NOT NULL,
+        PRIMARY KEY (name)
+    )
+    """]
@@ -4,22 +4,60 @@
 封装的数据库接口
 """
 
-from config import DATABASE_PATH
-from .Proxy import Proxy
+from config import DATABASE_PATH, DATABASE_JOURNAL_MODE, DATABASE_SYNCHRONOUS
+from config import DATABASE_CACHE_SIZE, DATABASE_MMAP_SIZE, DATABASE_BUSY_TIMEOUT, DATABASE_POOL_SIZE
+from config import VALIDATE_LEASE_SECONDS, PROXY_COUNT_CACHE_SECONDS, FETCH_FAST_TIER_SIZE
+from .Proxy import Proxy, shard_key
 from .Fetcher import Fetcher
 import sqlite3
 import datetime
 import threading
-
-conn = sqlite3.connect(DATABASE_PATH, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-# 线程锁
-conn_lock = threading.Lock()
-# 进程锁
+import queue
+import contextlib
+import json
+import random
+import base64
+import time
+
+# 查询proxies表时使用的字段列表，与Proxy.decode对应
+PROXY_COLUMNS = ','.join(Proxy.columns)
+PROXY_PLACEHOLDERS = ','.join(['?'] * len(Proxy.columns))
+
+def _connect():
+    """
+    打开一个新的数据库连接，并设置WAL模式以及相关参数
+    WAL模式下读操作不会被写事务阻塞，因此进程锁只需要在写数据库时使用
+    连接可能会在不同的线程中使用(但同一时间只会被一个线程使用)，因此关闭check_same_thread
+    """
+    c = sqlite3.connect(
+        DATABASE_PATH,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+        timeout=DATABASE_BUSY_TIMEOUT / 1000.0,
+        check_same_thread=False
+    )
+    c.execute(f'PRAGMA journal_mode={DATABASE_JOURNAL_MODE}')
+    c.execute(f'PRAGMA synchronous={DATABASE_SYNCHRONOUS}')
+    c.execute(f'PRAGMA cache_size={-DATABASE_CACHE_SIZE}')
+    c.execute(f'PRAGMA mmap_size={DATABASE_MMAP_SIZE}')
+    c.execute(f'PRAGMA busy_timeout={DATABASE_BUSY_TIMEOUT}')
+    return c
+
+
+# 空闲连接池，每个连接同一时间只会被一个线程使用，用完之后放回连接池
+_idle_conns = queue.LifoQueue(maxsize=max(DATABASE_POOL_SIZE, 1))
+# 线程锁，只有写数据库时才需要获取，保证同一进程内的写事务依次进行
+write_lock = threading.Lock()
+# 进程锁，只有写数据库时才需要获取
 proc_lock = None
+# 写入新的代理之后通知验证进程，见proc/wakeup.py中的IngestSignal
+ingest_signal = None
 
 
 def _acquire_locks():
-    conn_lock.acquire()
+    """
+    写数据库之前调用，同时获取线程锁和进程锁
+    """
+    write_lock.acquire()
     if proc_lock is not None:
         proc_lock.acquire()
 
@@ -30,7 +68,42 @@ def _release_locks():
             proc_lock.release()
         except ValueError:
             pass
-    conn_lock.release()
+    write_lock.release()
+
+
+@contextlib.contextmanager
+def _read_conn():
+    """
+    从连接池中取出一个连接用于读数据库，不需要获取任何锁
+    用法：with _read_conn() as conn: ...
+    """
+    try:
+        c = _idle_conns.get_nowait()
+    except queue.Empty:
+        c = _connect()
+    try:
+        yield c
+    finally:
+        if c.in_transaction:
+            c.rollback()
+        try:
+            _idle_conns.put_nowait(c)
+        except queue.Full:
+            c.close()
+
+
+@contextlib.contextmanager
+def _write_conn():
+    """
+    获取线程锁和进程锁，并从连接池中取出一个连接用于写数据库
+    用法：with _write_conn() as conn: ...
+    """
+    _acquire_locks()
+    try:
+        with _read_conn() as c:
+            yield c
+    finally:
+        _release_locks()
 
 
 def set_proc_lock(proc_lock_sub):
@@ -42,6 +115,19 @@ def set_proc_lock(proc_lock_sub):
     proc_lock = proc_lock_sub
 
 
+def set_ingest_signal(signal):
+    """
+    设置写入新的代理之后用于通知验证进程的IngestSignal，None表示不通知
+    """
+    global ingest_signal
+    ingest_signal = signal
+
+
+def _notify_ingest():
+    if ingest_signal is not None:
+        ingest_signal.notify()
+
+
 def pushNewFetch(fetcher_name, protocol, ip, port):
     """
     爬取器新抓到了一个代理，调用本函数将代理放入数据库
@@ -56,12 +142,11 @@ def pushNewFetch(fetcher_name, protocol, ip, port):
     p.ip = ip
     p.port = port
 
-    _acquire_locks()
-    try:
+    with _write_conn() as conn:
         c = conn.cursor()
         c.execute('BEGIN EXCLUSIVE TRANSACTION;')
         # 更新proxies表
-        c.execute('SELECT * FROM proxies WHERE protocol=? AND ip=? AND port=?', (p.protocol, p.ip, p.port))
+        c.execute(f'SELECT {PROXY_COLUMNS} FROM proxies WHERE protocol=? AND ip=? AND port=?', (p.protocol, p.ip, p.port))
         row = c.fetchone()
         if row is not None:  # 已经存在(protocol, ip, port)
             old_p = Proxy.decode(row)
@@ -69,41 +154,110 @@ def pushNewFetch(fetcher_name, protocol, ip, port):
                 UPDATE proxies SET fetcher_name=?,to_validate_date=? WHERE protocol=? AND ip=? AND port=?
             """, (p.fetcher_name, min(datetime.datetime.now(), old_p.to_validate_date), p.protocol, p.ip, p.port))
         else:
-            c.execute('INSERT INTO proxies VALUES (?,?,?,?,?,?,?,?,?)', p.params())
+            c.execute(
+                f'INSERT INTO proxies({PROXY_COLUMNS},shard_key) VALUES ({PROXY_PLACEHOLDERS},?)',
+                p.params() + (shard_key(p.protocol, p.ip, p.port),)
+            )
         c.close()
         conn.commit()
-    finally:
-        _release_locks()
+    _notify_ingest()
+
+
+def pushNewFetchBatch(fetcher_name, proxies):
+    """
+    爬取器完成一次爬取之后，调用本函数将爬取到的全部代理在同一个事务中放入数据库
+    对于已经存在的(protocol, ip, port)，逻辑与pushNewFetch相同：更新fetcher_name，并让其尽快被验证
+    fetcher_name : 爬取器名称
+    proxies : list[(protocol, ip, port)]
+    返回 : 本次写入的代理数量
+    """
+    now = datetime.datetime.now()
+    rows = []
+    for protocol, ip, port in proxies:
+        p = Proxy()
+        p.fetcher_name = fetcher_name
+        p.protocol = protocol
+        p.ip = ip
+        p.port = port
+        p.to_validate_date = now
+        rows.append(p.params() + (shard_key(protocol, ip, port),))
+    if len(rows) == 0:
+        return 0
+
+    with _write_conn() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN EXCLUSIVE TRANSACTION;')
+        c.executemany(f"""
+            INSERT INTO proxies({PROXY_COLUMNS},shard_key) VALUES ({PROXY_PLACEHOLDERS},?)
+            ON CONFLICT(protocol, ip, port) DO UPDATE SET
+                fetcher_name=excluded.fetcher_name,
+                to_validate_date=min(proxies.to_validate_date, excluded.to_validate_date)
+        """, rows)
+        c.close()
+        conn.commit()
+    _notify_ingest()
+    return len(rows)
 
 
-def getToValidate(max_count=1):
+def getToValidate(max_count=1, lease_owner=None, lease_seconds=VALIDATE_LEASE_SECONDS, shard=None):
     """
     从数据库中获取待验证的代理，根据to_validate_date字段
     优先选取已经通过了验证的代理，其次是没有通过验证的代理
+    正在被验证(租约没有过期)的代理不会被返回
     max_count : 返回数量限制
+    lease_owner : 如果不为None，则在同一个事务中为返回的代理设置租约，租约的持有者为lease_owner，
+                  在租约过期或者验证结果写入数据库之前，这些代理不会再次被返回，因此可以同时运行多个验证器
+    lease_seconds : 租约时长，单位秒
+    shard : (分片编号, 分片数量)，只返回 shard_key % 分片数量 == 分片编号 的代理，用于同时运行多个验证进程，None表示不分片
     返回 : list[Proxy]
     """
-    _acquire_locks()
-    try:
+    shard_sql = ''
+    shard_params = ()
+    if shard is not None and shard[1] > 1:
+        shard_sql = 'AND shard_key % ? = ?'
+        shard_params = (shard[1], shard[0])
+    with _write_conn() as conn:
+        now = datetime.datetime.now()
         c = conn.cursor()
         c.execute('BEGIN EXCLUSIVE TRANSACTION;')
-        c.execute('SELECT * FROM proxies WHERE to_validate_date<=? AND validated=? ORDER BY to_validate_date LIMIT ?', (
-            datetime.datetime.now(),
-            True,
-            max_count
-        ))
-        proxies = [Proxy.decode(row) for row in c]
-        c.execute('SELECT * FROM proxies WHERE to_validate_date<=? AND validated=? ORDER BY to_validate_date LIMIT ?', (
-            datetime.datetime.now(),
-            False,
-            max_count - len(proxies)
-        ))
-        proxies = proxies + [Proxy.decode(row) for row in c]
+        proxies = []
+        for validated in [True, False]:
+            c.execute(f"""
+                SELECT {PROXY_COLUMNS} FROM proxies
+                WHERE to_validate_date<=? AND validated=? AND (lease_expire_date IS NULL OR lease_expire_date<=?) {shard_sql}
+                ORDER BY to_validate_date LIMIT ?
+            """, (now, validated, now) + shard_params + (max_count - len(proxies),))
+            proxies = proxies + [Proxy.decode(row) for row in c]
+        if lease_owner is not None and len(proxies) > 0:
+            lease_expire_date = now + datetime.timedelta(seconds=lease_seconds)
+            c.executemany('UPDATE proxies SET lease_owner=?,lease_expire_date=? WHERE protocol=? AND ip=? AND port=?', [
+                (lease_owner, lease_expire_date, p.protocol, p.ip, p.port) for p in proxies
+            ])
         c.close()
         conn.commit()
         return proxies
-    finally:
-        _release_locks()
+
+
+def getNextToValidateDate(shard=None):
+    """
+    返回没有被领取(或者租约已经过期)的代理中最早的to_validate_date，即下一个代理到期的时间，没有代理时返回None
+    验证器在没有到期的代理时等待到这个时间，通过to_validate_date索引按顺序查找，只需要跳过正在验证的代理
+    shard : 同getToValidate
+    """
+    shard_sql = ''
+    shard_params = ()
+    if shard is not None and shard[1] > 1:
+        shard_sql = 'AND shard_key % ? = ?'
+        shard_params = (shard[1], shard[0])
+    with _read_conn() as conn:
+        r = conn.execute(f"""
+            SELECT to_validate_date FROM proxies
+            WHERE (lease_expire_date IS NULL OR lease_expire_date<=?) {shard_sql}
+            ORDER BY to_validate_date LIMIT 1
+        """, (datetime.datetime.now(),) + shard_params)
+        row = r.fetchone()
+        r.close()
+        return row[0] if row is not None else None
 
 
 def pushValidateResult(proxy, success, latency):
@@ -113,62 +267,218 @@ def pushValidateResult(proxy, success, latency):
     success : True/False，验证是否成功
     latency : 本次验证所用的时间(单位毫秒)
     """
-    p = proxy
-    should_remove = p.validate(success, latency)
-    _acquire_locks()
-    try:
+    pushValidateResultBatch([(proxy, success, latency)])
+
+
+def pushValidateResultBatch(results):
+    """
+    将验证器的一批结果在同一个事务中添加进数据库中
+    results : list[(proxy, success, latency)]，含义同pushValidateResult的参数
+    """
+    to_delete = []
+    to_update = []
+    for p, success, latency in results:
+        should_remove = p.validate(success, latency)
         if should_remove:
-            conn.execute('DELETE FROM proxies WHERE protocol=? AND ip=? AND port=?', (p.protocol, p.ip, p.port))
+            to_delete.append((p.protocol, p.ip, p.port))
         else:
-            conn.execute("""
-                UPDATE proxies
-                SET fetcher_name=?,validated=?,latency=?,validate_date=?,to_validate_date=?,validate_failed_cnt=?
-                WHERE protocol=? AND ip=? AND port=?
-            """, (
+            to_update.append((
                 p.fetcher_name, p.validated, p.latency, p.validate_date, p.to_validate_date, p.validate_failed_cnt,
+                p.success_streak, p.uptime_ewma, p.latency_ewma, p.latency_hist, p.latency_p50, p.latency_p95,
                 p.protocol, p.ip, p.port
             ))
+    if len(to_delete) == 0 and len(to_update) == 0:
+        return
+
+    with _write_conn() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN EXCLUSIVE TRANSACTION;')
+        if len(to_delete) > 0:
+            c.executemany('DELETE FROM proxies WHERE protocol=? AND ip=? AND port=?', to_delete)
+        if len(to_update) > 0:
+            c.executemany("""
+                UPDATE proxies
+                SET fetcher_name=?,validated=?,latency=?,validate_date=?,to_validate_date=?,validate_failed_cnt=?,
+                    success_streak=?,uptime_ewma=?,latency_ewma=?,latency_hist=?,latency_p50=?,latency_p95=?,
+                    lease_owner=NULL,lease_expire_date=NULL
+                WHERE protocol=? AND ip=? AND port=?
+            """, to_update)
+        c.close()
         conn.commit()
-    finally:
-        _release_locks()
 
 
-def getValidatedRandom(max_count):
+# 拒绝采样：可用代理在rowid范围内的比例低于这个值时，改为从索引中取出所有可用代理的rowid
+_SAMPLE_MIN_DENSITY = 1 / 16
+# 拒绝采样：最多查找多少轮，每一轮都没有选够时改为从索引中取出所有可用代理的rowid
+_SAMPLE_MAX_ROUNDS = 4
+
+
+def _select_rowids(conn, rowids, where_sql=None, params=()):
+    """
+    按rowid查找代理，where_sql为额外的条件，rowid的数量较多时分批查询，避免超过SQLite的参数数量限制
+    返回 : list[(rowid, Proxy)]
+    """
+    rowids = list(rowids)
+    result = []
+    for i in range(0, len(rowids), 500):
+        chunk = rowids[i:i + 500]
+        sql = f'SELECT rowid, {PROXY_COLUMNS} FROM proxies WHERE rowid IN (' + ','.join(['?'] * len(chunk)) + ')'
+        if where_sql is not None:
+            sql += f' AND {where_sql}'
+        r = conn.execute(sql, chunk + list(params))
+        result += [(row[0], Proxy.decode(row[1:])) for row in r]
+        r.close()
+    return result
+
+
+def _sample_validated(conn, protocol, max_count):
+    """
+    从通过了验证的代理中随机选择max_count个代理，protocol为None表示不限制协议
+    为了避免ORDER BY RANDOM()对所有可用代理排序，这里使用拒绝采样：在可用代理的rowid范围内随机取值，
+    按rowid精确查找，这个rowid不是可用代理(空洞、不可用或者其他协议的代理)时重新取值，
+    因此每个可用代理被选中的概率相同，每次查找只需要O(log n)；每一轮的随机rowid在一次查询中批量查找
+    可用代理在rowid范围内很稀疏时，拒绝的次数太多，改为通过索引取出所有可用代理的rowid再随机选择
+    返回 : list[Proxy]
+    """
+    where_sql = 'validated=?'
+    params = (True,)
+    stats_sql = 'SELECT sum(validated_cnt) FROM proxy_stats'
+    stats_params = ()
+    if protocol is not None:
+        where_sql = 'protocol=? AND validated=?'
+        params = (protocol, True)
+        stats_sql += ' WHERE protocol=?'
+        stats_params = (protocol,)
+
+    r = conn.execute(f'SELECT rowid FROM proxies WHERE {where_sql} ORDER BY rowid ASC LIMIT 1', params)
+    row = r.fetchone()
+    r.close()
+    if row is None:
+        return []
+    min_rowid = row[0]
+    r = conn.execute(f'SELECT rowid FROM proxies WHERE {where_sql} ORDER BY rowid DESC LIMIT 1', params)
+    max_rowid = r.fetchone()[0]
+    r.close()
+    # 可用代理的数量从触发器维护的proxy_stats表中读取，只用来估计拒绝的比例
+    r = conn.execute(stats_sql, stats_params)
+    total = r.fetchone()[0] or 0
+    r.close()
+
+    span = max_rowid - min_rowid + 1
+    if total > max_count and total >= span * _SAMPLE_MIN_DENSITY:
+        # 每一轮随机取出一批rowid，按预计的命中比例多取一些，在一次查询中精确查找
+        proxies = {}
+        for _ in range(_SAMPLE_MAX_ROUNDS):
+            need = max_count - len(proxies)
+            if need <= 0:
+                break
+            candidates = set()
+            for _ in range(min(int(need * span / total * 1.5) + 8, span)):
+                rowid = random.randint(min_rowid, max_rowid)
+                if rowid not in proxies:
+                    candidates.add(rowid)
+            hits = _select_rowids(conn, candidates, where_sql, params)
+            # 命中的数量多于需要时随机选择一部分，每个可用代理被选中的概率仍然相同
+            for rowid, proxy in random.sample(hits, min(need, len(hits))):
+                proxies[rowid] = proxy
+        if len(proxies) >= max_count:
+            proxies = list(proxies.values())
+            random.shuffle(proxies)
+            return proxies
+
+    # 可用代理不多于max_count个、在rowid范围内很稀疏，或者多次随机都没有选够时，从索引中取出所有可用代理的rowid再随机选择
+    r = conn.execute(f'SELECT rowid FROM proxies WHERE {where_sql}', params)
+    rowids = [row[0] for row in r]
+    r.close()
+    if len(rowids) > max_count:
+        rowids = random.sample(rowids, max_count)
+    proxies = [proxy for _, proxy in _select_rowids(conn, rowids)]
+    random.shuffle(proxies)
+    return proxies
+
+
+def _select_by_latency(conn, protocol, max_count, max_latency, prefer_fast):
+    """
+    按延迟从通过了验证的代理中选择max_count个代理，protocol为None表示不限制协议
+    只考虑已经有延迟估计(latency_p95)的代理，max_latency不为None时只选择p95延迟不超过max_latency毫秒的代理
+    prefer_fast为True时，从p95延迟最低的 max(max_count, FETCH_FAST_TIER_SIZE) 个代理中随机选择，返回结果按延迟从低到高排列
+    先通过(validated, latency_p95)或(protocol, validated, latency_p95)索引只取出rowid，不需要读取表中的记录
+    max_count<=0表示不做数量限制
+    返回 : list[Proxy]
+    """
+    where_sql = 'validated=? AND latency_p95>=?'
+    params = (True, 0)
+    if protocol is not None:
+        where_sql = 'protocol=? AND ' + where_sql
+        params = (protocol,) + params
+    if max_latency is not None:
+        where_sql += ' AND latency_p95<=?'
+        params += (max_latency,)
+
+    sql = f'SELECT rowid FROM proxies WHERE {where_sql}'
+    if prefer_fast:
+        sql += ' ORDER BY latency_p95'
+        if max_count > 0:
+            sql += ' LIMIT ?'
+            params += (max(max_count, FETCH_FAST_TIER_SIZE),)
+    r = conn.execute(sql, params)
+    rowids = [row[0] for row in r]
+    r.close()
+    if max_count > 0 and len(rowids) > max_count:
+        rowids = random.sample(rowids, max_count)
+
+    proxies = []
+    for i in range(0, len(rowids), 500):
+        chunk = rowids[i:i + 500]
+        r = conn.execute(
+            f'SELECT {PROXY_COLUMNS} FROM proxies WHERE rowid IN (' + ','.join(['?'] * len(chunk)) + ')',
+            chunk
+        )
+        proxies += [Proxy.decode(row) for row in r]
+        r.close()
+    if prefer_fast:
+        proxies.sort(key=lambda p: p.latency_p95)
+    else:
+        random.shuffle(proxies)
+    return proxies
+
+
+def getValidatedRandom(max_count, max_latency=None, prefer_fast=False):
     """
     从通过了验证的代理中，随机选择max_count个代理返回
     max_count<=0表示不做数量限制
+    max_latency、prefer_fast : 按延迟选择代理，见_select_by_latency
     返回 : list[Proxy]
     """
-    _acquire_locks()
-    try:
+    with _read_conn() as conn:
+        if max_latency is not None or prefer_fast:
+            return _select_by_latency(conn, None, max_count, max_latency, prefer_fast)
         if max_count > 0:
-            r = conn.execute('SELECT * FROM proxies WHERE validated=? ORDER BY RANDOM() LIMIT ?', (True, max_count))
-        else:
-            r = conn.execute('SELECT * FROM proxies WHERE validated=? ORDER BY RANDOM()', (True,))
+            return _sample_validated(conn, None, max_count)
+        r = conn.execute(f'SELECT {PROXY_COLUMNS} FROM proxies WHERE validated=?', (True,))
         proxies = [Proxy.decode(row) for row in r]
         r.close()
+        random.shuffle(proxies)
         return proxies
-    finally:
-        _release_locks()
 
 
-def get_by_protocol(protocol, max_count):
+def get_by_protocol(protocol, max_count, max_latency=None, prefer_fast=False):
     """
     查询 protocol 字段为指定值的代理服务器记录
     max_count 表示返回记录的最大数量，如果为 0 或负数则返回所有记录
+    max_latency、prefer_fast : 按延迟选择代理，见_select_by_latency
     返回 : list[Proxy]
     """
-    _acquire_locks()
-    try:
+    with _read_conn() as conn:
+        if max_latency is not None or prefer_fast:
+            return _select_by_latency(conn, protocol, max_count, max_latency, prefer_fast)
         if max_count > 0:
-            r = conn.execute('SELECT * FROM proxies WHERE protocol=? AND validated=? ORDER BY RANDOM() LIMIT ?', (protocol, True, max_count))
-        else:
-            r = conn.execute('SELECT * FROM proxies WHERE protocol=? AND validated=? ORDER BY RANDOM()', (protocol, True))
+            return _sample_validated(conn, protocol, max_count)
+        r = conn.execute(f'SELECT {PROXY_COLUMNS} FROM proxies WHERE protocol=? AND validated=?', (protocol, True))
         proxies = [Proxy.decode(row) for row in r]
         r.close()
+        random.shuffle(proxies)
         return proxies
-    finally:
-        _release_locks()
 
 
 def pushFetcherResult(name, proxies_cnt):
@@ -177,8 +487,7 @@ def pushFetcherResult(name, proxies_cnt):
     name : 爬取器的名称
     proxies_cnt : 本次爬取到的代理数量
     """
-    _acquire_locks()
-    try:
+    with _write_conn() as conn:
         c = conn.cursor()
         c.execute('BEGIN EXCLUSIVE TRANSACTION;')
         c.execute('SELECT * FROM fetchers WHERE name=?', (name,))
@@ -195,8 +504,6 @@ def pushFetcherResult(name, proxies_cnt):
             ))
         c.close()
         conn.commit()
-    finally:
-        _release_locks()
 
 
 def pushFetcherEnable(name, enable):
@@ -205,8 +512,7 @@ def pushFetcherEnable(name, enable):
     name : 爬取器的名称
     enable : True/False, 是否启用
     """
-    _acquire_locks()
-    try:
+    with _write_conn() as conn:
         c = conn.cursor()
         c.execute('BEGIN EXCLUSIVE TRANSACTION;')
         c.execute('SELECT * FROM fetchers WHERE name=?', (name,))
@@ -221,8 +527,6 @@ def pushFetcherEnable(name, enable):
             ))
         c.close()
         conn.commit()
-    finally:
-        _release_locks()
 
 
 def getAllFetchers():
@@ -230,14 +534,11 @@ def getAllFetchers():
     获取所有的爬取器以及状态
     返回 : list[Fetcher]
     """
-    _acquire_locks()
-    try:
+    with _read_conn() as conn:
         r = conn.execute('SELECT * FROM fetchers')
         fetchers = [Fetcher.decode(row) for row in r]
         r.close()
         return fetchers
-    finally:
-        _release_locks()
 
 
 def getFetcher(name):
@@ -245,13 +546,10 @@ def getFetcher(name):
     获取指定爬取器以及状态
     返回 : Fetcher
     """
-    _acquire_locks()
-    try:
+    with _read_conn() as conn:
         r = conn.execute('SELECT * FROM fetchers WHERE name=?', (name,))
         row = r.fetchone()
         r.close()
-    finally:
-        _release_locks()
 
     if row is None:
         return None
@@ -264,29 +562,26 @@ def getProxyCount(fetcher_name):
     fetcher_name : 爬取器名称
     返回 : int
     """
-    _acquire_locks()
-    try:
-        r = conn.execute('SELECT count(*) FROM proxies WHERE fetcher_name=?', (fetcher_name,))
+    with _read_conn() as conn:
+        # proxy_stats由触发器维护，不需要扫描proxies表
+        r = conn.execute('SELECT sum(total_cnt) FROM proxy_stats WHERE fetcher_name=?', (fetcher_name,))
         cnt = r.fetchone()[0]
         r.close()
-        return cnt
-    finally:
-        _release_locks()
+        return int(cnt) if cnt is not None else 0
 
 
 def getProxiesStatus():
     """
     获取代理状态，包括`全部代理数量`，`当前可用代理数量`，`等待验证代理数量`
+    前两者从触发器维护的proxy_stats表中读取，与代理池大小无关；
+    等待验证的数量与当前时间有关，无法增量维护，通过to_validate_date索引统计
     返回 : dict
     """
-    _acquire_locks()
-    try:
-        r = conn.execute('SELECT count(*) FROM proxies')
-        sum_proxies_cnt = r.fetchone()[0]
-        r.close()
-
-        r = conn.execute('SELECT count(*) FROM proxies WHERE validated=?', (True,))
-        validated_proxies_cnt = r.fetchone()[0]
+    with _read_conn() as conn:
+        r = conn.execute('SELECT sum(total_cnt), sum(validated_cnt) FROM proxy_stats')
+        row = r.fetchone()
+        sum_proxies_cnt = int(row[0]) if row[0] is not None else 0
+        validated_proxies_cnt = int(row[1]) if row[1] is not None else 0
         r.close()
 
         r = conn.execute('SELECT count(*) FROM proxies WHERE to_validate_date<=?', (datetime.datetime.now(),))
@@ -298,35 +593,43 @@ def getProxiesStatus():
             validated_proxies_cnt=validated_proxies_cnt,
             pending_proxies_cnt=pending_proxies_cnt
         )
-    finally:
-        _release_locks()
 
 
 def pushClearFetchersStatus():
     """
     清空爬取器的统计信息，包括sum_proxies_cnt,last_proxies_cnt,last_fetch_date
     """
-    _acquire_locks()
-    try:
+    with _write_conn() as conn:
         c = conn.cursor()
         c.execute('BEGIN EXCLUSIVE TRANSACTION;')
         c.execute('UPDATE fetchers SET sum_proxies_cnt=?, last_proxies_cnt=?, last_fetch_date=?', (0, 0, None))
         c.close()
         conn.commit()
-    finally:
-        _release_locks()
 
 
 def clearProxies():
     """
     清空代理池中的所有代理记录
     """
-    _acquire_locks()
-    try:
+    with _write_conn() as conn:
         conn.execute('DELETE FROM proxies')
         conn.commit()
-    finally:
-        _release_locks()
+
+
+def _parse_validated_filter(validated):
+    """
+    将validated筛选条件统一转换为True、False或者None(不筛选)
+    """
+    if validated is None or validated == 'all':
+        return None
+    if isinstance(validated, str):
+        val = validated.strip().lower()
+        if val in ('1', 'true', 'yes'):
+            return True
+        if val in ('0', 'false', 'no'):
+            return False
+        return None
+    return bool(validated)
 
 
 def _build_proxy_query_filters(protocol=None, fetcher_name=None, validated=None, keyword=None):
@@ -341,18 +644,10 @@ def _build_proxy_query_filters(protocol=None, fetcher_name=None, validated=None,
         where_clauses.append('fetcher_name=?')
         params.append(fetcher_name)
 
-    if validated is not None and validated != 'all':
-        if isinstance(validated, str):
-            val = validated.strip().lower()
-            if val in ('1', 'true', 'yes'):
-                validated = True
-            elif val in ('0', 'false', 'no'):
-                validated = False
-            else:
-                validated = None
-        if validated is not None:
-            where_clauses.append('validated=?')
-            params.append(bool(validated))
+    validated = _parse_validated_filter(validated)
+    if validated is not None:
+        where_clauses.append('validated=?')
+        params.append(validated)
 
     if keyword is not None and keyword.strip() != '':
         kw = '%' + keyword.strip() + '%'
@@ -364,9 +659,14 @@ def _build_proxy_query_filters(protocol=None, fetcher_name=None, validated=None,
     return ' WHERE ' + ' AND '.join(where_clauses), params
 
 
+# 管理后台代理列表的排序，与proxies_admin_order_index索引对应，rowid保证顺序唯一
+PROXY_LIST_ORDER = 'validated DESC, IFNULL(latency, -1) ASC, to_validate_date ASC, rowid ASC'
+
+
 def queryProxies(protocol=None, fetcher_name=None, validated=None, keyword=None, page=1, page_size=50):
     """
     分页查询代理列表
+    页码越大，需要跳过的记录越多，翻到很深的页时请使用queryProxiesAfter
     """
     page = max(int(page), 1)
     page_size = max(int(page_size), 1)
@@ -380,26 +680,162 @@ def queryProxies(protocol=None, fetcher_name=None, validated=None, keyword=None,
     )
 
     sql = (
-        'SELECT * FROM proxies'
+        f'SELECT {PROXY_COLUMNS} FROM proxies'
         + where_sql
-        + ' ORDER BY validated DESC, latency ASC, to_validate_date ASC LIMIT ? OFFSET ?'
+        + f' ORDER BY {PROXY_LIST_ORDER} LIMIT ? OFFSET ?'
     )
     params = params + [page_size, offset]
 
-    _acquire_locks()
-    try:
+    with _read_conn() as conn:
         r = conn.execute(sql, tuple(params))
         proxies = [Proxy.decode(row) for row in r]
         r.close()
         return proxies
-    finally:
-        _release_locks()
 
 
-def countProxies(protocol=None, fetcher_name=None, validated=None, keyword=None):
+def _encode_proxies_cursor(validated, latency_key, to_validate_date, rowid):
+    data = json.dumps([validated, latency_key, to_validate_date, rowid], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_proxies_cursor(after):
     """
-    查询符合条件的代理总数
+    解析queryProxiesAfter返回的游标，游标不合法时抛出ValueError
+    返回 : (validated, latency_key, to_validate_date, rowid)
+    """
+    try:
+        text = after.strip()
+        data = base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+        validated, latency_key, to_validate_date, rowid = json.loads(data.decode('utf-8'))
+    except Exception:
+        raise ValueError('无效的游标')
+    if validated not in (0, 1) or not isinstance(latency_key, int) \
+            or not isinstance(to_validate_date, str) or not isinstance(rowid, int):
+        raise ValueError('无效的游标')
+    return validated, latency_key, to_validate_date, rowid
+
+
+def queryProxiesAfter(protocol=None, fetcher_name=None, validated=None, keyword=None, after=None, page_size=50):
+    """
+    按游标分页查询代理列表，排序与queryProxies相同
+    after : 上一页返回的游标，为None时从第一条记录开始
+    返回 : (list[Proxy], 下一页的游标)，没有更多记录时游标为None
+    游标编码了上一页最后一条记录的排序键，查询时按proxies_admin_order_index索引直接定位，
+    耗时与翻到第几页无关；游标不合法时抛出ValueError
+    """
+    page_size = max(int(page_size), 1)
+    cursor = _decode_proxies_cursor(after) if after is not None and after != '' else None
+
+    where_sql, params = _build_proxy_query_filters(
+        protocol=protocol,
+        fetcher_name=fetcher_name,
+        keyword=keyword
+    )
+    where_sql = where_sql + (' AND ' if where_sql != '' else ' WHERE ') + 'validated=?'
+
+    # 按validated分段依次查询，每一段内的排序与索引一致
+    segments = [1, 0]
+    validated = _parse_validated_filter(validated)
+    if validated is not None:
+        segments = [1 if validated else 0]
+
+    # 每一段查询都是索引上的一个连续范围，可以直接定位到起始位置
+    # (validated, 查询条件, 参数, 排序)
+    order_sql = ' ORDER BY IFNULL(latency, -1) ASC, to_validate_date ASC, rowid ASC'
+    ranges = []
+    for segment in segments:
+        if cursor is None or segment < cursor[0]:
+            ranges.append((segment, '', [], order_sql))
+        elif segment == cursor[0]:
+            # (IFNULL(latency, -1), to_validate_date, rowid) > 游标，拆分为三个依次相连的范围
+            _, latency_key, to_validate_date, rowid = cursor
+            ranges.append((segment, ' AND IFNULL(latency, -1)=? AND to_validate_date=? AND rowid>?',
+                [latency_key, to_validate_date, rowid], ' ORDER BY rowid ASC'))
+            ranges.append((segment, ' AND IFNULL(latency, -1)=? AND to_validate_date>?',
+                [latency_key, to_validate_date], ' ORDER BY to_validate_date ASC, rowid ASC'))
+            ranges.append((segment, ' AND IFNULL(latency, -1)>?', [latency_key], order_sql))
+
+    proxies = []
+    last_key = None
+    with _read_conn() as conn:
+        for segment, range_sql, range_params, range_order_sql in ranges:
+            r = conn.execute(
+                f'SELECT rowid, IFNULL(latency, -1), {PROXY_COLUMNS} FROM proxies'
+                + where_sql + range_sql + range_order_sql + ' LIMIT ?',
+                tuple(params + [segment] + range_params + [page_size - len(proxies)])
+            )
+            for row in r:
+                proxy = Proxy.decode(row[2:])
+                proxies.append(proxy)
+                last_key = (segment, row[1], str(proxy.to_validate_date), row[0])
+            r.close()
+            if len(proxies) >= page_size:
+                break
+
+    next_after = None
+    if len(proxies) >= page_size and last_key is not None:
+        next_after = _encode_proxies_cursor(*last_key)
+    return proxies, next_after
+
+
+def iterProxies(protocol=None, fetcher_name=None, validated=None, keyword=None, batch_size=1000):
+    """
+    按queryProxies的顺序遍历全部符合条件的代理，用于导出
+    每次按游标取出batch_size个代理，取完一批就归还数据库连接，
+    因此内存占用与代理数量无关，也不会长时间占用连接、阻塞WAL检查点
+    返回 : 生成器，每次产生一个Proxy
+    """
+    after = None
+    while True:
+        proxies, after = queryProxiesAfter(
+            protocol=protocol,
+            fetcher_name=fetcher_name,
+            validated=validated,
+            keyword=keyword,
+            after=after,
+            page_size=batch_size
+        )
+        for proxy in proxies:
+            yield proxy
+        if after is None:
+            break
+
+
+# 带关键字的近似计数的缓存，key为筛选条件，value为(过期时间, 数量)
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+_COUNT_CACHE_MAX_SIZE = 256
+
+
+def countProxies(protocol=None, fetcher_name=None, validated=None, keyword=None, approximate=False):
     """
+    查询符合条件的代理总数
+    没有关键字时从触发器维护的proxy_stats表中读取，结果是准确的，并且与代理池大小无关；
+    有关键字时需要扫描proxies表，approximate为True时会使用缓存的结果，
+    缓存时间为PROXY_COUNT_CACHE_SECONDS秒，在此期间返回的数量可能与实际数量不一致
+    """
+    validated = _parse_validated_filter(validated)
+    if keyword is None or keyword.strip() == '':
+        where_sql, params = _build_proxy_query_filters(protocol=protocol, fetcher_name=fetcher_name)
+        if validated is None:
+            column = 'total_cnt'
+        elif validated:
+            column = 'validated_cnt'
+        else:
+            column = 'total_cnt-validated_cnt'
+        with _read_conn() as conn:
+            r = conn.execute(f'SELECT sum({column}) FROM proxy_stats' + where_sql, tuple(params))
+            cnt = r.fetchone()[0]
+            r.close()
+            return int(cnt) if cnt is not None else 0
+
+    cache_key = (protocol, fetcher_name, validated, keyword.strip())
+    if approximate:
+        with _count_cache_lock:
+            cached = _count_cache.get(cache_key)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
     where_sql, params = _build_proxy_query_filters(
         protocol=protocol,
         fetcher_name=fetcher_name,
@@ -408,85 +844,116 @@ def countProxies(protocol=None, fetcher_name=None, validated=None, keyword=None)
     )
     sql = 'SELECT count(*) FROM proxies' + where_sql
 
-    _acquire_locks()
-    try:
+    with _read_conn() as conn:
         r = conn.execute(sql, tuple(params))
         cnt = int(r.fetchone()[0])
         r.close()
-        return cnt
-    finally:
-        _release_locks()
+
+    with _count_cache_lock:
+        if len(_count_cache) >= _COUNT_CACHE_MAX_SIZE:
+            _count_cache.clear()
+        _count_cache[cache_key] = (time.time() + PROXY_COUNT_CACHE_SECONDS, cnt)
+    return cnt
 
 
 def getProtocolStats():
     """
     返回按协议聚合的统计
     """
-    _acquire_locks()
-    try:
-        totals = {}
-        validated = {}
-
-        r = conn.execute('SELECT protocol, count(*) FROM proxies GROUP BY protocol')
-        for row in r:
-            totals[row[0]] = int(row[1])
-        r.close()
-
-        r = conn.execute('SELECT protocol, count(*) FROM proxies WHERE validated=? GROUP BY protocol', (True,))
-        for row in r:
-            validated[row[0]] = int(row[1])
-        r.close()
-
-        protocols = sorted(set(list(totals.keys()) + list(validated.keys())))
+    with _read_conn() as conn:
+        r = conn.execute("""
+            SELECT protocol, sum(total_cnt), sum(validated_cnt)
+            FROM proxy_stats
+            GROUP BY protocol
+            HAVING sum(total_cnt)>0
+            ORDER BY protocol
+        """)
         stats = []
-        for protocol in protocols:
+        for row in r:
             stats.append(dict(
-                protocol=protocol,
-                total=totals.get(protocol, 0),
-                validated=validated.get(protocol, 0)
+                protocol=row[0],
+                total=int(row[1]),
+                validated=int(row[2])
             ))
+        r.close()
         return stats
-    finally:
-        _release_locks()
 
 
 def getFetcherProxyStats():
     """
     返回每个爬取器在proxies表中的统计(总量+可用量)
     """
-    _acquire_locks()
-    try:
+    with _read_conn() as conn:
         r = conn.execute("""
-            SELECT fetcher_name, count(*) as in_db_cnt,
-                   sum(CASE WHEN validated=1 THEN 1 ELSE 0 END) as validated_cnt
-            FROM proxies
+            SELECT fetcher_name, sum(total_cnt), sum(validated_cnt)
+            FROM proxy_stats
             GROUP BY fetcher_name
+            HAVING sum(total_cnt)>0
         """)
         result = {}
         for row in r:
             result[row[0]] = dict(
                 in_db_cnt=int(row[1]),
-                validated_cnt=int(row[2]) if row[2] is not None else 0
+                validated_cnt=int(row[2])
             )
         r.close()
         return result
-    finally:
-        _release_locks()
+
+
+_PROXY_STATS_RECOUNT_SQL = """
+    SELECT protocol, fetcher_name, count(*), sum(CASE WHEN validated THEN 1 ELSE 0 END)
+    FROM proxies
+    GROUP BY protocol, fetcher_name
+"""
+
+
+def checkProxyStats(repair=False):
+    """
+    重新扫描proxies表计算统计，并与触发器维护的proxy_stats表进行对比
+    repair : 为True时，用重新计算的结果覆盖proxy_stats表
+    返回 : list[dict]，每一项是一个不一致的(protocol, fetcher_name)，为空表示完全一致
+    """
+    with _write_conn() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN EXCLUSIVE TRANSACTION;')
+        expected = {}
+        for row in c.execute(_PROXY_STATS_RECOUNT_SQL):
+            expected[(row[0], row[1])] = (int(row[2]), int(row[3]))
+        actual = {}
+        for row in c.execute('SELECT protocol, fetcher_name, total_cnt, validated_cnt FROM proxy_stats'):
+            if row[2] != 0 or row[3] != 0:
+                actual[(row[0], row[1])] = (int(row[2]), int(row[3]))
+
+        diffs = []
+        for key in sorted(set(expected.keys()) | set(actual.keys())):
+            if expected.get(key, (0, 0)) != actual.get(key, (0, 0)):
+                diffs.append(dict(
+                    protocol=key[0],
+                    fetcher_name=key[1],
+                    expected_total=expected.get(key, (0, 0))[0],
+                    actual_total=actual.get(key, (0, 0))[0],
+                    expected_validated=expected.get(key, (0, 0))[1],
+                    actual_validated=actual.get(key, (0, 0))[1]
+                ))
+
+        if repair and len(diffs) > 0:
+            c.execute('DELETE FROM proxy_stats')
+            c.execute('INSERT INTO proxy_stats ' + _PROXY_STATS_RECOUNT_SQL)
+        c.close()
+        conn.commit()
+        return diffs
 
 
 def pushFetcherError(fetcher_name, error_message):
     """
     记录抓取器错误日志
     """
-    _acquire_locks()
-    try:
+    with _write_conn() as conn:
         conn.execute(
             'INSERT INTO fetcher_errors(fetcher_name,error_message,created_at) VALUES (?,?,?)',
             (fetcher_name, str(error_message), datetime.datetime.now())
         )
         conn.commit()
-    finally:
-        _release_locks()
 
 
 def getRecentFetcherErrors(limit=20):
@@ -494,8 +961,7 @@ def getRecentFetcherErrors(limit=20):
     获取最近的抓取器错误日志
     """
     limit = max(int(limit), 1)
-    _acquire_locks()
-    try:
+    with _read_conn() as conn:
         r = conn.execute(
             'SELECT id,fetcher_name,error_message,created_at FROM fetcher_errors ORDER BY created_at DESC LIMIT ?',
             (limit,)
@@ -510,5 +976,33 @@ def getRecentFetcherErrors(limit=20):
             ))
         r.close()
         return items
-    finally:
-        _release_locks()
+
+
+def pushRuntimeStats(name, stats):
+    """
+    记录某个进程的运行统计，同名的统计会被覆盖
+    name : 统计名称，例如validator
+    stats : dict，可以被序列化为JSON
+    """
+    with _write_conn() as conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO runtime_stats(name,stats,updated_at) VALUES (?,?,?)',
+            (name, json.dumps(stats, ensure_ascii=False), datetime.datetime.now())
+        )
+        conn.commit()
+
+
+def getRuntimeStats():
+    """
+    获取所有进程的运行统计
+    返回 : dict，键为统计名称，值为统计内容，并附带updated_at字段
+    """
+    with _read_conn() as conn:
+        r = conn.execute('SELECT name,stats,updated_at FROM runtime_stats ORDER BY name')
+        result = {}
+        for row in r:
+            stats = json.loads(row[1])
+            stats['updated_at'] = str(row[2]) if row[2] is not None else None
+            result[row[0]] = stats
+        r.close()
+        return result
@@ -1,9 +1,11 @@
 # encoding: utf-8
 
-from config import DATABASE_PATH
+from config import DATABASE_PATH, DATABASE_JOURNAL_MODE
 from .Proxy import Proxy
 from .Fetcher import Fetcher
 from .FetcherError import FetcherError
+from .RuntimeStats import RuntimeStats
+from .migrations import migrate
 from fetchers import fetchers
 import sqlite3
 
@@ -13,11 +15,16 @@ def init():
     """
 
     conn = sqlite3.connect(DATABASE_PATH)
+    # journal_mode会被持久化到数据库文件中
+    conn.execute(f'PRAGMA journal_mode={DATABASE_JOURNAL_MODE}')
 
-    create_tables = Proxy.ddls + Fetcher.ddls + FetcherError.ddls
+    create_tables = Proxy.ddls + Fetcher.ddls + FetcherError.ddls + RuntimeStats.ddls
     for sql in create_tables:
         conn.execute(sql)
         conn.commit()
+
+    # 依次执行尚未执行过的数据库结构迁移
+    migrate(conn)
     
     # 注册所有的爬取器
     c = conn.cursor()
@@ -0,0 +1,68 @@
+# encoding: utf-8
+
+"""
+代理延迟分布的估计
+
+每个代理保存一个按延迟分桶的直方图(latency_hist字段)，每次验证成功时，所有桶的计数先乘以LATENCY_HIST_DECAY，
+再给本次延迟所在的桶加1，因此直方图反映的是最近十几次验证的延迟分布，而且只需要保存十几个数字。
+p50、p95由直方图在桶内线性插值得到，保存在latency_p50、latency_p95字段中，用于按延迟筛选代理(见conn.py)。
+"""
+
+# 每个桶的上界，单位毫秒，最后还有一个桶保存超过最大上界的延迟
+LATENCY_BUCKETS = (100, 200, 300, 400, 600, 800, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 12000)
+# 每次加入新的延迟之前，原有计数乘以的系数
+LATENCY_HIST_DECAY = 0.85
+
+
+def decode_hist(text):
+    """
+    将数据库中保存的直方图解析为list[float]，text为None或者格式不正确时返回全0的直方图
+    """
+    counts = [0.0] * (len(LATENCY_BUCKETS) + 1)
+    if not text:
+        return counts
+    try:
+        values = [float(x) for x in text.split(',')]
+    except ValueError:
+        return counts
+    if len(values) != len(counts):
+        return counts
+    return values
+
+
+def encode_hist(counts):
+    return ','.join(f'{x:.3g}' if x >= 0.001 else '0' for x in counts)
+
+
+def add_sample(counts, latency):
+    """
+    衰减原有的计数，并加入一个新的延迟，返回新的直方图
+    """
+    counts = [x * LATENCY_HIST_DECAY for x in counts]
+    i = 0
+    while i < len(LATENCY_BUCKETS) and latency > LATENCY_BUCKETS[i]:
+        i += 1
+    counts[i] += 1
+    return counts
+
+
+def percentile(counts, q):
+    """
+    根据直方图估计延迟的q分位数(0 < q < 1)，直方图为空时返回None
+    """
+    total = sum(counts)
+    if total <= 0:
+        return None
+    target = total * q
+    cumulative = 0
+    for i, count in enumerate(counts):
+        if count <= 0:
+            continue
+        if cumulative + count >= target:
+            lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0
+            if i == len(LATENCY_BUCKETS):
+                return lower # 超过最大上界的桶没有上界，直接返回下界
+            upper = LATENCY_BUCKETS[i]
+            return int(round(lower + (upper - lower) * (target - cumulative) / count))
+        cumulative += count
+    return LATENCY_BUCKETS[-1]
@@ -0,0 +1,236 @@
+# encoding: utf-8
+
+"""
+数据库结构迁移
+
+各个表的ddls只包含最初版本的表结构，之后对表结构的修改(新增字段、索引等)都以迁移的形式放在这里。
+每个迁移有一个递增的版本号，初始化数据库时会按版本号依次执行尚未执行过的迁移，并记录在schema_version表中。
+
+添加新的迁移：在MIGRATIONS的末尾追加一项，版本号为上一项加一。已经发布的迁移不要再修改。
+"""
+
+import datetime
+
+SCHEMA_VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS schema_version
+(
+    version INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    applied_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (version)
+)
+"""
+
+
+def _add_columns(table, columns):
+    """
+    返回一个迁移步骤，为table添加columns中尚不存在的字段
+    columns : list[(字段名称, 字段定义)]
+    """
+    def step(conn):
+        existing_columns = set(row[1] for row in conn.execute(f'PRAGMA table_info({table})'))
+        for name, ddl in columns:
+            if name not in existing_columns:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}')
+    return step
+
+
+def _fill_shard_keys(conn):
+    """
+    为已有的代理计算shard_key
+    """
+    from .Proxy import shard_key
+    rows = conn.execute('SELECT rowid, protocol, ip, port FROM proxies').fetchall()
+    conn.executemany('UPDATE proxies SET shard_key=? WHERE rowid=?', [
+        (shard_key(protocol, ip, port), rowid) for rowid, protocol, ip, port in rows
+    ])
+
+
+# (版本号, 说明, 迁移步骤)，迁移步骤可以是SQL语句，也可以是以数据库连接为参数的函数
+MIGRATIONS = [
+    (1, 'proxies: add validation lease columns', [
+        # lease_owner和lease_expire_date表示哪个验证器正在验证这个代理，以及这个租约的过期时间
+        _add_columns('proxies', [
+            ('lease_owner', 'VARCHAR(255)'),
+            ('lease_expire_date', 'TIMESTAMP'),
+        ]),
+    ]),
+    (2, 'proxies: composite indexes for hot queries', [
+        # getToValidate: validated=? AND to_validate_date<=? ORDER BY to_validate_date
+        """
+        CREATE INDEX IF NOT EXISTS proxies_validated_to_validate_date_index
+        ON proxies(validated, to_validate_date)
+        """,
+        # getValidatedRandom: validated=? ORDER BY rowid LIMIT 1(可用代理的rowid范围)，索引中隐含了rowid
+        """
+        CREATE INDEX IF NOT EXISTS proxies_validated_index
+        ON proxies(validated)
+        """,
+        # get_by_protocol、getProtocolStats: protocol=? AND validated=?
+        """
+        CREATE INDEX IF NOT EXISTS proxies_protocol_validated_index
+        ON proxies(protocol, validated)
+        """,
+        # getProxyCount、getFetcherProxyStats: fetcher_name=? AND validated=?，可以替代原有的fetcher_name索引
+        """
+        CREATE INDEX IF NOT EXISTS proxies_fetcher_name_validated_index
+        ON proxies(fetcher_name, validated)
+        """,
+        """
+        DROP INDEX IF EXISTS proxies_fetcher_name_index
+        """,
+    ]),
+    (3, 'proxy_stats: counters maintained by triggers', [
+        # 按(protocol, fetcher_name)统计的代理总量和可用量，由触发器在proxies表变化时增量维护，
+        # 这样统计接口只需要读取这张很小的表，而不用扫描整个proxies表
+        """
+        CREATE TABLE IF NOT EXISTS proxy_stats
+        (
+            protocol VARCHAR(32) NOT NULL,
+            fetcher_name VARCHAR(255) NOT NULL,
+            total_cnt INTEGER NOT NULL,
+            validated_cnt INTEGER NOT NULL,
+            PRIMARY KEY (protocol, fetcher_name)
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS proxies_stats_insert AFTER INSERT ON proxies
+        BEGIN
+            INSERT OR IGNORE INTO proxy_stats VALUES (NEW.protocol, NEW.fetcher_name, 0, 0);
+            UPDATE proxy_stats
+            SET total_cnt=total_cnt+1, validated_cnt=validated_cnt+(CASE WHEN NEW.validated THEN 1 ELSE 0 END)
+            WHERE protocol=NEW.protocol AND fetcher_name=NEW.fetcher_name;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS proxies_stats_delete AFTER DELETE ON proxies
+        BEGIN
+            UPDATE proxy_stats
+            SET total_cnt=total_cnt-1, validated_cnt=validated_cnt-(CASE WHEN OLD.validated THEN 1 ELSE 0 END)
+            WHERE protocol=OLD.protocol AND fetcher_name=OLD.fetcher_name;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS proxies_stats_update AFTER UPDATE OF protocol, fetcher_name, validated ON proxies
+        WHEN OLD.protocol IS NOT NEW.protocol OR OLD.fetcher_name IS NOT NEW.fetcher_name OR OLD.validated IS NOT NEW.validated
+        BEGIN
+            UPDATE proxy_stats
+            SET total_cnt=total_cnt-1, validated_cnt=validated_cnt-(CASE WHEN OLD.validated THEN 1 ELSE 0 END)
+            WHERE protocol=OLD.protocol AND fetcher_name=OLD.fetcher_name;
+            INSERT OR IGNORE INTO proxy_stats VALUES (NEW.protocol, NEW.fetcher_name, 0, 0);
+            UPDATE proxy_stats
+            SET total_cnt=total_cnt+1, validated_cnt=validated_cnt+(CASE WHEN NEW.validated THEN 1 ELSE 0 END)
+            WHERE protocol=NEW.protocol AND fetcher_name=NEW.fetcher_name;
+        END
+        """,
+        # 根据已有的数据初始化统计
+        """
+        DELETE FROM proxy_stats
+        """,
+        """
+        INSERT INTO proxy_stats
+        SELECT protocol, fetcher_name, count(*), sum(CASE WHEN validated THEN 1 ELSE 0 END)
+        FROM proxies
+        GROUP BY protocol, fetcher_name
+        """,
+    ]),
+    (4, 'proxies: index for admin list keyset pagination', [
+        # queryProxies/queryProxiesAfter: ORDER BY validated DESC, IFNULL(latency, -1), to_validate_date, rowid
+        # 按游标翻页时在每个validated分段内从上一页的最后一行开始查找，不需要跳过前面的记录
+        """
+        CREATE INDEX IF NOT EXISTS proxies_admin_order_index
+        ON proxies(validated, IFNULL(latency, -1), to_validate_date)
+        """,
+    ]),
+    (5, 'proxies: validation history columns', [
+        # 用于决定下次验证时间的验证历史，见Proxy.validate和schedule.py
+        _add_columns('proxies', [
+            ('success_streak', 'INTEGER NOT NULL DEFAULT 0'),
+            ('uptime_ewma', 'REAL'),
+            ('latency_ewma', 'REAL'),
+        ]),
+    ]),
+    (6, 'proxies: shard key for multiple validator processes', [
+        # 多个验证进程按 shard_key % 进程数量 划分代理，shard_key由Proxy.shard_key计算，插入代理时写入
+        _add_columns('proxies', [
+            ('shard_key', 'INTEGER NOT NULL DEFAULT 0'),
+        ]),
+        _fill_shard_keys,
+    ]),
+    (7, 'proxies: latency distribution columns and indexes', [
+        # 近期延迟的直方图以及由它估计的p50、p95，见Proxy.validate和latency.py
+        _add_columns('proxies', [
+            ('latency_hist', 'TEXT'),
+            ('latency_p50', 'INTEGER'),
+            ('latency_p95', 'INTEGER'),
+        ]),
+        # 已有的代理还没有延迟分布，先用延迟的平均值(或者最近一次的延迟)代替，下次验证成功之后会重新估计
+        """
+        UPDATE proxies
+        SET latency_p50=CAST(ROUND(IFNULL(latency_ewma, latency)) AS INTEGER),
+            latency_p95=CAST(ROUND(IFNULL(latency_ewma, latency)) AS INTEGER)
+        WHERE latency_p95 IS NULL AND IFNULL(latency_ewma, latency) IS NOT NULL
+        """,
+        # getValidatedRandom、get_by_protocol指定max_latency或prefer_fast时:
+        # validated=? [AND protocol=?] AND latency_p95>=? AND latency_p95<=? ORDER BY latency_p95
+        # 原有的(validated)、(protocol, validated)索引仍然用于随机选择，不能被替代
+        """
+        CREATE INDEX IF NOT EXISTS proxies_validated_latency_index
+        ON proxies(validated, latency_p95)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS proxies_protocol_validated_latency_index
+        ON proxies(protocol, validated, latency_p95)
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    """
+    返回数据库当前的结构版本，0表示没有执行过任何迁移
+    """
+    conn.execute(SCHEMA_VERSION_DDL)
+    row = conn.execute('SELECT max(version) FROM schema_version').fetchone()
+    return row[0] if row[0] is not None else 0
+
+
+def migrate(conn):
+    """
+    依次执行尚未执行过的迁移，每个迁移在一个单独的事务中完成
+    conn : sqlite3连接
+    返回 : 本次执行的迁移数量
+    """
+    current_version = get_version(conn)
+    conn.commit()
+
+    applied_cnt = 0
+    for version, description, steps in MIGRATIONS:
+        if version <= current_version:
+            continue
+        c = conn.cursor()
+        c.execute('BEGIN EXCLUSIVE TRANSACTION;')
+        try:
+            # 在事务中重新检查版本，避免多个进程同时初始化时重复执行
+            row = c.execute('SELECT 1 FROM schema_version WHERE version=?', (version,)).fetchone()
+            if row is not None:
+                conn.commit()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    c.execute(step)
+            c.execute('INSERT INTO schema_version(version,description,applied_at) VALUES (?,?,?)', (
+                version, description, datetime.datetime.now()
+            ))
+            conn.commit()
+            applied_cnt += 1
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+    return applied_cnt
@@ -0,0 +1,69 @@
+# encoding: utf-8
+
+"""
+下次验证时间的策略
+
+每个策略根据代理本次的验证结果以及验证历史(Proxy的success_streak、uptime_ewma等属性，已经包含了本次的结果)，
+返回距离下一次验证的时间。Proxy.validate会调用配置中VALIDATE_SCHEDULE_POLICY指定的策略。
+
+添加新的策略：实现一个带有name属性和next_delay方法的类，并添加到POLICIES中。
+"""
+
+import datetime
+import random
+from config import VALIDATE_SCHEDULE_POLICY, VALIDATE_SCHEDULE_MIN_MINUTES, VALIDATE_SCHEDULE_MAX_MINUTES
+
+
+class FixedPolicy(object):
+    """
+    原来的策略：验证成功之后10~60分钟再次验证，失败之后 连续失败次数 * 10 分钟再次验证，不考虑之前的历史
+    """
+    name = 'fixed'
+
+    def next_delay(self, proxy, success):
+        if success:
+            return datetime.timedelta(minutes=random.randint(10, 60))
+        # 验证失败的次数越多，距离下次验证的时间越长
+        return datetime.timedelta(minutes=proxy.validate_failed_cnt * 10)
+
+
+class AdaptivePolicy(object):
+    """
+    根据验证历史调整验证间隔：
+    验证成功时，间隔为 min_minutes * 连续成功次数，最多max_minutes，再乘以可用率(uptime_ewma)的4次方，
+    因此一直稳定的代理验证间隔逐渐变长，最近失败过的代理间隔较短，但不少于min_minutes；
+    验证失败时，间隔为 连续失败次数 * 10 分钟，再乘以(1 - 可用率)，
+    之前一直可用的代理偶尔失败一次很可能只是暂时的，会尽快重新验证，而从来没有成功过的代理与原来的策略相同
+    间隔会加上±10%的随机抖动，避免大量代理在同一时间到期
+    """
+    name = 'adaptive'
+
+    def __init__(self, min_minutes=VALIDATE_SCHEDULE_MIN_MINUTES, max_minutes=VALIDATE_SCHEDULE_MAX_MINUTES):
+        self.min_minutes = min_minutes
+        self.max_minutes = max(max_minutes, min_minutes)
+
+    def next_delay(self, proxy, success):
+        uptime = proxy.uptime_ewma if proxy.uptime_ewma is not None else 0
+        if success:
+            minutes = min(self.min_minutes * proxy.success_streak, self.max_minutes) * uptime ** 4
+            minutes = max(minutes, self.min_minutes)
+        else:
+            minutes = max(proxy.validate_failed_cnt * 10 * (1 - uptime), 1)
+        return datetime.timedelta(minutes=minutes * random.uniform(0.9, 1.1))
+
+
+POLICIES = {policy.name: policy for policy in [FixedPolicy, AdaptivePolicy]}
+
+_default_policy = None
+
+
+def get_policy(name=None):
+    """
+    返回指定名称的策略，默认为VALIDATE_SCHEDULE_POLICY，名称无效时使用adaptive
+    """
+    global _default_policy
+    if name is not None:
+        return POLICIES.get(name, AdaptivePolicy)()
+    if _default_policy is None:
+        _default_policy = POLICIES.get(VALIDATE_SCHEDULE_POLICY, AdaptivePolicy)()
+    return _default_policy
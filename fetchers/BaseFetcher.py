@@ -1,13 +1,250 @@
 # encoding: utf-8
 
+import re
+import time
+import logging
+import threading
+from urllib.parse import urlsplit, urljoin
+from concurrent import futures
+from .FetcherSession import get_shared_session
+
+IP_REGEX = re.compile(r'^\d+\.\d+\.\d+\.\d+$')
+PORT_REGEX = re.compile(r'^\d+$')
+
+
+class HostLimiter(object):
+    """
+    限制对同一个主机的请求：同时最多concurrency个请求，相邻两个请求开始的时间至少间隔interval秒
+    """
+
+    def __init__(self, concurrency, interval):
+        self.semaphore = threading.BoundedSemaphore(max(int(concurrency), 1))
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def acquire(self, deadline):
+        """
+        等待直到可以发出请求，返回是否在deadline之前获得了许可，获得许可之后需要调用release
+        """
+        if not self.semaphore.acquire(timeout=max(deadline - time.time(), 0)):
+            return False
+        with self.lock:
+            now = time.time()
+            start_time = max(now, self.next_time)
+            self.next_time = start_time + self.interval
+        if start_time >= deadline:
+            self.semaphore.release()
+            return False
+        time.sleep(start_time - now)
+        return True
+
+    def release(self):
+        self.semaphore.release()
+
+
 class BaseFetcher(object):
     """
     所有爬取器的基类
+
+    爬取器可以直接实现fetch，也可以使用声明式的分页爬取：实现page_urls(返回需要下载的页面)以及
+    row_selector和parse_row(或者直接实现parse_page)，由fetch_pages并发地下载和解析这些页面：
+    同一个主机同时最多下载page_concurrency个页面(不超过会话中每个主机的连接数量)，相邻两次请求至少间隔page_interval秒，
+    到了fetch_deadline秒还没有下载完时，返回已经解析到的代理，每个页面的耗时记录在page_timings中
     """
 
+    page_concurrency = 4 # 同一个主机最多同时下载多少个页面
+    page_interval = 0 # 同一个主机相邻两次请求开始的最小间隔，单位秒
+    page_timeout = 10 # 下载一个页面的超时时间，单位秒
+    fetch_deadline = 25 # 分页爬取的截止时间，单位秒，需要小于爬取进程的超时时间(30秒)
+    page_headers = None # 下载页面时额外使用的请求头，会话默认已经带有BROWSER_HEADERS
+    row_selector = None # parse_page默认的实现：用这个CSS选择器找到所有的行，再由parse_row解析每一行
+
+    def __init__(self):
+        self.page_timings = [] # list[dict(url, ms, rows, error)]
+        self.logger = logging.getLogger(type(self).__module__)
+        self._pages_lock = threading.Lock()
+        self._pending_pages = []
+        self._seen_pages = set()
+
+    @property
+    def session(self):
+        """
+        所有爬取器共用的会话(见FetcherSession.py)，同一个主机的连接会被复用，默认带有BROWSER_HEADERS
+        """
+        return get_shared_session()
+
+    def host_concurrency(self):
+        """
+        同一个主机最多同时下载多少个页面：page_concurrency，但不超过会话中每个主机的连接数量，
+        否则多出来的请求会在会话中等待空闲的连接，而这段等待也被计入了下载时间和截止时间
+        """
+        return min(self.page_concurrency, getattr(self.session, 'pool_maxsize', self.page_concurrency))
+
     def fetch(self):
         """
         执行一次爬取，返回一个数组，每个元素是(protocol, ip, port)，portocal是协议名称，目前主要为http
         返回示例：[('http', '127.0.0.1', 8080), ('http', '127.0.0.1', 1234)]
         """
+        if type(self).page_urls is not BaseFetcher.page_urls:
+            return self.fetch_pages()
         raise NotImplementedError()
+
+    def commit(self):
+        """
+        fetch返回的代理写入数据库之后由爬取进程调用，默认不做任何事情
+        爬取器可以在这里保存只有代理写入成功之后才能保存的状态，例如RawSourcesFetcher的条件请求缓存
+        """
+        pass
+
+    def page_urls(self):
+        """
+        分页爬取：返回需要下载的页面url，可以是生成器
+        """
+        raise NotImplementedError()
+
+    def parse_page(self, url, html):
+        """
+        分页爬取：解析一个页面，返回其中的代理(protocol, ip, port)
+        默认使用row_selector找到所有的行，再由parse_row逐行解析，parse_row返回None的行会被忽略
+        解析过程中可以调用add_page添加新的页面(例如从第一页中解析出后面几页的链接)
+        """
+        from pyquery import PyQuery as pq
+        doc = pq(html)
+        proxies = []
+        for row in doc(self.row_selector).items():
+            proxy = self.parse_row(row)
+            if proxy is not None:
+                proxies.append(proxy)
+        return proxies
+
+    def parse_row(self, row):
+        """
+        分页爬取：解析一行(pyquery对象)，返回(protocol, ip, port)，不是代理的行返回None
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def make_proxy(protocol, ip, port):
+        """
+        检查ip和port的格式，返回(protocol, ip, port)，格式不正确时返回None
+        """
+        ip = str(ip).strip()
+        port = str(port).strip()
+        if IP_REGEX.match(ip) is None or PORT_REGEX.match(port) is None:
+            return None
+        return (protocol, ip, int(port))
+
+    def add_page(self, url, base_url=None):
+        """
+        添加一个需要下载的页面，url可以是相对于base_url的地址，已经添加过的页面会被忽略
+        """
+        if base_url is not None:
+            url = urljoin(base_url, url)
+        with self._pages_lock:
+            if url in self._seen_pages:
+                return
+            self._seen_pages.add(url)
+            self._pending_pages.append(url)
+
+    def _take_pending_pages(self):
+        with self._pages_lock:
+            pages = self._pending_pages
+            self._pending_pages = []
+            return pages
+
+    def _download_page(self, url, limiters, deadline):
+        """
+        在线程池中运行：等待主机的限制，下载并解析一个页面
+        返回 : (代理列表, 耗时统计)
+        """
+        host = urlsplit(url).netloc
+        timing = dict(url=url, ms=None, rows=0, error=None)
+        if not limiters[host].acquire(deadline):
+            timing['error'] = 'deadline'
+            return [], timing
+        start_time = time.time()
+        try:
+            timeout = max(min(self.page_timeout, deadline - start_time), 0.1)
+            r = self.session.get(url, headers=self.page_headers, timeout=timeout)
+            proxies = self.parse_page(url, r.text)
+            timing['rows'] = len(proxies)
+            return proxies, timing
+        except Exception as e:
+            timing['error'] = str(e)
+            return [], timing
+        finally:
+            timing['ms'] = int((time.time() - start_time) * 1000)
+            limiters[host].release()
+
+    def fetch_pages(self):
+        """
+        并发地下载page_urls返回的页面(以及解析过程中add_page添加的页面)，返回去重之后的代理
+        到了截止时间还没有下载完的页面会被放弃，已经解析到的代理仍然会返回
+        所有页面都下载失败时抛出第一个错误
+        """
+        deadline = time.time() + self.fetch_deadline
+        for url in self.page_urls():
+            self.add_page(url)
+        limiters = {}
+        proxies = set()
+        first_error = None
+
+        executor = futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix='fetch-page')
+        running = set()
+        running_urls = {}
+        try:
+            while True:
+                for url in self._take_pending_pages():
+                    host = urlsplit(url).netloc
+                    if host not in limiters:
+                        limiters[host] = HostLimiter(self.host_concurrency(), self.page_interval)
+                    future = executor.submit(self._download_page, url, limiters, deadline)
+                    running.add(future)
+                    running_urls[future] = url
+                if len(running) == 0:
+                    break
+                done, running = futures.wait(
+                    running, timeout=max(deadline - time.time(), 0), return_when=futures.FIRST_COMPLETED
+                )
+                if len(done) == 0:
+                    break # 到了截止时间
+                for future in done:
+                    page_proxies, timing = future.result()
+                    proxies.update(page_proxies)
+                    self.page_timings.append(timing)
+                    if timing['error'] is not None and first_error is None:
+                        first_error = timing['error']
+        finally:
+            # 取消还没有开始下载的页面(shutdown的cancel_futures参数需要Python 3.9)
+            for future in running:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        for future in running:
+            self.page_timings.append(dict(url=running_urls[future], ms=None, rows=0, error='deadline'))
+        if len(running) > 0:
+            self.logger.warning(f'{type(self).__name__}：到达截止时间，{len(running)}个页面没有下载完，返回已经解析到的{len(proxies)}个代理')
+        ok_cnt = len([t for t in self.page_timings if t['error'] is None])
+        if ok_cnt == 0 and first_error is not None:
+            raise RuntimeError(f'所有页面都下载失败：{first_error}')
+        return list(proxies)
+
+    def fetch_stats(self):
+        """
+        分页爬取的统计：页面数量、成功和失败的数量、因为截止时间而放弃的数量，以及每个页面的耗时
+        没有使用分页爬取时返回None
+        """
+        timings = getattr(self, 'page_timings', []) # 子类的__init__可能没有调用基类的__init__
+        if len(timings) == 0:
+            return None
+        finished = [t for t in timings if t['ms'] is not None]
+        return dict(
+            pages=len(timings),
+            ok=len([t for t in timings if t['error'] is None]),
+            failed=len([t for t in finished if t['error'] is not None]),
+            skipped=len([t for t in timings if t['ms'] is None]),
+            avg_page_ms=int(sum(t['ms'] for t in finished) / len(finished)) if len(finished) > 0 else None,
+            max_page_ms=max([t['ms'] for t in finished], default=None),
+            page_timings=timings
+        )
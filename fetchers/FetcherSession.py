@@ -0,0 +1,178 @@
+# encoding: utf-8
+
+"""
+爬取器共用的HTTP会话
+
+所有爬取器通过BaseFetcher.session发送请求，同一个主机的连接会被保持并复用(keep-alive)，
+不必每个页面都重新建立TCP连接和TLS握手。每个主机最多同时使用pool_maxsize个连接，超过时等待空闲的连接。
+会话由爬取进程(proc/run_fetcher.py)创建，每轮爬取之后调用take_stats统计连接的复用情况。
+"""
+
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# 模拟浏览器的请求头，部分网站会拒绝没有这些请求头的请求，作为会话的默认请求头
+BROWSER_HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
+    'Accept-Encoding': 'gzip, deflate',
+    'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'Pragma': 'no-cache',
+    'Upgrade-Insecure-Requests': '1',
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Ubuntu Chromium/79.0.3945.130 Chrome/79.0.3945.130 Safari/537.36'
+}
+
+
+class ConnectionStats(object):
+    """
+    统计请求数量、新建连接的数量以及建立连接(TCP连接和TLS握手)的耗时，可以在多个线程中同时调用
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.hosts = {} # host: dict(requests, connections, connect_ms)
+
+    def _host(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = dict(requests=0, connections=0, connect_ms=0.0)
+        return self.hosts[host]
+
+    def record_request(self, host):
+        with self.lock:
+            self._host(host)['requests'] += 1
+
+    def record_connect(self, host, connect_ms):
+        with self.lock:
+            item = self._host(host)
+            item['connections'] += 1
+            item['connect_ms'] += connect_ms
+
+    def take(self):
+        """
+        返回上次调用take之后的统计并清零：
+        reuse_ratio为复用已有连接的请求所占的比例，
+        handshake_saved_ms为复用连接节省的建立连接时间(复用的请求数量 * 该主机建立一个连接的平均耗时)
+        """
+        with self.lock:
+            hosts = self.hosts
+            self._reset()
+        requests_cnt = sum(item['requests'] for item in hosts.values())
+        connections_cnt = sum(item['connections'] for item in hosts.values())
+        connect_ms = sum(item['connect_ms'] for item in hosts.values())
+        saved_ms = 0
+        for item in hosts.values():
+            if item['connections'] > 0:
+                saved_ms += max(item['requests'] - item['connections'], 0) * item['connect_ms'] / item['connections']
+        return dict(
+            hosts=len(hosts),
+            requests=requests_cnt,
+            new_connections=connections_cnt,
+            reused=max(requests_cnt - connections_cnt, 0),
+            reuse_ratio=round(max(requests_cnt - connections_cnt, 0) / requests_cnt, 4) if requests_cnt > 0 else None,
+            handshake_ms=round(connect_ms, 1),
+            avg_handshake_ms=round(connect_ms / connections_cnt, 1) if connections_cnt > 0 else None,
+            handshake_saved_ms=round(saved_ms, 1)
+        )
+
+
+class _CountingPoolMixin(object):
+    """
+    统计经过这个连接池的请求，以及新建连接的耗时
+    """
+    stats = None
+    pool_timeout = None
+
+    def urlopen(self, method, url, *args, **kwargs):
+        self.stats.record_request(self.host)
+        # 连接都在使用中时最多等待pool_timeout秒，避免超时被放弃的爬取线程占用连接之后其他请求一直等待
+        kwargs.setdefault('pool_timeout', self.pool_timeout)
+        return super().urlopen(method, url, *args, **kwargs)
+
+    def _new_conn(self):
+        conn = super()._new_conn()
+        connect = conn.connect
+        stats = self.stats
+        host = self.host
+
+        def timed_connect():
+            start_time = time.perf_counter()
+            try:
+                connect()
+            finally:
+                stats.record_connect(host, (time.perf_counter() - start_time) * 1000)
+        conn.connect = timed_connect
+        return conn
+
+
+class _CountingAdapter(HTTPAdapter):
+    def __init__(self, stats, pool_timeout, **kwargs):
+        self.stats = stats
+        self.pool_timeout = pool_timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        attrs = dict(stats=self.stats, pool_timeout=self.pool_timeout)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('HTTPConnectionPool', (_CountingPoolMixin, HTTPConnectionPool), attrs),
+            'https': type('HTTPSConnectionPool', (_CountingPoolMixin, HTTPSConnectionPool), attrs),
+        }
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['stats'] = self.stats
+        state['pool_timeout'] = self.pool_timeout
+        return state
+
+
+class FetcherSession(requests.Session):
+    """
+    爬取器共用的会话，可以在多个爬取线程中同时使用
+    pool_maxsize : 每个主机最多同时使用多少个连接
+    pool_connections : 最多保留多少个主机的连接池
+    pool_timeout : 同一个主机的连接都在使用中时，最多等待多少秒
+    """
+
+    def __init__(self, pool_maxsize=4, pool_connections=32, pool_timeout=10):
+        super().__init__()
+        self.headers.update(BROWSER_HEADERS)
+        self.pool_maxsize = pool_maxsize
+        self.connection_stats = ConnectionStats()
+        for prefix in ['http://', 'https://']:
+            self.mount(prefix, _CountingAdapter(
+                self.connection_stats, pool_timeout, pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True
+            ))
+
+    def take_stats(self):
+        return self.connection_stats.take()
+
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def set_shared_session(session):
+    """
+    设置所有爬取器共用的会话，由爬取进程在启动时调用
+    """
+    global _shared_session
+    with _shared_session_lock:
+        _shared_session = session
+
+
+def get_shared_session():
+    """
+    返回所有爬取器共用的会话，还没有设置时创建一个默认的会话(例如单独测试爬取器时)
+    """
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = FetcherSession()
+        return _shared_session
@@ -1,7 +1,6 @@
 # encoding: utf-8
 
 from .BaseFetcher import BaseFetcher
-import requests
 from pyquery import PyQuery as pq
 import re
 
@@ -26,17 +25,7 @@ class JiangxianliFetcher(BaseFetcher):
         port_regex = re.compile(r'^\d+$')
 
         for url in urls:
-            headers = {
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
-                'Accept-Encoding': 'gzip, deflate',
-                'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
-                'Cache-Control': 'no-cache',
-                'Connection': 'keep-alive',
-                'Pragma': 'no-cache',
-                'Upgrade-Insecure-Requests': '1',
-                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Ubuntu Chromium/79.0.3945.130 Chrome/79.0.3945.130 Safari/537.36'
-            }
-            html = requests.get(url, headers=headers, timeout=10).text
+            html = self.session.get(url, timeout=10).text
             doc = pq(html)
             for line in doc('tr').items():
                 tds = list(line('td').items())
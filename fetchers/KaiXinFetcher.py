@@ -1,7 +1,6 @@
 import re
 import time
 
-import requests
 from pyquery import PyQuery as pq
 
 from .BaseFetcher import BaseFetcher
@@ -27,7 +26,7 @@ class KaiXinFetcher(BaseFetcher):
         port_regex = re.compile(r'^\d+$')
 
         for url in urls:
-            html = requests.get(url, timeout=10).text
+            html = self.session.get(url, timeout=10).text
             doc = pq(html)
             for line in doc('tr').items():
                 tds = list(line('td').items())
@@ -1,32 +1,21 @@
 # encoding: utf-8
 
 from .BaseFetcher import BaseFetcher
-import requests
-from pyquery import PyQuery as pq
 
 class KuaidailiFetcher(BaseFetcher):
     """
     https://www.kuaidaili.com/free
     """
 
-    def fetch(self):
-        """
-        执行一次爬取，返回一个数组，每个元素是(protocol, ip, port)，portocal是协议名称，目前主要为http
-        返回示例：[('http', '127.0.0.1', 8080), ('http', '127.0.0.1', 1234)]
-        """
-        
-        urls = []
-        urls = urls + [f'https://www.kuaidaili.com/free/inha/{page}/' for page in range(1, 11)]
-        urls = urls + [f'https://www.kuaidaili.com/free/intr/{page}/' for page in range(1, 11)]
+    # 请求太快时网站会返回错误页面
+    page_concurrency = 2
+    page_interval = 1
+    row_selector = 'table tbody tr'
 
-        proxies = []
+    def page_urls(self):
+        for kind in ['inha', 'intr']:
+            for page in range(1, 11):
+                yield f'https://www.kuaidaili.com/free/{kind}/{page}/'
 
-        for url in urls:
-            html = requests.get(url, timeout=10).text
-            doc = pq(html)
-            for item in doc('table tbody tr').items():
-                ip = item.find('td[data-title="IP"]').text()
-                port = int(item.find('td[data-title="PORT"]').text())
-                proxies.append(('http', ip, port))
-        
-        return list(set(proxies))
+    def parse_row(self, row):
+        return self.make_proxy('http', row.find('td[data-title="IP"]').text(), row.find('td[data-title="PORT"]').text())
@@ -1,7 +1,5 @@
 import time
 
-import requests
-
 from .BaseFetcher import BaseFetcher
 
 
@@ -16,7 +14,7 @@ class ProxyScrapeFetcher(BaseFetcher):
         for protocol in type_list:
             url = "https://api.proxyscrape.com/?request=displayproxies&proxytype=" + protocol + "&_t=" + str(
                 time.time())
-            resp = requests.get(url).text
+            resp = self.session.get(url).text
             for data in resp.split("\n"):
                 flag_idx = data.find(":")
                 ip = data[:flag_idx]
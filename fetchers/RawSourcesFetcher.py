@@ -2,10 +2,13 @@
 
 import os
 import re
-import logging
-import requests
+import time
+import hashlib
+from urllib.parse import urlsplit
+from concurrent import futures
 
-from .BaseFetcher import BaseFetcher
+from .BaseFetcher import BaseFetcher, HostLimiter
+from .SourceCache import SourceCache, cache_file_path, source_key
 
 
 class RawSourcesFetcher(BaseFetcher):
@@ -17,22 +20,45 @@ class RawSourcesFetcher(BaseFetcher):
        例如：http,https://example.com/http.txt
     2. url（未显式指定协议时默认按 http 处理）
     支持 protocol: http/https/socks4/socks5/auto
+
+    请求时带上条件请求头，代理源没有变化(返回304或者内容的哈希值相同)时跳过解析，
+    这个代理源的代理也不会再次写入数据库，见SourceCache.py
+    缓存在commit中(代理写入数据库之后)才保存，写入失败或者爬取超时时，下次爬取仍然会重新解析这些代理源
+
+    所有代理源并发地下载(同时最多RAW_SOURCES_WORKERS个)，到了fetch_deadline还没有下载完的代理源会被放弃，
+    不会因为爬取进程的超时而丢掉已经下载完的代理源
+
+    代理源可能有几十MB，响应体按块读取，每块只解析到最后一个完整的行，剩下的部分与下一块拼接，
+    解析到的代理直接放入去重的集合，内存占用与去重之后的代理数量成正比，而与代理源的大小无关
     """
 
     _LINE_RE = re.compile(
-        r'(?:(http|https|socks4|socks5)://)?'
-        r'(\d{1,3}(?:\.\d{1,3}){3})'
-        r':(\d{1,5})',
+        rb'(?:(http|https|socks4|socks5)://)?'
+        rb'(\d{1,3}(?:\.\d{1,3}){3})'
+        rb':(\d{1,5})',
         re.IGNORECASE
     )
+    chunk_size = 64 * 1024 # 每次从响应中读取的字节数
+    # 没有换行的内容(例如整个代理源只有一行)超过这个长度时，在这些分隔符处切开解析，避免一直拼接下去
+    max_line_bytes = 1024 * 1024
+    _SEPARATORS = (b' ', b'\t', b',', b';', b'"', b"'", b'<', b'>', b'|')
+    # 也没有这些分隔符时，在末尾这么多字节中最后一个不可能属于代理的字节处强制切开，一个代理最长约30字节
+    _FORCE_SPLIT_WINDOW = 64
+    _FORCE_SPLIT_RE = re.compile(rb'[^0-9A-Za-z.:/][0-9A-Za-z.:/]*\Z')
 
     def __init__(self):
-        self.logger = logging.getLogger(__name__)
+        super().__init__()
         self.sources_file = os.getenv(
             'RAW_SOURCES_FILE',
             os.path.join(os.path.dirname(__file__), '..', 'sources', 'raw_sources.txt')
         )
         self.request_timeout = int(os.getenv('RAW_SOURCES_TIMEOUT', '8'))
+        self.workers = int(os.getenv('RAW_SOURCES_WORKERS', '8')) # 同时下载的代理源数量
+        self._source_keys = None # 最近一次fetch的代理源，commit时用来清理缓存项
+        cache_path = cache_file_path()
+        self.cache = None if cache_path is None else SourceCache(
+            cache_path, max_age=int(os.getenv('RAW_SOURCES_CACHE_MAX_AGE', str(6 * 3600)))
+        )
 
     @staticmethod
     def _valid_ipv4(ip):
@@ -75,37 +101,177 @@ class RawSourcesFetcher(BaseFetcher):
                     sources.append((protocol, url))
         return sources
 
-    def _parse_text(self, text, source_protocol):
-        proxies = []
-        for match in self._LINE_RE.finditer(text):
-            inline_protocol = match.group(1)
-            ip = match.group(2)
-            port_raw = match.group(3)
-
+    def _parse_bytes(self, data, source_protocol, proxies):
+        """
+        解析一段完整的内容(不会在一个代理的中间截断)，将代理(protocol, ip, port)放入集合proxies
+        """
+        protocols = {} # 行内协议 -> 规范化之后的协议，同一个协议使用同一个字符串对象
+        for inline_protocol, ip_raw, port_raw in self._LINE_RE.findall(data):
+            ip = ip_raw.decode('ascii')
             if not self._valid_ipv4(ip):
                 continue
 
-            try:
-                port = int(port_raw)
-            except ValueError:
+            port = int(port_raw)
+            if port <= 0 or port > 65535:
                 continue
 
-            if port <= 0 or port > 65535:
+            protocol = protocols.get(inline_protocol)
+            if protocol is None:
+                protocol = self._normalize_protocol(inline_protocol.decode('ascii'), source_protocol)
+                protocols[inline_protocol] = protocol
+            proxies.add((protocol, ip, port))
+
+    def _split_point(self, buf):
+        """
+        返回buf中可以切开的位置(这个位置之前的内容可以解析，这个位置的字节会被丢弃)，没有时返回-1
+        buf超过max_line_bytes时一定会切开，因此剩下的部分不会超过max_line_bytes加上一块的大小，内存占用不会随着响应体增长
+        """
+        pos = buf.rfind(b'\n')
+        if pos < 0 and len(buf) > self.max_line_bytes:
+            pos = max(buf.rfind(sep) for sep in self._SEPARATORS)
+            if pos < 0:
+                start = len(buf) - self._FORCE_SPLIT_WINDOW
+                m = self._FORCE_SPLIT_RE.search(buf, start)
+                # 末尾的字节全都可能属于代理时(例如一直是数字)，只能在窗口的开头切开
+                pos = m.start() if m is not None else start
+        return pos
+
+    def _parse_stream(self, chunks, source_protocol, proxies):
+        """
+        按块解析响应体，chunks为bytes的迭代器
+        返回 : 内容的哈希值(sha256)
+        """
+        hasher = hashlib.sha256()
+        tail = b''
+        for chunk in chunks:
+            hasher.update(chunk)
+            buf = tail + chunk if len(tail) > 0 else chunk
+            pos = self._split_point(buf)
+            if pos < 0:
+                tail = buf
                 continue
+            self._parse_bytes(buf[:pos], source_protocol, proxies)
+            tail = buf[pos + 1:]
+        if len(tail) > 0:
+            self._parse_bytes(tail, source_protocol, proxies)
+        return hasher.hexdigest()
 
-            protocol = self._normalize_protocol(inline_protocol, source_protocol)
-            proxies.append((protocol, ip, port))
+    def _read_chunks(self, resp, deadline):
+        """
+        按块读取响应体，到了截止时间还没有读完时抛出TimeoutError
+        """
+        for chunk in resp.iter_content(self.chunk_size):
+            if time.time() > deadline:
+                raise TimeoutError('deadline')
+            yield chunk
+
+    def _fetch_source(self, protocol, url, deadline):
+        """
+        下载并解析一个代理源
+        返回 : set(代理)，代理源没有变化时返回空集合
+        """
+        key = source_key(protocol, url)
+        headers = self.cache.request_headers(key) if self.cache is not None else None
+        timeout = max(min(self.request_timeout, deadline - time.time()), 0.1)
+        proxies = set()
+        with self.session.get(url, headers=headers, timeout=timeout, stream=True) as resp:
+            etag = resp.headers.get('ETag')
+            last_modified = resp.headers.get('Last-Modified')
+            if resp.status_code == 304:
+                if self.cache is not None:
+                    self.cache.record_hit(key, 'not_modified', etag, last_modified)
+                return proxies
+            resp.raise_for_status()
+            # 服务器不支持条件请求时，只有读完才能知道内容是否变化，这时解析的结果会被丢弃，但不会写入数据库
+            digest = self._parse_stream(self._read_chunks(resp, deadline), protocol, proxies)
+        if self.cache is None:
+            return proxies
+        if self.cache.is_unchanged(key, digest):
+            self.cache.record_hit(key, 'unchanged', etag, last_modified)
+            return set()
+        self.cache.record_miss(key, etag, last_modified, digest, len(proxies))
         return proxies
 
+    def _download_source(self, protocol, url, limiters, deadline):
+        """
+        在线程池中运行：等待主机的限制，下载并解析一个代理源
+        返回 : (代理集合, 耗时统计)
+        """
+        key = source_key(protocol, url)
+        host = urlsplit(url).netloc
+        timing = dict(url=url, protocol=protocol, ms=None, rows=0, error=None)
+        if not limiters[host].acquire(deadline):
+            timing['error'] = 'deadline'
+            if self.cache is not None:
+                self.cache.record_error(key, 'deadline', 'timeout')
+            return set(), timing
+        start_time = time.time()
+        try:
+            proxies = self._fetch_source(protocol, url, deadline)
+            timing['rows'] = len(proxies)
+            return proxies, timing
+        except Exception as err:
+            self.logger.error('raw source fetch failed: %s, %s', url, err)
+            timing['error'] = str(err)
+            if self.cache is not None:
+                self.cache.record_error(key, err, 'timeout' if isinstance(err, TimeoutError) else 'error')
+            return set(), timing
+        finally:
+            timing['ms'] = int((time.time() - start_time) * 1000)
+            if self.cache is not None:
+                self.cache.record_duration(key, timing['ms'])
+            limiters[host].release()
+
     def fetch(self):
-        all_proxies = []
-        for protocol, url in self._load_sources():
-            try:
-                resp = requests.get(url, timeout=self.request_timeout)
-                resp.raise_for_status()
-                all_proxies.extend(self._parse_text(resp.text, protocol))
-            except Exception as err:
-                self.logger.error('raw source fetch failed: %s, %s', url, err)
-
-        # 去重，保证返回格式符合项目要求
-        return list(set(all_proxies))
+        """
+        并发地下载所有代理源，同时最多下载workers个，同一个主机同时最多host_concurrency()个
+        到了fetch_deadline秒还没有下载完的代理源会被放弃，已经下载完的代理源中的代理仍然会返回
+        每个代理源的耗时和解析到的代理数量记录在page_timings(运行统计)以及缓存中(管理后台的代理源页面)
+        """
+        deadline = time.time() + self.fetch_deadline
+        sources = self._load_sources()
+        limiters = {}
+        for _, url in sources:
+            host = urlsplit(url).netloc
+            if host not in limiters:
+                limiters[host] = HostLimiter(self.host_concurrency(), self.page_interval)
+
+        all_proxies = set()
+        executor = futures.ThreadPoolExecutor(max_workers=max(self.workers, 1), thread_name_prefix='raw-source')
+        running = {}
+        try:
+            for protocol, url in sources:
+                future = executor.submit(self._download_source, protocol, url, limiters, deadline)
+                running[future] = (protocol, url)
+            done, not_done = futures.wait(running, timeout=max(deadline - time.time(), 0))
+            for future in done:
+                proxies, timing = future.result()
+                all_proxies.update(proxies)
+                self.page_timings.append(timing)
+        finally:
+            # 取消还没有开始下载的代理源(shutdown的cancel_futures参数需要Python 3.9)
+            for future in running:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        for future in not_done:
+            protocol, url = running[future]
+            self.page_timings.append(dict(url=url, protocol=protocol, ms=None, rows=0, error='deadline'))
+            if self.cache is not None:
+                self.cache.record_error(source_key(protocol, url), 'deadline', 'timeout')
+        if len(not_done) > 0:
+            self.logger.warning(f'到达截止时间，{len(not_done)}个代理源没有下载完，返回已经解析到的{len(all_proxies)}个代理')
+        self._source_keys = [source_key(protocol, url) for protocol, url in sources]
+        return list(all_proxies)
+
+    def commit(self):
+        """
+        代理写入数据库之后保存缓存，只保留当前配置的代理源的缓存项
+        在这之前保存的话，写入数据库失败时，下次爬取会认为这些代理源没有变化而跳过，直到超过max_age
+        """
+        if self.cache is None or self._source_keys is None:
+            return
+        try:
+            self.cache.save(self._source_keys)
+        except OSError as err:
+            self.logger.error('raw source cache save failed: %s', err)
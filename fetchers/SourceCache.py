@@ -0,0 +1,162 @@
+# encoding: utf-8
+
+"""
+RawSourcesFetcher的条件请求缓存
+
+很多raw代理源(例如GitHub上的代理列表)一天只更新几次，而爬取器每隔PROC_FETCHER_SLEEP秒就会运行一次。
+缓存按代理源(protocol,url，同一个url可以按不同的协议配置多次)记录服务器返回的ETag、Last-Modified以及内容的哈希值：
+下次请求时带上If-None-Match、If-Modified-Since，服务器返回304或者内容的哈希值没有变化时，
+跳过解析和写入数据库。每个代理源的命中、未命中次数也记录在缓存中，在管理后台的代理源页面显示。
+
+即使代理源一直没有变化，超过max_age秒之后也会重新解析并写入数据库一次，
+避免代理池被清空之后，这些代理要等到代理源更新才能重新加入。
+"""
+
+import os
+import json
+import time
+import datetime
+import threading
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.dirname(__file__), '..', 'sources', 'raw_sources_cache.json')
+
+
+def cache_file_path():
+    """
+    缓存文件的路径，RAW_SOURCES_CACHE_FILE设置为空字符串时不使用缓存，返回None
+    """
+    path = os.getenv('RAW_SOURCES_CACHE_FILE', DEFAULT_CACHE_FILE)
+    if path.strip() == '':
+        return None
+    return os.path.abspath(path)
+
+
+def source_key(protocol, url):
+    return f'{protocol},{url}'
+
+
+class SourceCache(object):
+    """
+    path : 缓存文件路径
+    max_age : 代理源没有变化时，最多间隔多少秒重新写入一次数据库
+    缓存项的key为代理源的protocol,url，见source_key
+    每个代理源的缓存项：
+    etag、last_modified、content_hash : 上一次完整下载时服务器返回的校验信息，以及内容的哈希值
+    ingested_at : 上一次解析并写入数据库的时间戳
+    hits、misses : 命中(没有变化，跳过解析)和未命中(重新解析)的次数
+    last_result : 最近一次的结果，not_modified(服务器返回304)、unchanged(内容的哈希值没有变化)、changed、error、timeout(到了截止时间)
+    last_proxies_cnt、last_fetch_date、last_error、last_ms : 最近一次解析到的代理数量、请求时间、错误以及耗时(毫秒)
+    """
+
+    def __init__(self, path, max_age=6 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = load_entries(path)
+
+    def _entry(self, key):
+        if key not in self.entries:
+            self.entries[key] = dict(
+                etag=None, last_modified=None, content_hash=None, ingested_at=None,
+                hits=0, misses=0, last_result=None, last_proxies_cnt=0, last_fetch_date=None, last_error=None, last_ms=None
+            )
+        return self.entries[key]
+
+    def is_fresh(self, key):
+        """
+        代理源距离上一次写入数据库是否还没有超过max_age，超过之后即使没有变化也需要重新解析
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry['ingested_at'] is not None and time.time() - entry['ingested_at'] < self.max_age
+
+    def request_headers(self, key):
+        """
+        条件请求的请求头，缓存项已经超过max_age时不发送条件请求
+        """
+        if not self.is_fresh(key):
+            return {}
+        with self.lock:
+            entry = self.entries[key]
+            headers = {}
+            if entry['etag'] is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+            return headers
+
+    def is_unchanged(self, key, digest):
+        """
+        内容的哈希值与上一次相同，并且还没有超过max_age
+        """
+        if not self.is_fresh(key):
+            return False
+        with self.lock:
+            return self.entries[key]['content_hash'] == digest
+
+    def record_hit(self, key, result, etag=None, last_modified=None):
+        with self.lock:
+            entry = self._entry(key)
+            entry['hits'] += 1
+            entry['last_result'] = result
+            entry['last_proxies_cnt'] = 0
+            entry['last_fetch_date'] = datetime.datetime.now().isoformat(timespec='seconds')
+            entry['last_error'] = None
+            if etag is not None:
+                entry['etag'] = etag
+            if last_modified is not None:
+                entry['last_modified'] = last_modified
+
+    def record_miss(self, key, etag, last_modified, digest, proxies_cnt):
+        with self.lock:
+            entry = self._entry(key)
+            entry['misses'] += 1
+            entry['last_result'] = 'changed'
+            entry['last_proxies_cnt'] = proxies_cnt
+            entry['last_fetch_date'] = datetime.datetime.now().isoformat(timespec='seconds')
+            entry['last_error'] = None
+            entry['etag'] = etag
+            entry['last_modified'] = last_modified
+            entry['content_hash'] = digest
+            entry['ingested_at'] = time.time()
+
+    def record_error(self, key, error, result='error'):
+        with self.lock:
+            entry = self._entry(key)
+            entry['last_result'] = result
+            entry['last_proxies_cnt'] = 0
+            entry['last_fetch_date'] = datetime.datetime.now().isoformat(timespec='seconds')
+            entry['last_error'] = str(error)
+
+    def record_duration(self, key, ms):
+        with self.lock:
+            self._entry(key)['last_ms'] = ms
+
+    def save(self, keys):
+        """
+        写入缓存文件，只保留keys(当前配置的代理源)的缓存项
+        先写入临时文件再替换，管理后台读取时不会读到写了一半的文件
+        """
+        keys = set(keys)
+        with self.lock:
+            self.entries = {key: entry for key, entry in self.entries.items() if key in keys}
+            data = json.dumps(self.entries, ensure_ascii=False, indent=2)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+
+def load_entries(path):
+    """
+    读取缓存文件，返回 : dict(source_key: 缓存项)，文件不存在或者无法解析时返回空的dict
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
@@ -2,7 +2,6 @@ import re
 import time
 import random
 
-import requests
 from pyquery import PyQuery as pq
 
 from .BaseFetcher import BaseFetcher
@@ -34,7 +33,7 @@ class XiLaFetcher(BaseFetcher):
 
         for url in urls:
             time.sleep(1)
-            html = requests.get(url, timeout=10).text
+            html = self.session.get(url, timeout=10).text
             doc = pq(html)
             for line in doc('tr').items():
                 tds = list(line('td').items())
@@ -2,7 +2,6 @@ import re
 import time
 import random
 
-import requests
 from pyquery import PyQuery as pq
 
 from .BaseFetcher import BaseFetcher
@@ -30,7 +29,7 @@ class XiaoShuFetcher(BaseFetcher):
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36"
         }
         for page in range(new_index, new_index + 1):
-            response = requests.get("http://www.xsdaili.cn/dayProxy/" + str(page) + ".html", headers=headers, timeout=10)
+            response = self.session.get("http://www.xsdaili.cn/dayProxy/" + str(page) + ".html", headers=headers, timeout=10)
             for item in pq(response.text)('a').items():
                 try:
                     if "/dayProxy/ip" in item.attr("href"):
@@ -38,7 +37,7 @@ class XiaoShuFetcher(BaseFetcher):
                 except Exception:
                     continue
             for url in urls:
-                response = requests.get(url, headers=headers, timeout=8)
+                response = self.session.get(url, headers=headers, timeout=8)
                 doc = pq(response.text)
                 for item in doc(".cont").items():
                     for line in item.text().split("\n"):
@@ -183,7 +183,10 @@
         const state = {
             page: 1,
             pageSize: 50,
-            total: 0
+            total: 0,
+            // cursors[i]为第i+1页的游标，按游标翻页，耗时与页码无关
+            cursors: [''],
+            nextAfter: null
         };
 
         async function loadFetchers() {
@@ -204,14 +207,22 @@
                 validated: document.getElementById('validatedFilter').value,
                 fetcher_name: document.getElementById('fetcherFilter').value,
                 keyword: document.getElementById('keywordFilter').value.trim(),
-                page: state.page,
-                page_size: state.pageSize
+                after: state.cursors[state.page - 1],
+                page_size: state.pageSize,
+                total_mode: 'approx'
             };
         }
 
+        function resetPages() {
+            state.page = 1;
+            state.cursors = [''];
+            state.nextAfter = null;
+        }
+
         async function load() {
             const data = await apiGet('/admin/proxies', filters());
             state.total = data.total || 0;
+            state.nextAfter = data.next_after || null;
             const rows = data.items || [];
             document.getElementById('proxiesBody').innerHTML = rows.map((row) => `
                 <tr>
@@ -221,6 +232,7 @@
                     <td>${row.port}</td>
                     <td class="${row.validated ? 'status-good' : 'status-bad'}">${row.validated ? '可用' : '不可用'}</td>
                     <td>${row.latency == null ? '-' : row.latency}</td>
+                    <td>${row.latency_p50 == null ? '-' : `${row.latency_p50}/${row.latency_p95}`}</td>
                     <td>${escapeHtml(fmtDate(row.validate_date))}</td>
                 </tr>
             `).join('');
@@ -229,18 +241,20 @@
             setStatus('代理列表已更新', false);
         }
 
-        function exportCsv() {
+        function exportProxies() {
             const f = filters();
-            delete f.page;
+            delete f.after;
             delete f.page_size;
-            window.open(qs('/admin/proxies/export.csv', f), '_blank');
+            delete f.total_mode;
+            const format = document.getElementById('exportFormat').value;
+            window.open(qs(`/admin/proxies/export.${format}`, f), '_blank');
         }
 
         document.getElementById('searchBtn').addEventListener('click', async () => {
-            state.page = 1;
+            resetPages();
             await load();
         });
-        document.getElementById('exportBtn').addEventListener('click', exportCsv);
+        document.getElementById('exportBtn').addEventListener('click', exportProxies);
         document.getElementById('refreshBtn').addEventListener('click', load);
         document.getElementById('prevPageBtn').addEventListener('click', async () => {
             if (state.page > 1) {
@@ -249,15 +263,15 @@
             }
         });
         document.getElementById('nextPageBtn').addEventListener('click', async () => {
-            const maxPage = Math.max(Math.ceil(state.total / state.pageSize), 1);
-            if (state.page < maxPage) {
+            if (state.nextAfter) {
+                state.cursors[state.page] = state.nextAfter;
                 state.page += 1;
                 await load();
             }
         });
         document.getElementById('pageSize').addEventListener('change', async (e) => {
             state.pageSize = Number(e.target.value) || 50;
-            state.page = 1;
+            resetPages();
             await load();
         });
 
@@ -302,6 +316,20 @@
             document.getElementById('sourcePath').textContent = data.file_path || '-';
             const text = (data.lines || []).join('\n');
             document.getElementById('sourceEditor').value = text;
+            const resultNames = { not_modified: '未修改(304)', unchanged: '内容未变化', changed: '已更新', error: '出错', timeout: '超时' };
+            document.getElementById('sourceStatsBody').innerHTML = (data.source_stats || []).map((row) => `
+                <tr>
+                    <td>${escapeHtml(row.protocol)}</td>
+                    <td>${escapeHtml(row.url)}</td>
+                    <td>${row.hits}</td>
+                    <td>${row.misses}</td>
+                    <td>${row.hit_ratio == null ? '-' : (row.hit_ratio * 100).toFixed(1) + '%'}</td>
+                    <td class="${row.last_result === 'error' || row.last_result === 'timeout' ? 'status-bad' : ''}" title="${escapeHtml(row.last_error || '')}">${escapeHtml(resultNames[row.last_result] || '-')}</td>
+                    <td>${row.last_ms == null ? '-' : row.last_ms}</td>
+                    <td>${row.last_proxies_cnt}</td>
+                    <td>${escapeHtml(fmtDate(row.last_fetch_date))}</td>
+                </tr>
+            `).join('');
             renderValidation();
             setStatus('代理源已加载', false);
         }
@@ -345,7 +373,12 @@
             document.getElementById('apiHealth').textContent = health.api_ok ? 'OK' : 'FAIL';
             document.getElementById('dbHealth').textContent = health.db_ok ? 'OK' : 'FAIL';
             document.getElementById('registeredFetchers').textContent = health.fetchers_registered || 0;
+            const concurrency = summary.validator_concurrency;
+            document.getElementById('validatorConcurrency').textContent = concurrency ? concurrency.limit : '-';
+            document.getElementById('validatorConcurrencyReason').textContent =
+                concurrency && concurrency.last_decision ? concurrency.last_decision.reason : '-';
             document.getElementById('runtimeConfig').textContent = JSON.stringify(summary.runtime_config || {}, null, 2);
+            document.getElementById('runtimeStats').textContent = JSON.stringify(summary.runtime_stats || {}, null, 2);
             setStatus('系统信息已更新', false);
         }
 
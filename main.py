@@ -5,29 +5,45 @@ sys.path.append(os.path.dirname(__file__) + os.sep + '../')
 from multiprocessing import Process
 import time
 from proc import run_fetcher, run_validator
+from proc.wakeup import IngestSignal
 from api import api
+from config import VALIDATE_PROCESS_NUM
 import multiprocessing
 
 # 进程锁
 proc_lock = multiprocessing.Lock()
+# 爬取器写入新的代理之后，通过它唤醒各个验证进程
+ingest_signal = IngestSignal(max(VALIDATE_PROCESS_NUM, 1))
 
 class Item:
-    def __init__(self, target, name):
+    def __init__(self, target, name, args=()):
         self.target = target
         self.name = name
+        self.args = args # 除进程锁以外的参数
         self.process = None
         self.start_time = 0
 
+def validator_items():
+    """
+    VALIDATE_PROCESS_NUM个验证进程，每个进程负责一个分片的代理
+    """
+    if VALIDATE_PROCESS_NUM <= 1:
+        return [Item(target=run_validator.main, name='validator', args=(0, 1, ingest_signal))]
+    return [
+        Item(target=run_validator.main, name=f'validator-{i}', args=(i, VALIDATE_PROCESS_NUM, ingest_signal))
+        for i in range(VALIDATE_PROCESS_NUM)
+    ]
+
 def main():
     processes = []
-    processes.append(Item(target=run_fetcher.main, name='fetcher'))
-    processes.append(Item(target=run_validator.main, name='validator'))
+    processes.append(Item(target=run_fetcher.main, name='fetcher', args=(ingest_signal,)))
+    processes += validator_items()
     processes.append(Item(target=api.main, name='api'))
 
     while True:
         for p in processes:
             if p.process is None:
-                p.process = Process(target=p.target, name=p.name, daemon=False, args=(proc_lock, ))
+                p.process = Process(target=p.target, name=p.name, daemon=False, args=(proc_lock, ) + p.args)
                 p.process.start()
                 print(f'启动{p.name}进程，pid={p.process.pid}')
                 p.start_time = time.time()
@@ -60,13 +76,13 @@ def citest():
     此函数仅用于检查程序是否可运行，一般情况下使用本项目可忽略
     """
     processes = []
-    processes.append(Item(target=run_fetcher.main, name='fetcher'))
-    processes.append(Item(target=run_validator.main, name='validator'))
+    processes.append(Item(target=run_fetcher.main, name='fetcher', args=(ingest_signal,)))
+    processes += validator_items()
     processes.append(Item(target=api.main, name='api'))
 
     for p in processes:
         assert p.process is None
-        p.process = Process(target=p.target, name=p.name, daemon=False, args=(proc_lock, ))
+        p.process = Process(target=p.target, name=p.name, daemon=False, args=(proc_lock, ) + p.args)
         p.process.start()
         print(f'running {p.name}, pid={p.process.pid}')
         p.start_time = time.time()
@@ -78,10 +94,33 @@ def citest():
         assert p.process.is_alive()
         p.process.terminate()
 
+def check_stats(repair):
+    """
+    检查触发器维护的代理统计(proxy_stats表)是否与proxies表一致
+    用法：python main.py check_stats [--repair]
+    """
+    from db import conn
+    diffs = conn.checkProxyStats(repair=repair)
+    for item in diffs:
+        print(
+            f"{item['protocol']}/{item['fetcher_name']}: "
+            f"total {item['actual_total']} -> {item['expected_total']}, "
+            f"validated {item['actual_validated']} -> {item['expected_validated']}"
+        )
+    if len(diffs) == 0:
+        print('统计一致')
+    elif repair:
+        print(f'已修复{len(diffs)}项不一致的统计')
+    else:
+        print(f'发现{len(diffs)}项不一致的统计，可使用 --repair 参数修复')
+        sys.exit(2)
+
 if __name__ == '__main__':
     try:
         if len(sys.argv) >= 2 and sys.argv[1] == 'citest':
             citest()
+        elif len(sys.argv) >= 2 and sys.argv[1] == 'check_stats':
+            check_stats('--repair' in sys.argv[2:])
         else:
             main()
         sys.exit(0)
@@ -0,0 +1,489 @@
+# encoding: utf-8
+"""
+基于asyncio的验证器
+所有验证都在同一个线程的事件循环中进行，每个正在验证的代理只占用一个协程和一个socket，
+因此一个进程可以同时验证数千个代理，而不需要数千个线程
+"""
+
+import asyncio
+import ssl
+import socket
+import struct
+import ipaddress
+import threading
+import logging
+import time
+from urllib.parse import urlsplit
+from config import VALIDATE_METHOD, VALIDATE_KEYWORD, VALIDATE_HEADER, VALIDATE_URL, VALIDATE_TIMEOUT, VALIDATE_MAX_FAILS
+from config import VALIDATE_CONNECT_TIMEOUT, VALIDATE_PROXY_BUDGET, VALIDATE_MAX_BODY_BYTES, VALIDATE_RACE_STAGGER_MS
+from .stage_stats import transfer_stats
+from .concurrency import attempt_stats, classify_error
+
+# 验证时请求的网址，启动时解析一次
+_url = urlsplit(VALIDATE_URL)
+URL_SCHEME = _url.scheme.lower()
+URL_HOST = _url.hostname
+URL_PORT = _url.port or (443 if URL_SCHEME == 'https' else 80)
+URL_PATH = (_url.path or '/') + (('?' + _url.query) if _url.query else '')
+URL_HOST_HEADER = _url.netloc.rsplit('@', 1)[-1]
+
+# 与requests发送的请求头保持一致，但不接受压缩，省去解压
+REQUEST_HEADERS = [
+    ('Host', URL_HOST_HEADER),
+    ('User-Agent', 'python-requests/2'),
+    ('Accept', '*/*'),
+    ('Accept-Encoding', 'identity'),
+    ('Connection', 'close'),
+]
+
+# 每次读取响应体的最大字节数
+BODY_CHUNK_SIZE = 8192
+
+_ssl_context = None
+
+
+def _get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+class ProxyError(Exception):
+    """
+    代理握手失败，或者返回了不合法的响应
+    """
+    pass
+
+
+def _is_ip(host):
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+async def _read_headers(reader):
+    """
+    读取HTTP响应的状态行和响应头
+    返回 : (状态码, dict{小写的响应头名称: 值}, 读取的字节数)
+    """
+    status_line = await reader.readline()
+    size = len(status_line)
+    parts = status_line.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+        raise ProxyError('无效的状态行')
+    try:
+        status = int(parts[1])
+    except ValueError:
+        raise ProxyError('无效的状态码')
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        size += len(line)
+        if line in (b'\r\n', b'\n'):
+            break
+        if line == b'':
+            raise ProxyError('响应头不完整')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, headers, size
+
+
+async def _read_exactly(reader, size):
+    """
+    逐段读取size个字节，每次最多BODY_CHUNK_SIZE个字节
+    """
+    while size > 0:
+        chunk = await reader.read(min(size, BODY_CHUNK_SIZE))
+        if not chunk:
+            raise ProxyError('响应体不完整')
+        size -= len(chunk)
+        yield chunk
+
+
+async def _iter_body(reader, headers):
+    """
+    根据Transfer-Encoding或Content-Length逐段读取响应体，都没有时读取到连接关闭
+    调用者可以随时停止读取，剩下的部分不会再读取
+    """
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            size_line = await reader.readline()
+            try:
+                size = int(size_line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise ProxyError('无效的chunk')
+            if size == 0:
+                return
+            async for chunk in _read_exactly(reader, size):
+                yield chunk
+            await reader.readline()
+    elif 'content-length' in headers:
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            raise ProxyError('无效的Content-Length')
+        async for chunk in _read_exactly(reader, length):
+            yield chunk
+    else:
+        while True:
+            chunk = await reader.read(BODY_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class KeywordScanner(object):
+    """
+    在逐段读取的响应体中查找关键字，找到之后就不必再读取剩下的部分
+    只保留上一段末尾的len(keyword)-1个字节，关键字被拆分在两段中时也能找到，不需要保存整个响应体
+    """
+
+    def __init__(self, keyword, max_bytes):
+        self.keyword = keyword.encode('utf-8')
+        self.max_bytes = max_bytes
+        self.tail = b''
+        self.size = 0 # 已经读取的响应体字节数
+        self.found = len(self.keyword) == 0
+        self.capped = False
+
+    def feed(self, chunk):
+        """
+        返回 : 是否应该停止读取，即已经找到关键字，或者已经读取了max_bytes个字节
+        """
+        self.size += len(chunk)
+        data = self.tail + chunk
+        if self.keyword in data:
+            self.found = True
+            return True
+        keep = len(self.keyword) - 1
+        self.tail = data[-keep:] if keep > 0 else b''
+        if self.size >= self.max_bytes:
+            self.capped = True
+            return True
+        return False
+
+
+async def _socks4_handshake(reader, writer, host, port):
+    # SOCKS4只支持IPv4地址，与requests(PySocks)一样在本地解析域名
+    if not _is_ip(host):
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_STREAM)
+        host = infos[0][4][0]
+    writer.write(struct.pack('>BBH', 4, 1, port) + socket.inet_aton(host) + b'\x00')
+    resp = await reader.readexactly(8)
+    if resp[1] != 0x5A:
+        raise ProxyError(f'SOCKS4连接失败: {resp[1]}')
+
+
+async def _socks5_handshake(reader, writer, host, port):
+    writer.write(b'\x05\x01\x00') # 不需要认证
+    resp = await reader.readexactly(2)
+    if resp[0] != 5 or resp[1] != 0:
+        raise ProxyError('SOCKS5认证失败')
+
+    if _is_ip(host):
+        addr = ipaddress.ip_address(host)
+        atyp = b'\x01' if addr.version == 4 else b'\x04'
+        target = atyp + addr.packed
+    else:
+        # 直接把域名交给代理解析
+        target = b'\x03' + bytes([len(host)]) + host.encode('idna')
+    writer.write(b'\x05\x01\x00' + target + struct.pack('>H', port))
+
+    resp = await reader.readexactly(4)
+    if resp[0] != 5 or resp[1] != 0:
+        raise ProxyError(f'SOCKS5连接失败: {resp[1]}')
+    if resp[3] == 1:
+        await reader.readexactly(4 + 2)
+    elif resp[3] == 4:
+        await reader.readexactly(16 + 2)
+    elif resp[3] == 3:
+        length = (await reader.readexactly(1))[0]
+        await reader.readexactly(length + 2)
+    else:
+        raise ProxyError('SOCKS5返回了无效的地址类型')
+
+
+async def _http_connect(reader, writer, host, port):
+    writer.write((
+        f'CONNECT {host}:{port} HTTP/1.1\r\n'
+        f'Host: {host}:{port}\r\n'
+        '\r\n'
+    ).encode('latin-1'))
+    status, _, _ = await _read_headers(reader)
+    if status != 200:
+        raise ProxyError(f'CONNECT失败: {status}')
+
+
+async def _start_tls(writer, server_hostname):
+    """
+    在已经建立的连接(代理隧道)上开始TLS，reader、writer之后继续使用
+    StreamWriter.start_tls需要Python 3.11，更早的版本与它的实现相同：使用loop.start_tls，再替换writer底层的transport
+    (不能另外创建一个writer，旧的writer被回收时会关闭原来的transport)
+    """
+    if hasattr(writer, 'start_tls'):
+        await writer.start_tls(_get_ssl_context(), server_hostname=server_hostname)
+        return
+    await writer.drain()
+    protocol = writer.transport.get_protocol()
+    writer._transport = await asyncio.get_running_loop().start_tls(
+        writer.transport, protocol, _get_ssl_context(), server_hostname=server_hostname
+    )
+    protocol._over_ssl = True # 对端关闭连接时关闭transport，与StreamReaderProtocol直接建立的TLS连接相同
+
+
+async def open_via_proxy(proxy):
+    """
+    通过代理建立到VALIDATE_URL的连接，协议与requests对代理URL的处理一致：
+    http代理直接转发http请求，https网址使用CONNECT隧道；https代理先与代理建立TLS连接；
+    socks4/socks5代理先握手，再连接到目标网址
+    返回 : (reader, writer, 是否直接向代理发送完整URL的请求)
+    """
+    proxy_ssl = _get_ssl_context() if proxy.protocol == 'https' else None
+    reader, writer = await asyncio.open_connection(
+        proxy.ip, proxy.port,
+        ssl=proxy_ssl,
+        server_hostname=proxy.ip if proxy_ssl is not None else None
+    )
+    try:
+        if proxy.protocol in ('http', 'https'):
+            if URL_SCHEME != 'https':
+                return reader, writer, True
+            await _http_connect(reader, writer, URL_HOST, URL_PORT)
+        elif proxy.protocol == 'socks4':
+            await _socks4_handshake(reader, writer, URL_HOST, URL_PORT)
+        elif proxy.protocol == 'socks5':
+            await _socks5_handshake(reader, writer, URL_HOST, URL_PORT)
+        else:
+            raise ProxyError(f'不支持的协议: {proxy.protocol}')
+
+        if URL_SCHEME == 'https':
+            await _start_tls(writer, URL_HOST)
+        return reader, writer, False
+    except BaseException:
+        writer.close()
+        raise
+
+
+def _build_request(absolute_form):
+    target = VALIDATE_URL if absolute_form else URL_PATH
+    lines = [f'{VALIDATE_METHOD} {target} HTTP/1.1'] + [f'{k}: {v}' for k, v in REQUEST_HEADERS]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def _validate_once(proxy):
+    # 不会跟随跳转，VALIDATE_URL应该是最终的网址
+    reader, writer, absolute_form = await open_via_proxy(proxy)
+    try:
+        writer.write(_build_request(absolute_form))
+        await writer.drain()
+        status, headers, header_size = await _read_headers(reader)
+        if VALIDATE_METHOD == 'GET':
+            # 找到关键字或者读取了VALIDATE_MAX_BODY_BYTES个字节之后不再读取剩下的部分，直接关闭连接
+            scanner = KeywordScanner(VALIDATE_KEYWORD, VALIDATE_MAX_BODY_BYTES)
+            try:
+                async for chunk in _iter_body(reader, headers):
+                    if scanner.feed(chunk):
+                        break
+            finally:
+                transfer_stats.record(header_size + scanner.size, scanner.found, scanner.capped)
+            return scanner.found
+        # HEAD请求的响应没有响应体
+        transfer_stats.record(header_size)
+        value = headers.get(VALIDATE_HEADER.lower())
+        return value is not None and VALIDATE_KEYWORD in value
+    finally:
+        writer.close()
+
+
+async def validate_once(proxy, timeout=None):
+    """
+    进行一次验证，与run_validator.validate_once相同，整个过程最多timeout秒，默认为VALIDATE_TIMEOUT * 2秒
+    返回 : bool，出错或者超时时抛出异常
+    """
+    if timeout is None:
+        timeout = VALIDATE_TIMEOUT * 2
+    return await asyncio.wait_for(_validate_once(proxy), timeout)
+
+
+async def validate_proxy(proxy):
+    """
+    验证一个代理，最多尝试VALIDATE_MAX_FAILS次，只要有一次成功就认为代理可用，所有尝试加起来最多VALIDATE_PROXY_BUDGET秒
+    返回 : (success, latency)，latency为成功的那一次验证的耗时，单位毫秒
+    """
+    budget_deadline = time.time() + VALIDATE_PROXY_BUDGET
+    for _ in range(VALIDATE_MAX_FAILS):
+        start_time = time.time()
+        if start_time >= budget_deadline:
+            break
+        try:
+            if await validate_once(proxy, min(VALIDATE_TIMEOUT * 2, budget_deadline - start_time)):
+                latency = int((time.time() - start_time) * 1000)
+                attempt_stats.record('success', latency)
+                return True, latency
+            attempt_stats.record('fail')
+        except Exception as e:
+            attempt_stats.record_error(e)
+    return False, None
+
+
+async def _race_attempt(proxy, timeout):
+    """
+    race_proxy中的一次尝试
+    返回 : 成功时返回本次尝试的耗时(毫秒)，失败时返回None
+    """
+    start_time = time.time()
+    try:
+        if await validate_once(proxy, timeout):
+            latency = int((time.time() - start_time) * 1000)
+            attempt_stats.record('success', latency)
+            return latency
+        attempt_stats.record('fail')
+    except Exception as e:
+        attempt_stats.record_error(e)
+    return None
+
+
+async def race_proxy(proxy):
+    """
+    与validate_proxy相同，但是同时进行多次尝试：每隔VALIDATE_RACE_STAGGER_MS毫秒(或者一次尝试失败之后立即)开始下一次尝试，
+    最多VALIDATE_MAX_FAILS次，任意一次成功之后取消其余的尝试
+    所有尝试共用同一个截止时间，验证一个代理最多min(VALIDATE_PROXY_BUDGET, VALIDATE_TIMEOUT * 2)秒
+    返回 : (success, latency)
+    """
+    deadline = time.time() + min(VALIDATE_PROXY_BUDGET, VALIDATE_TIMEOUT * 2)
+    pending = set()
+    launched = 0
+    try:
+        while True:
+            now = time.time()
+            if now >= deadline:
+                break
+            if launched < VALIDATE_MAX_FAILS:
+                pending.add(asyncio.ensure_future(_race_attempt(proxy, deadline - now)))
+                launched += 1
+            if len(pending) == 0:
+                break
+            timeout = deadline - now
+            if launched < VALIDATE_MAX_FAILS:
+                timeout = min(timeout, VALIDATE_RACE_STAGGER_MS / 1000)
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                latency = task.result()
+                if latency is not None:
+                    return True, latency
+    finally:
+        for task in pending:
+            task.cancel()
+    return False, None
+
+
+async def _precheck(proxy):
+    reader, writer = await asyncio.open_connection(proxy.ip, proxy.port)
+    try:
+        if proxy.protocol == 'socks5':
+            # 只协商认证方式，不连接目标网址
+            writer.write(b'\x05\x01\x00')
+            resp = await reader.readexactly(2)
+            if resp[0] != 5 or resp[1] != 0:
+                raise ProxyError('SOCKS5认证失败')
+        elif proxy.protocol == 'socks4':
+            # SOCKS4没有单独的协商过程，只能直接请求连接目标网址
+            await _socks4_handshake(reader, writer, URL_HOST, URL_PORT)
+    finally:
+        writer.close()
+
+
+async def precheck_proxy(proxy):
+    """
+    第一阶段验证：与代理建立TCP连接(SOCKS代理还会进行握手)，最多VALIDATE_CONNECT_TIMEOUT秒
+    大部分刚爬取到的代理都无法连接，在这一阶段就可以被淘汰，而不需要进行完整的验证
+    返回 : (是否通过, None)，与validate_proxy的返回值格式一致
+    """
+    try:
+        await asyncio.wait_for(_precheck(proxy), VALIDATE_CONNECT_TIMEOUT)
+        return True, None
+    except Exception as e:
+        # 无法连接一般是代理本身的问题，只有本地socket错误需要通知并发控制
+        if classify_error(e) == 'local_error':
+            attempt_stats.record('local_error')
+        return False, None
+
+
+def raise_nofile_limit(wanted):
+    """
+    尽量将可打开的文件数量上限提高到wanted，每个正在验证的代理都需要一个socket
+    返回 : 调整之后的上限，没有resource模块(Windows)时返回None
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        new_soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            soft = new_soft
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+class AsyncValidator(object):
+    """
+    在一个单独的线程中运行事件循环，同时验证最多concurrency个代理
+    on_result : 每个代理验证完成之后，在事件循环线程中以(proxy, success, latency)为参数调用
+    check : 验证一个代理的协程函数，返回(success, latency)，默认为完整的验证validate_proxy
+    stage : 可选，StageStats，用于统计并发的利用率
+    """
+
+    def __init__(self, concurrency, on_result, check=None, stage=None):
+        self.concurrency = max(int(concurrency), 1)
+        self.on_result = on_result
+        self.check = check if check is not None else validate_proxy
+        self.stage = stage
+        self.logger = logging.getLogger('validator')
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = None
+        self.tasks = set()
+        self.thread = threading.Thread(target=self._run, name='async-validator', daemon=True)
+        self.ready = threading.Event()
+
+    def start(self):
+        nofile = raise_nofile_limit(self.concurrency + 256)
+        if nofile is not None and nofile < self.concurrency + 256:
+            self.logger.warning(f'可打开的文件数量上限为{nofile}，可能不足以同时验证{self.concurrency}个代理')
+        self.thread.start()
+        self.ready.wait()
+
+    def submit(self, proxy):
+        """
+        提交一个待验证的代理，可以在任意线程中调用，本函数不会阻塞
+        """
+        self.loop.call_soon_threadsafe(self._spawn, proxy)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.loop.call_soon(self.ready.set)
+        self.loop.run_forever()
+
+    def _spawn(self, proxy):
+        task = self.loop.create_task(self._validate(proxy))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _validate(self, proxy):
+        async with self.semaphore:
+            if self.stage is not None:
+                self.stage.begin()
+            try:
+                success, latency = await self.check(proxy)
+            finally:
+                if self.stage is not None:
+                    self.stage.end()
+        self.on_result(proxy, success, latency)
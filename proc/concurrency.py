@@ -0,0 +1,170 @@
+# encoding: utf-8
+"""
+验证器的并发控制
+
+验证器中正在验证的代理数量不再是固定的，而是由AIMDController根据最近的验证情况调整：
+验证正常(超时比例、延迟没有明显升高，也没有本地socket错误)并且并发已经用满时，每次增加一个固定的步长；
+超时比例明显升高、延迟明显变长或者出现本地socket错误(文件描述符、端口耗尽等)时，乘以一个小于1的系数
+AIMDController限制的是验证器领取的代理数量，真正同时验证的数量不会超过验证流水线的容量，
+因此max_limit不应超过这个容量，否则多出来的代理只是在队列中等待，见run_validator.main
+"""
+
+import errno
+import threading
+import datetime
+from collections import deque
+
+# 说明本机资源不足，而不是代理本身有问题的错误
+LOCAL_ERRNOS = set(getattr(errno, name) for name in [
+    'EMFILE', 'ENFILE', 'ENOBUFS', 'ENOMEM', 'EADDRNOTAVAIL', 'EADDRINUSE'
+] if hasattr(errno, name))
+
+
+def classify_error(exc):
+    """
+    将一次验证尝试抛出的异常分类
+    requests和urllib3会把原始的异常包装好几层，这里沿着__cause__、__context__、reason以及args依次查找
+    返回 : 'local_error'(本地socket错误)、'timeout'(超时)或者'error'(其他错误，一般是代理本身的问题)
+    """
+    timeout = False
+    seen = set()
+    todo = [exc]
+    while len(todo) > 0 and len(seen) < 16:
+        e = todo.pop()
+        if e is None or id(e) in seen or not isinstance(e, BaseException):
+            continue
+        seen.add(id(e))
+        if isinstance(e, OSError) and e.errno in LOCAL_ERRNOS:
+            return 'local_error'
+        if isinstance(e, TimeoutError) or 'Timeout' in type(e).__name__:
+            timeout = True
+        todo += [e.__cause__, e.__context__, getattr(e, 'reason', None)] + list(e.args)
+    return 'timeout' if timeout else 'error'
+
+
+class AttemptStats(object):
+    """
+    统计一段时间内每次验证尝试的结果：success、fail(响应不符合要求)、timeout、local_error、error
+    可以在多个线程中同时调用record，take返回上次调用take之后的统计并清零
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.counts = dict(success=0, fail=0, timeout=0, local_error=0, error=0)
+        self.latency_sum = 0
+
+    def record(self, outcome, latency=None):
+        with self.lock:
+            self.counts[outcome] += 1
+            if latency is not None:
+                self.latency_sum += latency
+
+    def record_error(self, exc):
+        self.record(classify_error(exc))
+
+    def take(self):
+        """
+        返回 : (dict{结果: 次数}, 成功的尝试的平均延迟(毫秒)，没有成功的尝试时为None)
+        """
+        with self.lock:
+            counts = self.counts
+            avg_latency = self.latency_sum / counts['success'] if counts['success'] > 0 else None
+            self._reset()
+            return counts, avg_latency
+
+# 同一个进程中的验证器共用
+attempt_stats = AttemptStats()
+
+
+class AIMDController(object):
+    """
+    加性增、乘性减地调整同时验证的代理数量limit，limit始终在[min_limit, max_limit]之间
+    主循环每隔一段时间调用一次adjust，根据这段时间内attempt_stats的统计决定是否调整：
+    1. 出现本地socket错误：limit乘以decrease_factor
+    2. 超时比例比基准高出timeout_margin，或者平均延迟超过基准的latency_ratio倍：limit乘以decrease_factor
+    3. 否则，如果正在验证的代理数量达到了limit的90%：limit增加step
+    基准是之前没有减少limit时的超时比例和平均延迟的指数加权平均
+    尝试次数少于min_samples时不做调整
+    """
+
+    def __init__(self, min_limit, max_limit, step, initial=None, decrease_factor=0.7,
+                 timeout_margin=0.1, latency_ratio=2, min_samples=20, stats=attempt_stats):
+        self.min_limit = max(int(min_limit), 1)
+        self.max_limit = max(int(max_limit), self.min_limit)
+        self.step = max(int(step), 1)
+        self.limit = self._clamp(initial if initial is not None else self.max_limit)
+        self.decrease_factor = decrease_factor
+        self.timeout_margin = timeout_margin
+        self.latency_ratio = latency_ratio
+        self.min_samples = min_samples
+        self.attempt_stats = stats
+        self.baseline_timeout_rate = None
+        self.baseline_latency = None
+        self.increase_cnt = 0
+        self.decrease_cnt = 0
+        self.last_decision = None
+        self.decisions = deque(maxlen=20) # 最近的调整记录
+
+    def _clamp(self, limit):
+        return int(min(max(limit, self.min_limit), self.max_limit))
+
+    def adjust(self, inflight):
+        """
+        inflight : 当前正在验证的代理数量
+        返回 : 调整之后的limit
+        """
+        counts, avg_latency = self.attempt_stats.take()
+        total = sum(counts.values())
+        if total < self.min_samples:
+            return self._decide('hold', f'尝试次数太少({total})')
+
+        timeout_rate = counts['timeout'] / total
+        if counts['local_error'] > 0:
+            return self._decide('decrease', f'本地socket错误{counts["local_error"]}次')
+        if self.baseline_timeout_rate is not None and timeout_rate > self.baseline_timeout_rate + self.timeout_margin:
+            return self._decide('decrease', f'超时比例{timeout_rate:.2f}，基准{self.baseline_timeout_rate:.2f}')
+        if (self.baseline_latency is not None and avg_latency is not None
+                and avg_latency > self.baseline_latency * self.latency_ratio):
+            return self._decide('decrease', f'平均延迟{avg_latency:.0f}ms，基准{self.baseline_latency:.0f}ms')
+
+        # 验证正常，更新基准
+        self.baseline_timeout_rate = timeout_rate if self.baseline_timeout_rate is None else \
+            0.8 * self.baseline_timeout_rate + 0.2 * timeout_rate
+        if avg_latency is not None:
+            self.baseline_latency = avg_latency if self.baseline_latency is None else \
+                0.8 * self.baseline_latency + 0.2 * avg_latency
+        if inflight >= self.limit * 0.9:
+            return self._decide('increase', f'并发已用满({inflight}/{self.limit})')
+        return self._decide('hold', f'并发没有用满({inflight}/{self.limit})')
+
+    def _decide(self, action, reason):
+        old_limit = self.limit
+        if action == 'increase':
+            self.limit = self._clamp(self.limit + self.step)
+        elif action == 'decrease':
+            self.limit = self._clamp(self.limit * self.decrease_factor)
+        self.last_decision = dict(action=action, reason=reason)
+        if self.limit != old_limit:
+            if action == 'increase':
+                self.increase_cnt += 1
+            else:
+                self.decrease_cnt += 1
+            self.decisions.append(dict(
+                time=str(datetime.datetime.now().replace(microsecond=0)),
+                action=action, reason=reason, old_limit=old_limit, limit=self.limit
+            ))
+        return self.limit
+
+    def stats(self):
+        return dict(
+            limit=self.limit,
+            min_limit=self.min_limit,
+            max_limit=self.max_limit,
+            increases=self.increase_cnt,
+            decreases=self.decrease_cnt,
+            last_decision=self.last_decision,
+            recent_changes=list(self.decisions)
+        )
@@ -0,0 +1,172 @@
+# encoding: utf-8
+"""
+线程方式验证的截止时间
+
+requests的超时只限制每一次连接或者读取，代理每隔一段时间返回一个字节(例如缓慢地返回状态行和响应头)时，
+一次验证可以远远超过截止时间。这里由一个共用的线程负责所有验证尝试的截止时间：
+验证尝试通过deadline_session发出请求，建立的连接都会登记在当前的尝试中，
+到了截止时间还没有结束的尝试，它的socket会被shutdown，阻塞在连接、响应头或者响应体上的读取随之返回
+"""
+
+import heapq
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_local = threading.local() # 当前线程正在进行的验证尝试
+
+
+class Attempt(object):
+    """
+    一次验证尝试：截止时间以及尝试过程中建立的连接
+    """
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.connections = [] # list[(urllib3的连接, 建立连接时的socket)]
+        self.finished = False
+        self.expired = False
+
+    def add(self, connection, sock):
+        with self.lock:
+            self.connections.append((connection, sock))
+            expired = self.expired
+        if expired:
+            _shutdown(sock)
+
+    def expire(self):
+        """
+        到了截止时间：shutdown所有连接，正在阻塞的读取会立即返回
+        """
+        with self.lock:
+            if self.finished:
+                return
+            self.expired = True
+            connections = list(self.connections)
+        for connection, sock in connections:
+            # 建立TLS连接之后，连接上的socket换成了SSLSocket，原来的socket已经不再持有文件描述符
+            _shutdown(getattr(connection, 'sock', None) or sock)
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, AttributeError):
+        pass
+
+
+class DeadlineWatchdog(object):
+    """
+    所有验证尝试共用一个线程，按截止时间的先后顺序处理，第一次使用时才创建线程
+    已经结束的尝试留在堆中，到了堆顶时直接丢弃
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = 0
+        self.thread = None
+
+    def watch(self, attempt):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='validate-deadline', daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, (attempt.deadline, self.seq, attempt))
+            self.seq += 1
+            if self.heap[0][2] is attempt:
+                # 只有新的截止时间最早时才需要唤醒线程重新计算等待时间
+                self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if len(self.heap) == 0:
+                    self.cond.wait()
+                    continue
+                deadline, _, attempt = self.heap[0]
+                if not attempt.finished and deadline > time.time():
+                    self.cond.wait(deadline - time.time())
+                    continue
+                heapq.heappop(self.heap)
+            attempt.expire()
+
+watchdog = DeadlineWatchdog()
+
+
+@contextmanager
+def watch(deadline):
+    """
+    在with中进行一次验证尝试，deadline_session建立的连接到了截止时间会被shutdown
+    返回 : Attempt，expired为True表示尝试因为截止时间而中断
+    """
+    attempt = Attempt(deadline)
+    previous = getattr(_local, 'attempt', None)
+    _local.attempt = attempt
+    watchdog.watch(attempt)
+    try:
+        yield attempt
+    finally:
+        attempt.finish()
+        _local.attempt = previous
+
+
+_deadline_classes = {}
+_deadline_classes_lock = threading.Lock()
+
+def _deadline_class(cls):
+    """
+    返回cls的子类：连接池使用登记连接的连接类，连接类建立连接之后登记到当前线程的验证尝试中
+    """
+    with _deadline_classes_lock:
+        if cls not in _deadline_classes:
+            if hasattr(cls, 'ConnectionCls'):
+                attrs = dict(ConnectionCls=_deadline_connection_class(cls.ConnectionCls))
+            else:
+                attrs = {}
+            _deadline_classes[cls] = type('Deadline' + cls.__name__, (cls,), attrs)
+        return _deadline_classes[cls]
+
+def _deadline_connection_class(cls):
+    def _new_conn(self):
+        sock = cls._new_conn(self)
+        attempt = getattr(_local, 'attempt', None)
+        if attempt is not None:
+            attempt.add(self, sock)
+        return sock
+    return type('Deadline' + cls.__name__, (cls,), dict(_new_conn=_new_conn))
+
+
+class DeadlineAdapter(HTTPAdapter):
+    """
+    通过代理发出的请求使用登记连接的连接池，见_deadline_class
+    """
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if not getattr(manager, '_deadline', False):
+            manager.pool_classes_by_scheme = {
+                scheme: _deadline_class(cls) for scheme, cls in manager.pool_classes_by_scheme.items()
+            }
+            manager._deadline = True
+        return manager
+
+
+def deadline_session():
+    """
+    返回一个新的会话，在watch中通过代理发出的请求会受到截止时间的限制
+    """
+    session = requests.Session()
+    adapter = DeadlineAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,115 @@
+# encoding: utf-8
+"""
+验证结果批量写入
+"""
+
+import threading
+import logging
+import time
+from queue import Queue, Empty
+from db import conn
+
+class ResultSink(object):
+    """
+    收集验证线程返回的结果，并在一个单独的线程中批量写入数据库
+    攒够batch_size个结果，或者最早的结果已经等待了flush_ms毫秒，或者idle_ms毫秒内没有新的结果，就在同一个事务中提交这一批结果
+    验证结果源源不断时批量提交，偶尔才有结果时不必等满flush_ms毫秒
+    on_commit : 可选，每一批结果提交之后(无论成功与否)都会以这一批结果为参数调用
+    """
+
+    def __init__(self, batch_size, flush_ms, on_commit=None, idle_ms=None):
+        self.batch_size = max(int(batch_size), 1)
+        self.flush_interval = max(int(flush_ms), 1) / 1000.0
+        self.idle_interval = max(int(idle_ms), 1) / 1000.0 if idle_ms is not None else self.flush_interval
+        self.on_commit = on_commit
+        self.logger = logging.getLogger('validator')
+        self.que = Queue()
+        self.thread = threading.Thread(target=self._run, name='result-sink', daemon=True)
+
+        # 统计信息
+        self.stats_lock = threading.Lock()
+        self.batches_cnt = 0
+        self.results_cnt = 0
+        self.failed_batches_cnt = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.commit_ms_sum = 0.0
+        self.last_commit_ms = 0.0
+        self.max_commit_ms = 0.0
+        self.wait_ms_sum = 0.0 # 每个结果从放入到写入数据库的时间之和
+        self.max_wait_ms = 0.0
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, proxy, success, latency):
+        """
+        放入一个验证结果，本函数不会阻塞
+        """
+        self.que.put(((proxy, success, latency), time.time()))
+
+    def stats(self):
+        """
+        返回批量写入的统计信息
+        """
+        with self.stats_lock:
+            batches_cnt = max(self.batches_cnt, 1)
+            return dict(
+                batch_size_limit=self.batch_size,
+                flush_ms=int(self.flush_interval * 1000),
+                idle_ms=int(self.idle_interval * 1000),
+                batches=self.batches_cnt,
+                failed_batches=self.failed_batches_cnt,
+                results=self.results_cnt,
+                pending=self.que.qsize(),
+                last_batch_size=self.last_batch_size,
+                avg_batch_size=round(self.results_cnt / batches_cnt, 2),
+                max_batch_size=self.max_batch_size,
+                last_commit_ms=round(self.last_commit_ms, 2),
+                avg_commit_ms=round(self.commit_ms_sum / batches_cnt, 2),
+                max_commit_ms=round(self.max_commit_ms, 2),
+                avg_wait_ms=round(self.wait_ms_sum / max(self.results_cnt, 1), 2),
+                max_wait_ms=round(self.max_wait_ms, 2)
+            )
+
+    def _run(self):
+        while True:
+            items = [self.que.get()]
+            deadline = time.time() + self.flush_interval
+            while len(items) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self.que.get(timeout=min(remaining, self.idle_interval)))
+                except Empty:
+                    break
+            self._flush([result for result, _ in items], [put_time for _, put_time in items])
+
+    def _flush(self, batch, put_times=()):
+        start_time = time.time()
+        success = True
+        try:
+            conn.pushValidateResultBatch(batch)
+        except Exception as e:
+            success = False
+            self.logger.error(f'写入{len(batch)}个验证结果出错：' + str(e))
+        end_time = time.time()
+        cost_ms = (end_time - start_time) * 1000
+        wait_ms = [(end_time - put_time) * 1000 for put_time in put_times]
+
+        with self.stats_lock:
+            self.batches_cnt += 1
+            self.results_cnt += len(batch)
+            if not success:
+                self.failed_batches_cnt += 1
+            self.last_batch_size = len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.commit_ms_sum += cost_ms
+            self.last_commit_ms = cost_ms
+            self.max_commit_ms = max(self.max_commit_ms, cost_ms)
+            self.wait_ms_sum += sum(wait_ms)
+            self.max_wait_ms = max([self.max_wait_ms] + wait_ms)
+
+        if self.on_commit is not None:
+            self.on_commit(batch)
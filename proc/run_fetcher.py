@@ -10,7 +10,8 @@ import logging
 import time
 from db import conn
 from fetchers import fetchers
-from config import PROC_FETCHER_SLEEP
+from fetchers.FetcherSession import FetcherSession, set_shared_session
+from config import PROC_FETCHER_SLEEP, FETCHER_POOL_PER_HOST
 
 try:
     from func_timeout import func_set_timeout
@@ -27,20 +28,25 @@ except ImportError:
 
 logging.basicConfig(stream=sys.stdout, format="%(asctime)s-%(levelname)s:%(name)s:%(message)s", level='INFO')
 
-def main(proc_lock):
+def main(proc_lock, ingest_signal=None):
     """
     定时运行爬取器
+    ingest_signal : 可选，IngestSignal(见wakeup.py)，写入新的代理之后通过它唤醒验证进程
     主要逻辑：
     While True:
         for 爬取器 in 所有爬取器:
             查询数据库，判断当前爬取器是否需要运行
             如果需要运行，那么启动线程运行该爬取器
         等待所有线程结束
-        将爬取到的代理放入数据库中
+        将爬取到的代理放入数据库中，写入成功之后调用爬取器的commit
         睡眠一段时间
     """
     logger = logging.getLogger('fetcher')
     conn.set_proc_lock(proc_lock)
+    conn.set_ingest_signal(ingest_signal)
+    # 所有爬取器共用一个会话，连接在多轮爬取之间保持，每轮统计连接的复用情况
+    session = FetcherSession(pool_maxsize=FETCHER_POOL_PER_HOST)
+    set_shared_session(session)
 
     while True:
         logger.info('开始运行一轮爬取器')
@@ -54,7 +60,7 @@ def main(proc_lock):
         def fetch_worker(fetcher):
             f = fetcher()
             proxies = f.fetch()
-            return proxies
+            return f, proxies, f.fetch_stats()
 
         def run_thread(name, fetcher, que):
             """
@@ -63,19 +69,22 @@ def main(proc_lock):
             que: 队列，用于返回数据
             """
             try:
-                proxies = fetch_worker(fetcher)
-                que.put((name, proxies))
+                f, proxies, stats = fetch_worker(fetcher)
+                if stats is not None:
+                    page_stats[name] = stats
+                que.put((name, proxies, f))
             except FunctionTimedOut:
                 conn.pushFetcherError(name, 'fetch worker timeout')
-                que.put((name, []))
+                que.put((name, [], None))
             except Exception as e:
                 logger.error(f'运行爬取器{name}出错：' + str(e))
                 conn.pushFetcherError(name, str(e))
-                que.put((name, []))
+                que.put((name, [], None))
 
         threads = []
         enabled_fetchers = []
         que = Queue()
+        page_stats = {} # 使用分页爬取的爬取器的页面统计，见BaseFetcher.fetch_pages
         for item in fetchers:
             data = conn.getFetcher(item.name)
             if data is None:
@@ -105,12 +114,25 @@ def main(proc_lock):
 
         fetcher_results = {name: 0 for name in enabled_fetchers}
         while not que.empty():
-            fetcher_name, proxies = que.get()
+            fetcher_name, proxies, f = que.get()
             fetcher_results[fetcher_name] = len(proxies)
-            for proxy in proxies:
-                conn.pushNewFetch(fetcher_name, proxy[0], proxy[1], proxy[2])
+            # 一个爬取器的结果在同一个事务中写入，避免长时间占用数据库
+            conn.pushNewFetchBatch(fetcher_name, proxies)
+            if f is not None:
+                # 写入成功之后爬取器才能保存依赖于写入结果的状态，见BaseFetcher.commit
+                try:
+                    f.commit()
+                except Exception as e:
+                    logger.error(f'爬取器{fetcher_name}保存状态出错：' + str(e))
         for fetcher_name, proxies_cnt in fetcher_results.items():
             conn.pushFetcherResult(fetcher_name, proxies_cnt)
-        
+        http_stats = session.take_stats()
+        conn.pushRuntimeStats('fetcher', dict(pages=page_stats, http=http_stats))
+        if http_stats['requests'] > 0:
+            logger.info(
+                f"本轮发出{http_stats['requests']}个请求，新建{http_stats['new_connections']}个连接，"
+                f"连接复用率{http_stats['reuse_ratio']:.0%}，节省建立连接时间约{http_stats['handshake_saved_ms']:.0f}毫秒"
+            )
+
         logger.info(f'完成运行{len(threads)}个爬取器，睡眠{PROC_FETCHER_SLEEP}秒')
         time.sleep(PROC_FETCHER_SLEEP)
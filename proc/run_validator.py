@@ -3,130 +3,402 @@
 验证器逻辑
 """
 
+import os
 import sys
 import socket
 import threading
 from queue import Queue
+from concurrent import futures
 import logging
 import time
-import requests
+import datetime
 from db import conn
-from config import PROC_VALIDATOR_SLEEP, VALIDATE_THREAD_NUM
+from .result_sink import ResultSink
+from .async_validator import AsyncValidator, KeywordScanner, BODY_CHUNK_SIZE, precheck_proxy, race_proxy
+from .stage_stats import StageStats, ScheduleStats, DispatchStats, transfer_stats
+from .wakeup import Wakeup
+from .concurrency import AIMDController, attempt_stats
+from .deadline import watch, deadline_session
+from db.schedule import get_policy
+from config import PROC_VALIDATOR_SLEEP, VALIDATE_THREAD_NUM, STATS_REPORT_INTERVAL
+from config import VALIDATE_MODE, VALIDATE_ASYNC_CONCURRENCY, VALIDATE_PREFILTER, VALIDATE_PREFILTER_CONCURRENCY
+from config import VALIDATE_RESULT_BATCH_SIZE, VALIDATE_RESULT_FLUSH_MS, VALIDATE_RESULT_IDLE_MS
 from config import VALIDATE_METHOD, VALIDATE_KEYWORD, VALIDATE_HEADER, VALIDATE_URL, VALIDATE_TIMEOUT, VALIDATE_MAX_FAILS
+from config import VALIDATE_PROXY_BUDGET, VALIDATE_MAX_BODY_BYTES, VALIDATE_RACE, VALIDATE_RACE_STAGGER_MS
+from config import VALIDATE_AIMD, VALIDATE_CONCURRENCY_MIN, VALIDATE_CONCURRENCY_MAX, VALIDATE_AIMD_STEP, VALIDATE_AIMD_INTERVAL
 
-try:
-    from func_timeout import func_set_timeout
-    from func_timeout.exceptions import FunctionTimedOut
-except ImportError:
-    # 在缺少func-timeout依赖时退化为普通调用，避免启动失败
-    def func_set_timeout(_timeout_seconds):
-        def decorator(func):
-            return func
-        return decorator
+logging.basicConfig(stream=sys.stdout, format="%(asctime)s-%(levelname)s:%(name)s:%(message)s", level='INFO')
 
-    class FunctionTimedOut(TimeoutError):
-        pass
+def create_validator(on_result):
+    """
+    根据配置创建验证流水线：
+    第一阶段(VALIDATE_PREFILTER为True时)：在事件循环中与代理建立TCP连接，无法连接的代理直接记为失败
+    第二阶段：完整的验证，使用VALIDATE_THREAD_NUM个线程，或者VALIDATE_MODE为asyncio时使用事件循环，
+    VALIDATE_RACE为True时同时进行一个代理的多次尝试
+    on_result : 每个代理验证完成之后以(proxy, success, latency)为参数调用，可能在任意线程中调用
+    返回 : (submit, capacity, stages)
+        submit(proxy)提交一个待验证的代理，不会阻塞
+        capacity为流水线中同时验证的代理数量
+        stages为dict{阶段名称: StageStats}
+    """
+    capacity = VALIDATE_ASYNC_CONCURRENCY if VALIDATE_MODE == 'asyncio' else VALIDATE_THREAD_NUM
+    stages = dict(validate=StageStats(workers=capacity))
 
-logging.basicConfig(stream=sys.stdout, format="%(asctime)s-%(levelname)s:%(name)s:%(message)s", level='INFO')
+    def on_validated(proxy, success, latency):
+        stages['validate'].record(success)
+        on_result(proxy, success, latency)
+
+    if VALIDATE_MODE == 'asyncio':
+        validator = AsyncValidator(
+            capacity, on_validated, check=race_proxy if VALIDATE_RACE else None, stage=stages['validate']
+        )
+        validator.start()
+        submit = validator.submit
+    else:
+        in_que = Queue()
+        for _ in range(VALIDATE_THREAD_NUM):
+            threading.Thread(
+                target=validate_thread,
+                args=(in_que, on_validated, race_validate_proxy if VALIDATE_RACE else validate_proxy, stages['validate']),
+                daemon=True
+            ).start()
+        submit = in_que.put
+
+    if VALIDATE_PREFILTER:
+        stages = dict(connect=StageStats(workers=VALIDATE_PREFILTER_CONCURRENCY), **stages)
+        validate_submit = submit
+
+        def on_prechecked(proxy, success, _latency):
+            stages['connect'].record(success)
+            if success:
+                validate_submit(proxy)
+            else:
+                on_result(proxy, False, None)
 
-def main(proc_lock):
+        prefilter = AsyncValidator(
+            VALIDATE_PREFILTER_CONCURRENCY, on_prechecked, check=precheck_proxy, stage=stages['connect']
+        )
+        prefilter.start()
+        submit = prefilter.submit
+        capacity += VALIDATE_PREFILTER_CONCURRENCY
+
+    return submit, capacity, stages
+
+def create_controller(capacity):
+    """
+    根据配置创建并发控制(见concurrency.py)，VALIDATE_AIMD为False时返回None
+    超过流水线容量的代理只会在队列中等待，并不会增加真正同时验证的数量，
+    因此调整的范围不超过容量capacity，初始值为上限，只有负载过高时才会减少
+    """
+    if not VALIDATE_AIMD:
+        return None
+    max_limit = min(VALIDATE_CONCURRENCY_MAX, capacity) if VALIDATE_CONCURRENCY_MAX > 0 else capacity
+    return AIMDController(min(VALIDATE_CONCURRENCY_MIN, max_limit), max_limit, VALIDATE_AIMD_STEP, initial=max_limit)
+
+def main(proc_lock, shard_index=0, shard_count=1, ingest_signal=None):
     """
     验证器
+    shard_index, shard_count : 同时运行多个验证进程时(VALIDATE_PROCESS_NUM)，本进程只验证 shard_key % shard_count == shard_index 的代理
+    ingest_signal : 可选，IngestSignal(见wakeup.py)，爬取器写入新的代理之后会通过它唤醒本进程
     主要逻辑：
-    创建VALIDATE_THREAD_NUM个验证线程，这些线程会不断运行
+    创建验证流水线(见create_validator)，默认先检查能否连接代理，再进行完整的验证
+    验证流水线直接将结果交给结果写入线程(ResultSink)，批量地写入数据库
+    同时验证的代理数量默认由AIMDController根据最近的超时比例、延迟和本地socket错误自动调整，不超过验证流水线的容量
     While True:
-        检查验证线程是否返回了代理的验证结果
-        从数据库中获取若干当前待验证的代理
-        将代理发送给前面创建的线程
+        从数据库中领取若干当前待验证的代理(设置租约，其他验证器不会重复领取)，发送给验证流水线
+        等待以下事件之一(最多PROC_VALIDATOR_SLEEP秒)：
+            验证结果写入数据库(有了空闲的并发)、爬取器写入了新的代理、
+            还有空闲的并发时下一个代理到了验证时间、需要调整并发数量或者输出统计
     """
-    logger = logging.getLogger('validator')
+    # 只有一个验证进程时沿用原来的名称
+    name = 'validator' if shard_count <= 1 else f'validator-{shard_index}'
+    shard = (shard_index, shard_count) if shard_count > 1 else None
+    logger = logging.getLogger(name)
     conn.set_proc_lock(proc_lock)
 
-    in_que = Queue()
-    out_que = Queue()
-    running_proxies = set() # 储存哪些代理正在运行，以字符串的形式储存
+    wakeup = Wakeup()
+    if ingest_signal is not None:
+        ingest_signal.watch(shard_index, lambda: wakeup.notify('ingest'))
+    # 租约持有者，数据库中被本进程取出、正在验证的代理都会标记为这个名称
+    lease_owner = f'{socket.gethostname()}:{os.getpid()}'
+    running_cnt = 0 # 正在进行验证(包括等待写入数据库)的代理数量
+    running_lock = threading.Lock()
+    schedule_stats = ScheduleStats(get_policy().name)
+    dispatch_stats = DispatchStats()
+
+    def on_commit(results):
+        # 验证结果写入数据库之后租约随之释放，这时候才算验证完成
+        nonlocal running_cnt
+        with running_lock:
+            running_cnt -= len(results)
+        schedule_stats.record(len(results))
+        wakeup.notify('commit')
+
+    sink = ResultSink(VALIDATE_RESULT_BATCH_SIZE, VALIDATE_RESULT_FLUSH_MS, on_commit=on_commit, idle_ms=VALIDATE_RESULT_IDLE_MS)
+    sink.start()
 
-    threads = []
-    for _ in range(VALIDATE_THREAD_NUM):
-        threads.append(threading.Thread(target=validate_thread, args=(in_que, out_que)))
-    [_.start() for _ in threads]
+    submit, capacity, stages = create_validator(sink.put)
+    logger.info(f'验证方式：{VALIDATE_MODE}，验证阶段：{list(stages.keys())}，并发数量：{capacity}')
 
+    # 同时领取(包括正在验证以及等待写入数据库)的代理数量上限，关闭自动调整时多领取一些代理在队列中等待，验证线程不会空闲
+    max_inflight = capacity * 2
+    controller = create_controller(capacity)
+    if controller is not None:
+        logger.info(f'自动调整并发数量，范围：[{controller.min_limit}, {controller.max_limit}]，初始值：{controller.limit}')
+    next_adjust_time = time.time() + VALIDATE_AIMD_INTERVAL if controller is not None else float('inf')
+
+    next_report_time = time.time() + STATS_REPORT_INTERVAL
     while True:
-        out_cnt = 0
-        while not out_que.empty():
-            proxy, success, latency = out_que.get()
-            conn.pushValidateResult(proxy, success, latency)
-            uri = f'{proxy.protocol}://{proxy.ip}:{proxy.port}'
-            running_proxies.remove(uri)
-            out_cnt = out_cnt + 1
-        if out_cnt > 0:
-            logger.info(f'完成了{out_cnt}个代理的验证')
-
-        # 如果正在进行验证的代理足够多，那么就不着急添加新代理        
-        if len(running_proxies) >= VALIDATE_THREAD_NUM * 2:
-            time.sleep(PROC_VALIDATOR_SLEEP)
-            continue
-
-        # 找一些新的待验证的代理放入队列中
-        added_cnt = 0
-        for proxy in conn.getToValidate(VALIDATE_THREAD_NUM * 4):
-            uri = f'{proxy.protocol}://{proxy.ip}:{proxy.port}'
-            # 这里找出的代理有可能是正在进行验证的代理，要避免重复加入
-            if uri not in running_proxies:
-                running_proxies.add(uri)
-                in_que.put(proxy)
-                added_cnt += 1
-        
-        if added_cnt == 0:
-            time.sleep(PROC_VALIDATOR_SLEEP)
-
-@func_set_timeout(VALIDATE_TIMEOUT * 2)
-def validate_once(proxy):
+        if time.time() >= next_report_time:
+            next_report_time = time.time() + STATS_REPORT_INTERVAL
+            stats = dict(
+                stages={name: stage.stats() for name, stage in stages.items()},
+                transfer=transfer_stats.stats(),
+                schedule=schedule_stats.stats(conn.countProxies(validated=True)),
+                concurrency=controller.stats() if controller is not None else dict(limit=capacity),
+                result_sink=sink.stats(),
+                dispatch=dict(wakeups=wakeup.stats(), **dispatch_stats.stats())
+            )
+            logger.info(f'各阶段统计：{stats["stages"]}')
+            logger.info(f'验证流量统计：{stats["transfer"]}')
+            logger.info(f'验证开销统计：{stats["schedule"]}')
+            logger.info(f'验证结果写入统计：{stats["result_sink"]}')
+            logger.info(f'领取代理统计：{stats["dispatch"]}')
+            conn.pushRuntimeStats(name, stats)
+
+        if time.time() >= next_adjust_time:
+            next_adjust_time = time.time() + VALIDATE_AIMD_INTERVAL
+            old_limit = controller.limit
+            limit = controller.adjust(running_cnt)
+            if limit != old_limit:
+                logger.info(f'并发数量调整为{limit}：{controller.last_decision["reason"]}')
+
+        # 如果正在进行验证的代理足够多，那么就不着急添加新代理，等待验证结果写入数据库
+        with running_lock:
+            free_cnt = (controller.limit if controller is not None else max_inflight) - running_cnt
+        proxies = []
+        if free_cnt > 0:
+            # 领取一些新的待验证的代理放入队列中，数据库保证不会返回正在验证的代理
+            now = datetime.datetime.now()
+            proxies = conn.getToValidate(free_cnt, lease_owner=lease_owner, shard=shard)
+            with running_lock:
+                running_cnt += len(proxies)
+            for proxy in proxies:
+                submit(proxy)
+            dispatch_stats.record(proxies, now)
+
+        timeout = min(next_report_time, next_adjust_time, time.time() + PROC_VALIDATOR_SLEEP) - time.time()
+        if free_cnt > len(proxies):
+            # 还有空闲的并发，说明现在没有到期的代理，等到下一个代理到期
+            next_date = conn.getNextToValidateDate(shard)
+            if next_date is not None:
+                timeout = min(timeout, (next_date - datetime.datetime.now()).total_seconds())
+        elif free_cnt > 0:
+            continue # 领取的数量达到了上限，可能还有更多到期的代理
+        wakeup.wait(max(timeout, 0.01))
+
+class ValidateTimeout(Exception):
+    """
+    超过了验证的截止时间
+    """
+    pass
+
+def _timeout_before(deadline):
+    """
+    返回下一次连接或读取的超时时间：不超过VALIDATE_TIMEOUT，也不超过距离deadline的剩余时间
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise ValidateTimeout()
+    return min(VALIDATE_TIMEOUT, remaining)
+
+def _set_read_timeout(r, timeout):
+    """
+    修改响应所在socket的超时时间，之后读取响应体时每次等待最多timeout秒
+    """
+    connection = getattr(r.raw, 'connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        sock.settimeout(timeout)
+
+def _iter_body(r, deadline):
+    """
+    逐段读取响应体，每段读取之后都检查截止时间
+    read1只要读到数据就会返回，即使代理每次只返回很少的数据，也能及时检查截止时间
+    """
+    read = getattr(r.raw, 'read1', None) or r.raw.read # urllib3 1.x没有read1
+    while True:
+        _set_read_timeout(r, _timeout_before(deadline))
+        chunk = read(BODY_CHUNK_SIZE, decode_content=True)
+        if not chunk:
+            break
+        yield chunk
+
+def _header_size(r):
+    """
+    估算响应的状态行和响应头的字节数，requests不会保留原始的响应头
+    """
+    return len('HTTP/1.1 200 OK\r\n\r\n') + sum(len(k) + len(v) + 4 for k, v in r.raw.headers.items())
+
+def validate_once(proxy, deadline=None, cancel=None):
     """
     进行一次验证，如果验证成功则返回True，否则返回False或者是异常
+    deadline : 本次验证的截止时间(time.time())，默认为VALIDATE_TIMEOUT * 2秒之后
+    连接和每次读取的超时时间都不会超过截止时间，读取响应体时每读取一段都会检查截止时间；
+    代理缓慢地返回状态行或者响应头时，到了截止时间连接会被共用的线程shutdown(见deadline.py)，抛出ValidateTimeout
+    GET验证方式找到关键字之后就不再读取剩下的响应体，HEAD验证方式发送HEAD请求，只读取响应头
+    cancel : threading.Event，被设置之后不再读取剩下的响应体，本次验证失败
     """
+    if deadline is None:
+        deadline = time.time() + VALIDATE_TIMEOUT * 2
     proxies = {
         'http': f'{proxy.protocol}://{proxy.ip}:{proxy.port}',
         'https': f'{proxy.protocol}://{proxy.ip}:{proxy.port}'
     }
+    timeout = _timeout_before(deadline)
+    with watch(deadline) as attempt, deadline_session() as session:
+        try:
+            result = _request_once(session, proxies, timeout, deadline, cancel)
+        except Exception as e:
+            if attempt.expired:
+                raise ValidateTimeout() from e
+            raise
+        if attempt.expired:
+            # 连接被shutdown时，http.client可能把读到一半的响应头当作完整的响应返回
+            raise ValidateTimeout()
+        return result
+
+def _request_once(session, proxies, timeout, deadline, cancel):
+    """
+    validate_once中发出请求并检查响应
+    """
     if VALIDATE_METHOD == "GET":
-        r = requests.get(VALIDATE_URL, timeout=VALIDATE_TIMEOUT, proxies=proxies)
-        r.encoding = "utf-8"
-        html = r.text
-        if VALIDATE_KEYWORD in html:
-            return True
-        return False
+        with session.get(VALIDATE_URL, timeout=(timeout, timeout), proxies=proxies, stream=True) as r:
+            # 提前停止读取时，with结束时会关闭连接，而不是把没有读完的连接放回连接池
+            scanner = KeywordScanner(VALIDATE_KEYWORD, VALIDATE_MAX_BODY_BYTES)
+            try:
+                for chunk in _iter_body(r, deadline):
+                    if scanner.feed(chunk) or (cancel is not None and cancel.is_set()):
+                        break
+            finally:
+                transfer_stats.record(_header_size(r) + r.raw.tell(), scanner.found, scanner.capped)
+        return scanner.found
     else:
-        r = requests.get(VALIDATE_URL, timeout=VALIDATE_TIMEOUT, proxies=proxies, allow_redirects=False)
+        r = session.head(VALIDATE_URL, timeout=(timeout, timeout), proxies=proxies, allow_redirects=False)
+        transfer_stats.record(_header_size(r))
         resp_headers = r.headers
         if VALIDATE_HEADER in resp_headers.keys() and VALIDATE_KEYWORD in resp_headers[VALIDATE_HEADER]:
             return True
         return False
 
-def validate_thread(in_que, out_que):
+def validate_proxy(proxy):
+    """
+    验证一个代理，依次尝试最多VALIDATE_MAX_FAILS次，只要有一次成功就认为代理可用，所有尝试加起来最多VALIDATE_PROXY_BUDGET秒
+    返回 : (success, latency)，latency为成功的那一次验证的耗时，单位毫秒
+    """
+    budget_deadline = time.time() + VALIDATE_PROXY_BUDGET
+    for _ in range(VALIDATE_MAX_FAILS):
+        start_time = time.time()
+        if start_time >= budget_deadline:
+            break
+        try:
+            if validate_once(proxy, min(start_time + VALIDATE_TIMEOUT * 2, budget_deadline)):
+                end_time = time.time()
+                latency = int((end_time-start_time)*1000)
+                attempt_stats.record('success', latency)
+                return True, latency
+            attempt_stats.record('fail')
+        except Exception as e:
+            attempt_stats.record_error(e)
+    return False, None
+
+_race_executor = None
+_race_executor_lock = threading.Lock()
+
+def _get_race_executor():
+    """
+    race_validate_proxy中的尝试在这个线程池中进行，线程按需创建并且会被重复使用，
+    最多VALIDATE_THREAD_NUM * VALIDATE_MAX_FAILS个线程
+    """
+    global _race_executor
+    with _race_executor_lock:
+        if _race_executor is None:
+            _race_executor = futures.ThreadPoolExecutor(VALIDATE_THREAD_NUM * VALIDATE_MAX_FAILS, 'validate-attempt')
+        return _race_executor
+
+def _race_attempt(proxy, deadline, cancel):
+    """
+    race_validate_proxy中的一次尝试
+    返回 : 成功时返回本次尝试的耗时(毫秒)，失败时返回None
+    """
+    if cancel.is_set():
+        return None
+    start_time = time.time()
+    try:
+        if validate_once(proxy, deadline, cancel):
+            latency = int((time.time() - start_time) * 1000)
+            attempt_stats.record('success', latency)
+            return latency
+        if not cancel.is_set():
+            attempt_stats.record('fail')
+    except Exception as e:
+        if not cancel.is_set():
+            attempt_stats.record_error(e)
+    return None
+
+def race_validate_proxy(proxy):
+    """
+    与validate_proxy相同，但是同时进行多次尝试：每隔VALIDATE_RACE_STAGGER_MS毫秒(或者一次尝试失败之后立即)开始下一次尝试，
+    最多VALIDATE_MAX_FAILS次，任意一次成功之后立即返回，并取消其余的尝试：
+    还没有开始的尝试不再进行，正在读取响应体的尝试会在读到下一段数据时停止，其他尝试最晚在截止时间结束
+    所有尝试共用同一个截止时间，验证一个代理最多min(VALIDATE_PROXY_BUDGET, VALIDATE_TIMEOUT * 2)秒
+    返回 : (success, latency)
+    """
+    executor = _get_race_executor()
+    deadline = time.time() + min(VALIDATE_PROXY_BUDGET, VALIDATE_TIMEOUT * 2)
+    cancel = threading.Event()
+    pending = set()
+    launched = 0
+    try:
+        while True:
+            now = time.time()
+            if now >= deadline:
+                break
+            if launched < VALIDATE_MAX_FAILS:
+                pending.add(executor.submit(_race_attempt, proxy, deadline, cancel))
+                launched += 1
+            if len(pending) == 0:
+                break
+            timeout = deadline - now
+            if launched < VALIDATE_MAX_FAILS:
+                timeout = min(timeout, VALIDATE_RACE_STAGGER_MS / 1000)
+            done, pending = futures.wait(pending, timeout=timeout, return_when=futures.FIRST_COMPLETED)
+            for f in done:
+                latency = f.result()
+                if latency is not None:
+                    return True, latency
+    finally:
+        cancel.set()
+        for f in pending:
+            f.cancel()
+    return False, None
+
+def validate_thread(in_que, on_result, validate=validate_proxy, stage=None):
     """
     验证函数，这个函数会在一个线程中被调用
-    in_que: 输入队列，用于接收验证任务
-    out_que: 输出队列，用于返回验证结果
-    in_que和out_que都是线程安全队列，并且如果队列为空，调用in_que.get()会阻塞线程
+    in_que: 输入队列，用于接收验证任务，线程安全，如果队列为空，调用in_que.get()会阻塞线程
+    on_result: 以(proxy, success, latency)为参数调用，用于返回验证结果
+    validate: 验证一个代理的函数，返回(success, latency)，默认为依次尝试的validate_proxy
+    stage: 可选，StageStats，用于统计验证线程的利用率
     """
 
     while True:
         proxy = in_que.get()
-
-        success = False
-        latency = None
-        for _ in range(VALIDATE_MAX_FAILS):
-            try:
-                start_time = time.time()
-                if validate_once(proxy):
-                    end_time = time.time()
-                    latency = int((end_time-start_time)*1000)
-                    success = True
-                    break
-            except Exception as e:
-                pass
-            except FunctionTimedOut:
-                pass
-
-        out_que.put((proxy, success, latency))
+        if stage is not None:
+            stage.begin()
+        try:
+            success, latency = validate(proxy)
+        finally:
+            if stage is not None:
+                stage.end()
+        on_result(proxy, success, latency)
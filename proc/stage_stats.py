@@ -0,0 +1,183 @@
+# encoding: utf-8
+"""
+验证流水线各个阶段的统计
+"""
+
+import threading
+import time
+
+class StageStats(object):
+    """
+    统计一个验证阶段处理的代理数量，以及其中通过(交给下一阶段或者验证成功)和淘汰的数量
+    workers不为None时，还统计这个阶段的worker(验证线程或者事件循环中的并发数量)利用率：
+    每个代理开始验证时调用begin，验证完成时调用end，利用率为 正在验证的代理数量在时间上的平均值 / workers
+    可以在多个线程中同时调用record、begin、end
+    """
+
+    def __init__(self, workers=None):
+        self.lock = threading.Lock()
+        self.checked_cnt = 0
+        self.passed_cnt = 0
+        self.last_time = time.time()
+        self.last_checked_cnt = 0
+        self.workers = workers
+        self.busy_cnt = 0 # 正在验证的代理数量
+        self.busy_seconds = 0 # busy_cnt对时间的积分
+        self.busy_changed_time = self.last_time
+
+    def record(self, passed):
+        with self.lock:
+            self.checked_cnt += 1
+            if passed:
+                self.passed_cnt += 1
+
+    def _update_busy(self, now, delta):
+        self.busy_seconds += self.busy_cnt * (now - self.busy_changed_time)
+        self.busy_changed_time = now
+        self.busy_cnt += delta
+
+    def begin(self):
+        with self.lock:
+            self._update_busy(time.time(), 1)
+
+    def end(self):
+        with self.lock:
+            self._update_busy(time.time(), -1)
+
+    def stats(self):
+        """
+        返回累计的统计信息，per_second为距离上次调用本函数期间每秒处理的代理数量
+        """
+        with self.lock:
+            now = time.time()
+            elapsed = max(now - self.last_time, 1e-6)
+            per_second = (self.checked_cnt - self.last_checked_cnt) / elapsed
+            self.last_time = now
+            self.last_checked_cnt = self.checked_cnt
+            dropped_cnt = self.checked_cnt - self.passed_cnt
+            stats = dict(
+                checked=self.checked_cnt,
+                passed=self.passed_cnt,
+                dropped=dropped_cnt,
+                drop_rate=round(dropped_cnt / self.checked_cnt, 4) if self.checked_cnt > 0 else 0,
+                per_second=round(per_second, 2)
+            )
+            if self.workers is not None:
+                # 利用率也是距离上次调用本函数期间的平均值
+                self._update_busy(now, 0)
+                stats.update(
+                    workers=self.workers,
+                    busy=self.busy_cnt,
+                    utilization=round(self.busy_seconds / (self.workers * elapsed), 4)
+                )
+                self.busy_seconds = 0
+            return stats
+
+class TransferStats(object):
+    """
+    统计完整验证(访问VALIDATE_URL)从代理读取的字节数(响应头加响应体)
+    以及GET验证方式中因为找到关键字、或者达到VALIDATE_MAX_BODY_BYTES而提前停止读取的次数
+    可以在多个线程中同时调用record
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.validation_cnt = 0
+        self.bytes_cnt = 0
+        self.keyword_stop_cnt = 0
+        self.cap_stop_cnt = 0
+
+    def record(self, bytes_cnt, keyword_stop=False, cap_stop=False):
+        with self.lock:
+            self.validation_cnt += 1
+            self.bytes_cnt += bytes_cnt
+            if keyword_stop:
+                self.keyword_stop_cnt += 1
+            if cap_stop:
+                self.cap_stop_cnt += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                validations=self.validation_cnt,
+                bytes=self.bytes_cnt,
+                bytes_per_validation=round(self.bytes_cnt / self.validation_cnt, 1) if self.validation_cnt > 0 else 0,
+                stopped_at_keyword=self.keyword_stop_cnt,
+                stopped_at_cap=self.cap_stop_cnt
+            )
+
+# 同一个进程中的验证器共用
+transfer_stats = TransferStats()
+
+class ScheduleStats(object):
+    """
+    统计验证的开销：完成的验证次数 / 可用代理时长(可用代理数量 * 小时)，即平均每个可用代理每小时被验证了多少次，
+    用于比较不同的下次验证时间策略(VALIDATE_SCHEDULE_POLICY)
+    可用代理时长在每次调用stats时按照当前的可用代理数量累加
+    """
+
+    def __init__(self, policy_name):
+        self.lock = threading.Lock()
+        self.policy_name = policy_name
+        self.validation_cnt = 0
+        self.validated_hours = 0
+        self.last_time = time.time()
+
+    def record(self, validation_cnt):
+        with self.lock:
+            self.validation_cnt += validation_cnt
+
+    def stats(self, validated_cnt):
+        """
+        validated_cnt : 当前数据库中可用代理的数量
+        """
+        with self.lock:
+            now = time.time()
+            self.validated_hours += validated_cnt * (now - self.last_time) / 3600
+            self.last_time = now
+            return dict(
+                policy=self.policy_name,
+                validations=self.validation_cnt,
+                validated_proxy_hours=round(self.validated_hours, 2),
+                validations_per_validated_proxy_hour=(
+                    round(self.validation_cnt / self.validated_hours, 3) if self.validated_hours > 0 else None
+                )
+            )
+
+class DispatchStats(object):
+    """
+    统计验证器主循环领取代理的情况：领取的代理数量，以及代理从到期(to_validate_date)到被领取的延迟
+    延迟为距离上次调用stats期间的平均值和最大值，可以用来判断到期的代理是否需要等待很久才开始验证
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dispatched_cnt = 0
+        self.period_cnt = 0
+        self.period_lag_sum = 0
+        self.period_lag_max = 0
+
+    def record(self, proxies, now):
+        """
+        proxies : 本次领取的代理
+        now : 领取的时间，datetime
+        """
+        with self.lock:
+            for p in proxies:
+                lag = max((now - p.to_validate_date).total_seconds(), 0)
+                self.period_lag_sum += lag
+                self.period_lag_max = max(self.period_lag_max, lag)
+            self.dispatched_cnt += len(proxies)
+            self.period_cnt += len(proxies)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(
+                dispatched=self.dispatched_cnt,
+                avg_lag_ms=round(self.period_lag_sum * 1000 / self.period_cnt, 1) if self.period_cnt > 0 else None,
+                max_lag_ms=round(self.period_lag_max * 1000, 1)
+            )
+            self.period_cnt = 0
+            self.period_lag_sum = 0
+            self.period_lag_max = 0
+            return stats
@@ -0,0 +1,85 @@
+# encoding: utf-8
+"""
+验证器主循环的唤醒
+
+验证器不再固定睡眠PROC_VALIDATOR_SLEEP秒，而是等待以下事件之一：
+验证结果写入数据库(有了空闲的并发)、爬取器写入了新的代理、下一个代理到了验证时间、需要调整并发或者输出统计
+"""
+
+import threading
+import multiprocessing
+
+
+class Wakeup(object):
+    """
+    同一进程内的唤醒，notify可以在任意线程中调用，wait返回这段时间内的全部唤醒原因
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.reasons = set()
+        self.counts = dict()
+
+    def notify(self, reason):
+        with self.cond:
+            self.reasons.add(reason)
+            self.cond.notify()
+
+    def wait(self, timeout):
+        """
+        等待被唤醒，最多timeout秒
+        返回 : set(唤醒原因)，超时返回{'timer'}
+        """
+        with self.cond:
+            if len(self.reasons) == 0 and timeout > 0:
+                self.cond.wait(timeout)
+            reasons = self.reasons if len(self.reasons) > 0 else {'timer'}
+            self.reasons = set()
+            for reason in reasons:
+                self.counts[reason] = self.counts.get(reason, 0) + 1
+            return reasons
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counts)
+
+
+class IngestSignal(object):
+    """
+    跨进程通知验证进程：爬取器写入了新的代理
+    每个验证进程使用自己的信号量(最大值为1，多次通知只唤醒一次)，通知时不会阻塞，
+    即使某个验证进程已经退出(main.py会定期重启子进程)，也不会影响爬取器和其他验证进程
+    没有使用multiprocessing.Condition，因为等待的进程被终止之后，notify_all会一直等待它被唤醒
+    """
+
+    def __init__(self, listeners=1):
+        self.semaphores = []
+        for _ in range(max(int(listeners), 1)):
+            sem = multiprocessing.BoundedSemaphore(1)
+            sem.acquire()
+            self.semaphores.append(sem)
+
+    def notify(self):
+        for sem in self.semaphores:
+            try:
+                sem.release()
+            except ValueError:
+                pass # 上一次通知还没有被处理
+
+    def wait(self, index, timeout=None):
+        """
+        等待第index个验证进程的通知，返回是否收到了通知
+        """
+        return self.semaphores[index % len(self.semaphores)].acquire(timeout=timeout)
+
+    def watch(self, index, callback):
+        """
+        启动一个线程，每次收到第index个验证进程的通知时调用callback
+        """
+        def run():
+            while True:
+                if self.wait(index):
+                    callback()
+        thread = threading.Thread(target=run, name='ingest-watch', daemon=True)
+        thread.start()
+        return thread
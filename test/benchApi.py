@@ -0,0 +1,93 @@
+# encoding: utf-8
+
+"""
+API吞吐量测试：分别以单线程和多线程模式启动API服务器，
+在后台不断请求/admin/proxies/export.csv的同时，用1、8、32个并发客户端请求/fetch_random
+使用临时数据库，不会影响`data.db`
+用法：python test/benchApi.py [每组测试的秒数]
+"""
+
+import sys, os
+import tempfile
+import subprocess
+import threading
+import http.client
+import time
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+
+PORT = 15731
+
+def serve(threaded):
+    from werkzeug.serving import make_server
+    from api.api import app
+    make_server('127.0.0.1', PORT, app, threaded=threaded).serve_forever()
+
+def request(path):
+    c = http.client.HTTPConnection('127.0.0.1', PORT, timeout=60)
+    c.request('GET', path)
+    body = c.getresponse().read()
+    c.close()
+    return body
+
+def wait_ready():
+    for _ in range(100):
+        try:
+            request('/ping')
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('API服务器启动失败')
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(int(len(values) * p / 100), len(values) - 1)
+    return values[index]
+
+def bench_clients(clients, seconds):
+    stop = threading.Event()
+    latencies = []
+    lock = threading.Lock()
+
+    def export_loop():
+        while not stop.is_set():
+            request('/admin/proxies/export.csv')
+
+    def client_loop():
+        while not stop.is_set():
+            start_time = time.perf_counter()
+            request('/fetch_random')
+            cost = (time.perf_counter() - start_time) * 1000
+            with lock:
+                latencies.append(cost)
+
+    threads = [threading.Thread(target=export_loop)]
+    threads += [threading.Thread(target=client_loop) for _ in range(clients)]
+    [t.start() for t in threads]
+    time.sleep(seconds)
+    stop.set()
+    [t.join() for t in threads]
+    return len(latencies) / seconds, percentile(latencies, 99)
+
+def run(seconds=5):
+    from db import conn
+    proxies = [('http', f'10.0.{i >> 8}.{i & 255}', 8080) for i in range(20000)]
+    conn.pushNewFetchBatch('bench', proxies)
+    conn.pushValidateResultBatch([(p, True, 100) for p in conn.getToValidate(len(proxies))])
+
+    for threaded in [False, True]:
+        server = subprocess.Popen([sys.executable, __file__, '--serve', '1' if threaded else '0'], env=os.environ)
+        try:
+            wait_ready()
+            for clients in [1, 8, 32]:
+                qps, p99 = bench_clients(clients, seconds)
+                print(f'threaded={str(threaded):<5} clients={clients:>2} /fetch_random {qps:>8.1f} req/s p99={p99:>8.1f}ms')
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--serve':
+        serve(sys.argv[2] == '1')
+    else:
+        os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        run(int(sys.argv[1]) if len(sys.argv) >= 2 else 5)
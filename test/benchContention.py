@@ -0,0 +1,71 @@
+# encoding: utf-8
+
+"""
+读写并发测试：一个进程不断模拟爬取器写入代理，同时在当前进程中模拟API读取代理，统计读操作的延迟
+分别在journal_mode=DELETE(旧的回滚日志模式)和journal_mode=WAL下运行，使用临时数据库，不会影响`data.db`
+用法：python test/benchContention.py [写入轮数] [每轮代理数量]
+"""
+
+import sys, os
+import tempfile
+import subprocess
+import multiprocessing
+import time
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+
+def make_proxies(n, offset=0):
+    proxies = []
+    for i in range(offset, offset + n):
+        proxies.append(('http', f'10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}', 8080))
+    return proxies
+
+def writer(proc_lock, rounds, n):
+    from db import conn
+    conn.set_proc_lock(proc_lock)
+    for i in range(rounds):
+        conn.pushNewFetchBatch('bench', make_proxies(n, offset=i * n))
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(int(len(values) * p / 100), len(values) - 1)
+    return values[index]
+
+def run_mode(rounds, n):
+    from db import conn
+    proc_lock = multiprocessing.Lock()
+    conn.set_proc_lock(proc_lock)
+
+    # 准备一些已经通过验证的代理
+    conn.pushNewFetchBatch('bench', make_proxies(1000, offset=10 ** 6))
+    proxies = conn.getToValidate(1000)
+    conn.pushValidateResultBatch([(p, True, 100) for p in proxies])
+
+    p = multiprocessing.Process(target=writer, args=(proc_lock, rounds, n))
+    p.start()
+    latencies = []
+    while p.is_alive():
+        start_time = time.perf_counter()
+        conn.getValidatedRandom(1)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+    p.join()
+
+    print(
+        f'journal_mode={conn.DATABASE_JOURNAL_MODE:<6} reads={len(latencies):>6} '
+        f'p50={percentile(latencies, 50):>8.2f}ms p99={percentile(latencies, 99):>8.2f}ms '
+        f'max={max(latencies):>8.2f}ms'
+    )
+
+def run(rounds=10, n=30000):
+    for mode in ['DELETE', 'WAL']:
+        env = dict(os.environ)
+        env['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        env['DATABASE_JOURNAL_MODE'] = mode
+        subprocess.run([sys.executable, __file__, '--mode', str(rounds), str(n)], env=env, check=True)
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--mode':
+        run_mode(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        rounds = int(sys.argv[1]) if len(sys.argv) >= 2 else 10
+        n = int(sys.argv[2]) if len(sys.argv) >= 3 else 30000
+        run(rounds, n)
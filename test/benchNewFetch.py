@@ -0,0 +1,45 @@
+# encoding: utf-8
+
+"""
+对比逐条写入(pushNewFetch)与批量写入(pushNewFetchBatch)的速度
+会使用临时数据库文件，不会影响`data.db`
+用法：python test/benchNewFetch.py [代理数量]
+"""
+
+import sys, os
+import tempfile
+import time
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+
+tmp_dir = tempfile.mkdtemp()
+os.environ['DATABASE_PATH'] = os.path.join(tmp_dir, 'bench.db')
+
+from db import conn
+
+def make_proxies(n, offset=0):
+    proxies = []
+    for i in range(offset, offset + n):
+        proxies.append(('http', f'10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}', 8080))
+    return proxies
+
+def bench(title, n, func):
+    start_time = time.time()
+    func()
+    cost = time.time() - start_time
+    print(f'{title:<32} {n:>8} rows {cost:>8.3f}s {n / cost:>12.0f} rows/s')
+
+def run(n=5000):
+    conn.clearProxies()
+    proxies = make_proxies(n)
+    bench('pushNewFetch (insert)', n, lambda: [conn.pushNewFetch('bench', *p) for p in proxies])
+    bench('pushNewFetch (update)', n, lambda: [conn.pushNewFetch('bench', *p) for p in proxies])
+
+    conn.clearProxies()
+    proxies = make_proxies(n, offset=n)
+    bench('pushNewFetchBatch (insert)', n, lambda: conn.pushNewFetchBatch('bench', proxies))
+    bench('pushNewFetchBatch (update)', n, lambda: conn.pushNewFetchBatch('bench', proxies))
+
+    assert conn.getProxiesStatus()['sum_proxies_cnt'] == n
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) >= 2 else 5000)
@@ -0,0 +1,64 @@
+# encoding: utf-8
+
+"""
+对比管理后台代理列表按页码(OFFSET)翻页与按游标翻页的耗时，以及每页都重新计算总数的耗时
+在20万个代理中，分别测试翻到第1、100、1000、4000页(每页50个)的平均耗时
+使用临时数据库，不会影响`data.db`
+用法：python test/benchPagination.py [每组测试的次数]
+"""
+
+import sys, os
+import tempfile
+import time
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+
+tmp_dir = tempfile.mkdtemp()
+os.environ['DATABASE_PATH'] = os.path.join(tmp_dir, 'bench.db')
+
+from db import conn
+
+PAGE_SIZE = 50
+
+def timeit(func, times):
+    start_time = time.perf_counter()
+    for _ in range(times):
+        func()
+    return (time.perf_counter() - start_time) * 1000 / times
+
+def run(times=20):
+    n = 200000
+    proxies = [('http' if i % 2 == 0 else 'socks5', f'10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}', 8080) for i in range(n)]
+    conn.pushNewFetchBatch('bench', proxies)
+    to_validate = conn.getToValidate(n)
+    conn.pushValidateResultBatch([(p, i % 2 == 0, i % 1000 if i % 2 == 0 else None) for i, p in enumerate(to_validate)])
+
+    # 先按游标走一遍，记下每一页的游标
+    cursors = [None]
+    after = None
+    while True:
+        _, after = conn.queryProxiesAfter(after=after, page_size=PAGE_SIZE)
+        if after is None:
+            break
+        cursors.append(after)
+
+    for page in [1, 100, 1000, 4000]:
+        print(
+            f'page={page:>5} '
+            f'OFFSET: {timeit(lambda: conn.queryProxies(page=page, page_size=PAGE_SIZE), times):>8.3f}ms '
+            f'cursor: {timeit(lambda: conn.queryProxiesAfter(after=cursors[page - 1], page_size=PAGE_SIZE), times):>8.3f}ms'
+        )
+
+    def legacy_count(keyword=None):
+        where_sql, params = conn._build_proxy_query_filters(keyword=keyword)
+        with conn._read_conn() as c:
+            return c.execute('SELECT count(*) FROM proxies' + where_sql, params).fetchone()[0]
+
+    print(
+        f'count(*): {timeit(legacy_count, times):>8.3f}ms '
+        f'proxy_stats: {timeit(conn.countProxies, times):>8.3f}ms '
+        f'keyword count(*): {timeit(lambda: legacy_count("10.1"), times):>8.3f}ms '
+        f'keyword approximate: {timeit(lambda: conn.countProxies(keyword="10.1", approximate=True), times):>8.3f}ms'
+    )
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) >= 2 else 20)
@@ -0,0 +1,60 @@
+# encoding: utf-8
+
+"""
+对比ORDER BY RANDOM()与拒绝采样(随机rowid加精确查找)两种随机选择可用代理的方式
+在1千、1万、10万个可用代理时，分别测试每次选择1、10、50个代理时getValidatedRandom和get_by_protocol('http', ...)的平均耗时
+使用临时数据库，不会影响`data.db`
+用法：python test/benchRandom.py [每组测试的次数]
+"""
+
+import sys, os
+import tempfile
+import time
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+
+tmp_dir = tempfile.mkdtemp()
+os.environ['DATABASE_PATH'] = os.path.join(tmp_dir, 'bench.db')
+
+from db import conn
+
+def legacy_random(protocol, max_count):
+    with conn._read_conn() as c:
+        if protocol is None:
+            r = c.execute('SELECT * FROM proxies WHERE validated=? ORDER BY RANDOM() LIMIT ?', (True, max_count))
+        else:
+            r = c.execute('SELECT * FROM proxies WHERE protocol=? AND validated=? ORDER BY RANDOM() LIMIT ?', (protocol, True, max_count))
+        rows = r.fetchall()
+        r.close()
+        return rows
+
+def timeit(func, times, k):
+    start_time = time.perf_counter()
+    for _ in range(times):
+        assert len(func()) == k
+    return (time.perf_counter() - start_time) * 1000 / times
+
+def run(times=200):
+    offset = 0
+    for n in [1000, 10000, 100000]:
+        # 补齐到n个可用代理，协议交替为http和socks5，并混入同样数量的不可用代理
+        proxies = []
+        for i in range(offset, n):
+            protocol = 'http' if i % 2 == 0 else 'socks5'
+            proxies.append((protocol, f'10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}', 8080))
+            proxies.append((protocol, f'11.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}', 8080))
+        conn.pushNewFetchBatch('bench', proxies)
+        to_validate = conn.getToValidate(len(proxies))
+        conn.pushValidateResultBatch([(p, p.ip.startswith('10.'), 100) for p in to_validate])
+        offset = n
+
+        for k in [1, 10, 50]:
+            print(
+                f'validated={n:>6} k={k:>2} '
+                f'ORDER BY RANDOM(): all={timeit(lambda: legacy_random(None, k), times, k):>7.3f}ms '
+                f'http={timeit(lambda: legacy_random("http", k), times, k):>7.3f}ms   '
+                f'rejection sampling: all={timeit(lambda: conn.getValidatedRandom(k), times, k):>7.3f}ms '
+                f'http={timeit(lambda: conn.get_by_protocol("http", k), times, k):>7.3f}ms'
+            )
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) >= 2 else 200)
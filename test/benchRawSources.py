@@ -0,0 +1,113 @@
+# encoding: utf-8
+
+"""
+RawSourcesFetcher解析大型代理源的速度和内存：对比原来的解析方式(读取整个响应体，解码为字符串之后用正则表达式解析到列表，
+再合并到全部代理的列表中去重)与按块解析到去重集合的方式
+代理源由本地HTTP服务提供，默认100万行，其中不重复的代理10万个，每种方式在单独的子进程中运行，
+内存为子进程的峰值常驻内存(/proc/self/status中的VmHWM)减去开始解析之前的值，需要在Linux上运行
+不会访问外部网络，也不会读写`data.db`以及代理源的缓存文件
+用法：python test/benchRawSources.py [行数] [不重复的代理数量]
+"""
+
+import sys, os
+import re
+import time
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+
+def make_source(lines, unique):
+    rows = []
+    for i in range(lines):
+        n = i % unique
+        ip = f'10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}'
+        if n % 10 == 0:
+            rows.append(f'socks5://{ip}:{1080 + n % 1000}')
+        else:
+            rows.append(f'{ip}:{8000 + n % 1000}')
+    return ('\n'.join(rows) + '\n').encode('ascii')
+
+def legacy_fetch(fetcher):
+    """
+    修改之前的RawSourcesFetcher.fetch
+    """
+    line_re = re.compile(
+        r'(?:(http|https|socks4|socks5)://)?'
+        r'(\d{1,3}(?:\.\d{1,3}){3})'
+        r':(\d{1,5})',
+        re.IGNORECASE
+    )
+    all_proxies = []
+    for protocol, url in fetcher._load_sources():
+        resp = fetcher.session.get(url, timeout=fetcher.request_timeout)
+        resp.raise_for_status()
+        proxies = []
+        for match in line_re.finditer(resp.text):
+            ip = match.group(2)
+            if not fetcher._valid_ipv4(ip):
+                continue
+            port = int(match.group(3))
+            if port <= 0 or port > 65535:
+                continue
+            proxies.append((fetcher._normalize_protocol(match.group(1), protocol), ip, port))
+        all_proxies.extend(proxies)
+    return list(set(all_proxies))
+
+def peak_rss_kb():
+    # 没有使用ru_maxrss，因为它在exec之后仍然保留父进程的值
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+
+def run_variant(variant):
+    from fetchers.RawSourcesFetcher import RawSourcesFetcher
+    fetcher = RawSourcesFetcher()
+    before_kb = peak_rss_kb()
+    start_time = time.time()
+    proxies = legacy_fetch(fetcher) if variant == 'legacy' else fetcher.fetch()
+    cost = time.time() - start_time
+    peak_kb = peak_rss_kb() - before_kb
+    print(f'{variant:<8} proxies={len(proxies):>8} {cost:>7.2f}s peak_rss=+{peak_kb / 1024:>7.1f}MB')
+
+def run(lines=1000000, unique=100000):
+    body = make_source(lines, unique)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    tmp_dir = tempfile.mkdtemp()
+    sources_file = os.path.join(tmp_dir, 'raw_sources.txt')
+    with open(sources_file, 'w') as f:
+        f.write(f'http,http://127.0.0.1:{server.server_address[1]}/list.txt\n')
+    print(f'source: {lines} lines, {unique} unique proxies, {len(body) / 1024 / 1024:.1f}MB')
+
+    env = dict(os.environ)
+    env['RAW_SOURCES_FILE'] = sources_file
+    env['RAW_SOURCES_CACHE_FILE'] = '' # 不使用缓存，每次都完整解析
+    env['RAW_SOURCES_TIMEOUT'] = '60'
+    env['DATABASE_PATH'] = os.path.join(tmp_dir, 'bench.db')
+    for variant in ['legacy', 'stream']:
+        subprocess.run([sys.executable, __file__, '--variant', variant], env=env, check=True)
+    server.shutdown()
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--variant':
+        run_variant(sys.argv[2])
+    else:
+        lines = int(sys.argv[1]) if len(sys.argv) >= 2 else 1000000
+        unique = int(sys.argv[2]) if len(sys.argv) >= 3 else 100000
+        run(lines, unique)
@@ -0,0 +1,97 @@
+# encoding: utf-8
+
+"""
+模拟比较不同的下次验证时间策略(db/schedule.py)，不会进行真正的验证，使用临时数据库，不会读写`data.db`
+每个代理的真实状态在可用/不可用之间随机切换(两种状态的持续时间服从指数分布)，验证结果即验证时刻的真实状态：
+stable：平均可用24小时、不可用0.5小时；flaky：平均可用1小时、不可用1小时；dead：一直不可用
+统计：平均每个可用代理每小时被验证的次数，以及被标记为可用的时间中代理实际不可用的比例(越低越好)
+用法：python test/benchSchedule.py [每类代理的数量] [模拟的小时数]
+"""
+
+import sys, os
+import heapq
+import random
+import tempfile
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from db.Proxy import Proxy
+from db.schedule import POLICIES
+
+KINDS = dict(stable=(24, 0.5), flaky=(1, 1), dead=(0, None))
+
+class SimProxy(object):
+    def __init__(self, kind, rng):
+        self.kind = kind
+        self.rng = rng
+        self.proxy = Proxy()
+        self.up = kind != 'dead'
+        self.next_flip = self._duration()
+        self.last_time = 0
+
+    def _duration(self):
+        mean_up, mean_down = KINDS[self.kind]
+        if mean_down is None:
+            return float('inf')
+        return self.rng.expovariate(1 / (mean_up if self.up else mean_down))
+
+    def advance(self, t, stats):
+        """
+        推进到时刻t，累计这段时间内被标记为可用的时间，以及其中实际不可用的时间
+        """
+        while self.last_time < t:
+            end = min(t, self.next_flip)
+            if self.proxy.validated:
+                stats['validated_hours'] += end - self.last_time
+                if not self.up:
+                    stats['stale_hours'] += end - self.last_time
+            self.last_time = end
+            if end == self.next_flip:
+                self.up = not self.up
+                self.next_flip = end + self._duration()
+
+def simulate(policy_name, n, hours):
+    rng = random.Random(1)
+    random.seed(1)
+    policy = POLICIES[policy_name]()
+    stats = {kind: dict(validations=0, validated_hours=0, stale_hours=0, removed=0) for kind in KINDS}
+    proxies = [SimProxy(kind, rng) for kind in KINDS for _ in range(n)]
+    heap = [(0, i) for i in range(len(proxies))]
+    while len(heap) > 0:
+        t, i = heapq.heappop(heap)
+        if t >= hours:
+            break
+        p = proxies[i]
+        kind_stats = stats[p.kind]
+        p.advance(t, kind_stats)
+        kind_stats['validations'] += 1
+        should_remove = p.proxy.validate(p.up, 100 if p.up else None, policy)
+        if should_remove:
+            kind_stats['removed'] += 1
+            p.proxy.validated = False
+            continue
+        delay = (p.proxy.to_validate_date - p.proxy.validate_date).total_seconds() / 3600
+        heapq.heappush(heap, (t + delay, i))
+    for p in proxies:
+        if p.last_time < hours:
+            p.advance(hours, stats[p.kind])
+
+    total = dict(validations=0, validated_hours=0, stale_hours=0)
+    for kind, kind_stats in stats.items():
+        for k in total:
+            total[k] += kind_stats[k]
+        per_hour = kind_stats['validations'] / (n * hours)
+        print(
+            f'policy={policy_name:<8} kind={kind:<6} validations/proxy-hour={per_hour:>6.2f} '
+            f'stale={kind_stats["stale_hours"] / max(kind_stats["validated_hours"], 1e-9):>6.1%} removed={kind_stats["removed"]}'
+        )
+    print(
+        f'policy={policy_name:<8} validations/validated-proxy-hour={total["validations"] / total["validated_hours"]:>6.2f} '
+        f'stale={total["stale_hours"] / total["validated_hours"]:>6.1%}'
+    )
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) >= 2 else 1000
+    hours = int(sys.argv[2]) if len(sys.argv) >= 3 else 48
+    for policy_name in POLICIES:
+        simulate(policy_name, n, hours)
@@ -0,0 +1,76 @@
+# encoding: utf-8
+
+"""
+多进程验证器测试：使用1、2、4个验证进程(每个进程负责一个分片，与main.py中VALIDATE_PROCESS_NUM的行为相同)
+验证同一批本地模拟代理(见benchValidator.py)，统计从开始到全部代理的验证结果写入数据库为止，每秒验证的代理数量
+每个进程的配置相同(默认200个验证线程)，不会访问外部网络，每次测试使用一个新的临时数据库，不会读写`data.db`
+用法：python test/benchShardedValidator.py [代理数量] [模拟代理的延迟毫秒数]
+"""
+
+import sys, os
+import tempfile
+import subprocess
+import multiprocessing
+import logging
+import time
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+
+def run_processes(process_num, n):
+    from db import conn
+    from proc import run_validator
+    from benchValidator import make_proxies
+    logging.getLogger().setLevel('WARNING') # 验证进程的日志太多
+
+    proxies = make_proxies(n)
+    conn.pushNewFetchBatch('bench', [(p.protocol, p.ip, p.port) for p in proxies])
+
+    proc_lock = multiprocessing.Lock()
+    processes = [
+        multiprocessing.Process(target=run_validator.main, args=(proc_lock, i, process_num), daemon=True)
+        for i in range(process_num)
+    ]
+    start_time = time.perf_counter()
+    for p in processes:
+        p.start()
+    while True:
+        time.sleep(0.2)
+        with conn._read_conn() as c:
+            done_cnt = c.execute('SELECT count(*) FROM proxies WHERE validate_date IS NOT NULL').fetchone()[0]
+        if done_cnt >= n:
+            break
+    cost = time.perf_counter() - start_time
+    for p in processes:
+        p.terminate()
+        p.join()
+    print(f'processes={process_num} proxies={n} cost={cost:>6.2f}s {n / cost:>8.1f} checks/s  (cpu count={os.cpu_count()})')
+
+def run(n=5000, delay_ms=0):
+    from benchValidator import KEYWORD
+    env = dict(os.environ)
+    env['VALIDATE_URL'] = 'http://10.255.255.1/'
+    env['VALIDATE_KEYWORD'] = KEYWORD
+    env['VALIDATE_METHOD'] = 'GET'
+    env['VALIDATE_TIMEOUT'] = '2'
+    env['VALIDATE_CONNECT_TIMEOUT'] = '3'
+    env['VALIDATE_AIMD'] = '0'
+    env['PROC_VALIDATOR_SLEEP'] = '1'
+
+    bench_validator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchValidator.py')
+    server = subprocess.Popen([sys.executable, bench_validator, '--server', str(delay_ms)], env=env)
+    try:
+        time.sleep(1)
+        for process_num in [1, 2, 4]:
+            run_env = dict(env)
+            run_env['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+            subprocess.run([sys.executable, __file__, '--processes', str(process_num), str(n)], env=run_env, check=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--processes':
+        run_processes(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        n = int(sys.argv[1]) if len(sys.argv) >= 2 else 5000
+        delay_ms = int(sys.argv[2]) if len(sys.argv) >= 3 else 0
+        run(n, delay_ms)
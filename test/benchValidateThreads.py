@@ -0,0 +1,114 @@
+# encoding: utf-8
+
+"""
+对比使用func_timeout限制验证时间(每次验证都会创建一个额外的线程)与socket超时加上共用的截止时间线程(见proc/deadline.py)两种方式，
+用VALIDATE_THREAD_NUM个验证线程验证1万次本地模拟代理(见benchValidator.py)，统计创建的线程数量以及消耗的CPU时间
+需要安装func-timeout才能测试旧的方式，不会访问外部网络，也不会读写`data.db`
+用法：python test/benchValidateThreads.py [验证次数]
+"""
+
+import sys, os
+import tempfile
+import subprocess
+import threading
+import resource
+import time
+from queue import Queue
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+
+from benchValidator import HTTP_PORT, KEYWORD
+
+def legacy_validate_thread(in_que, on_result):
+    """
+    修改之前的验证线程：每次验证都通过func_timeout在一个新的线程中进行
+    """
+    import requests
+    from func_timeout import func_set_timeout
+    from config import VALIDATE_TIMEOUT, VALIDATE_MAX_FAILS, VALIDATE_URL
+
+    @func_set_timeout(VALIDATE_TIMEOUT * 2)
+    def validate_once(proxy):
+        proxies = {
+            'http': f'{proxy.protocol}://{proxy.ip}:{proxy.port}',
+            'https': f'{proxy.protocol}://{proxy.ip}:{proxy.port}'
+        }
+        r = requests.get(VALIDATE_URL, timeout=VALIDATE_TIMEOUT, proxies=proxies)
+        r.encoding = "utf-8"
+        return KEYWORD in r.text
+
+    while True:
+        proxy = in_que.get()
+        success = False
+        latency = None
+        for _ in range(VALIDATE_MAX_FAILS):
+            try:
+                start_time = time.time()
+                if validate_once(proxy):
+                    latency = int((time.time() - start_time) * 1000)
+                    success = True
+                    break
+            except BaseException:
+                pass
+        on_result(proxy, success, latency)
+
+def run_variant(variant, n):
+    from db.Proxy import Proxy
+    from proc import run_validator
+    from config import VALIDATE_THREAD_NUM
+
+    # 统计创建的线程数量
+    started = [0]
+    original_start = threading.Thread.start
+    def counting_start(self):
+        started[0] += 1
+        original_start(self)
+    threading.Thread.start = counting_start
+
+    if variant == 'func_timeout':
+        import requests, func_timeout # 避免在验证线程中同时导入
+    target = legacy_validate_thread if variant == 'func_timeout' else run_validator.validate_thread
+    in_que = Queue()
+    out_que = Queue()
+    for _ in range(VALIDATE_THREAD_NUM):
+        threading.Thread(target=target, args=(in_que, lambda *result: out_que.put(result)), daemon=True).start()
+    worker_threads = started[0]
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start_time = time.perf_counter()
+    for i in range(n):
+        p = Proxy()
+        p.protocol, p.ip, p.port = 'http', f'127.0.{(i >> 8) & 255}.{(i & 255) or 1}', HTTP_PORT
+        in_que.put(p)
+    success_cnt = len([_ for _ in range(n) if out_que.get()[1]])
+    cost = time.perf_counter() - start_time
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+
+    print(
+        f'{variant:<12} validations={n} success={success_cnt:>6} '
+        f'threads created={started[0] - worker_threads:>6} '
+        f'CPU={cpu:>7.2f}s ({cpu / n * 10000:>6.2f}s per 10k) wall={cost:>6.2f}s'
+    )
+
+def run(n=10000):
+    env = dict(os.environ)
+    env['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    env['VALIDATE_URL'] = 'http://10.255.255.1/'
+    env['VALIDATE_KEYWORD'] = KEYWORD
+    env['VALIDATE_METHOD'] = 'GET'
+
+    bench_validator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchValidator.py')
+    server = subprocess.Popen([sys.executable, bench_validator, '--server', '0'], env=env)
+    try:
+        time.sleep(1)
+        for variant in ['func_timeout', 'socket']:
+            subprocess.run([sys.executable, __file__, '--variant', variant, str(n)], env=env, check=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--variant':
+        run_variant(sys.argv[2], int(sys.argv[3]))
+    else:
+        run(int(sys.argv[1]) if len(sys.argv) >= 2 else 10000)
@@ -0,0 +1,162 @@
+# encoding: utf-8
+
+"""
+验证器吞吐量测试：在本地启动模拟的HTTP代理和SOCKS5代理(每个请求固定延迟一段时间后返回包含关键字的网页)，
+分别使用线程方式和asyncio方式、是否启用第一阶段的连接检查验证同一批代理，统计每秒验证的代理数量以及进程的内存占用(RSS峰值)
+模拟代理监听在0.0.0.0上，通过127.x.x.x的不同地址区分不同的代理；
+另有40%的代理指向一个不接受连接的端口(监听队列已满，连接会一直等到超时)，模拟无法连接的代理
+不会访问外部网络，也不会读写`data.db`
+用法：python test/benchValidator.py [代理数量] [模拟代理的延迟毫秒数]
+"""
+
+import sys, os
+import tempfile
+import subprocess
+import asyncio
+import socket
+import time
+from queue import Queue
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+
+HTTP_PORT = 15781
+SOCKS_PORT = 15782
+DEAD_PORT = 15783
+KEYWORD = 'Example Domain'
+
+def fake_proxy_server(delay_ms):
+    """
+    模拟代理，HTTP代理和SOCKS5代理都不会真正连接目标网址，而是直接返回包含关键字的网页
+    """
+    body = f'<html><body><h1>{KEYWORD}</h1>{"x" * 1024}</body></html>'.encode('utf-8')
+    response = (
+        b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n'
+        + f'Content-Length: {len(body)}\r\n'.encode('latin-1')
+        + b'Connection: close\r\n\r\n' + body
+    )
+
+    async def serve_http(reader, writer):
+        try:
+            while (await reader.readline()) not in (b'\r\n', b''):
+                pass
+            await asyncio.sleep(delay_ms / 1000)
+            writer.write(response)
+            await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve_socks5(reader, writer):
+        try:
+            n_methods = (await reader.readexactly(2))[1]
+            await reader.readexactly(n_methods)
+            writer.write(b'\x05\x00')
+            _, _, _, atyp = await reader.readexactly(4)
+            if atyp == 1:
+                await reader.readexactly(4 + 2)
+            elif atyp == 4:
+                await reader.readexactly(16 + 2)
+            else:
+                await reader.readexactly((await reader.readexactly(1))[0] + 2)
+            writer.write(b'\x05\x00\x00\x01\x7f\x00\x00\x01\x00\x50')
+        except (OSError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+        await serve_http(reader, writer)
+
+    # 监听队列长度为0并且从不accept，之后的连接请求都会被丢弃
+    dead = socket.socket()
+    dead.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    dead.bind(('0.0.0.0', DEAD_PORT))
+    dead.listen(0)
+
+    async def main():
+        await asyncio.start_server(serve_http, '0.0.0.0', HTTP_PORT, backlog=4096)
+        await asyncio.start_server(serve_socks5, '0.0.0.0', SOCKS_PORT, backlog=4096)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+def make_proxies(n):
+    from db.Proxy import Proxy
+    proxies = []
+    for i in range(n):
+        p = Proxy()
+        p.ip = f'127.{(i >> 16) & 255}.{(i >> 8) & 255}.{(i & 255) or 1}'
+        if i % 5 >= 3:
+            p.protocol, p.port = ('http', DEAD_PORT) if i % 2 == 0 else ('socks5', DEAD_PORT)
+        elif i % 2 == 0:
+            p.protocol, p.port = 'http', HTTP_PORT
+        else:
+            p.protocol, p.port = 'socks5', SOCKS_PORT
+        proxies.append(p)
+    return proxies
+
+def peak_rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0
+
+def run_mode(n):
+    from proc import run_validator
+    from config import VALIDATE_MODE, VALIDATE_THREAD_NUM, VALIDATE_ASYNC_CONCURRENCY, VALIDATE_PREFILTER
+
+    proxies = make_proxies(n)
+    out_que = Queue()
+    start_time = time.perf_counter()
+    submit, _, stages = run_validator.create_validator(lambda *result: out_que.put(result))
+    for p in proxies:
+        submit(p)
+    results = [out_que.get() for _ in range(n)]
+    cost = time.perf_counter() - start_time
+
+    concurrency = VALIDATE_ASYNC_CONCURRENCY if VALIDATE_MODE == 'asyncio' else VALIDATE_THREAD_NUM
+    success_cnt = len([_ for _ in results if _[1]])
+    print(
+        f'mode={VALIDATE_MODE:<7} concurrency={concurrency:>5} prefilter={str(VALIDATE_PREFILTER):<5} '
+        f'proxies={n} success={success_cnt:>6} {n / cost:>8.1f} checks/s  peak RSS={peak_rss_mb():>6.1f}MB'
+    )
+    for name, stage in stages.items():
+        stats = stage.stats()
+        print(f'    stage={name:<8} checked={stats["checked"]:>6} dropped={stats["dropped"]:>6} drop_rate={stats["drop_rate"]:.2f}')
+
+def run(n=5000, delay_ms=500):
+    env = dict(os.environ)
+    env['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    env['VALIDATE_URL'] = 'http://10.255.255.1/'
+    env['VALIDATE_KEYWORD'] = KEYWORD
+    env['VALIDATE_METHOD'] = 'GET'
+    env['VALIDATE_TIMEOUT'] = '2'
+    env['VALIDATE_CONNECT_TIMEOUT'] = '3'
+    env['VALIDATE_ASYNC_CONCURRENCY'] = '2000'
+    env['VALIDATE_PREFILTER_CONCURRENCY'] = '1000'
+
+    server = subprocess.Popen([sys.executable, __file__, '--server', str(delay_ms)], env=env)
+    try:
+        time.sleep(1)
+        # 线程方式分别使用默认的线程数量以及与asyncio方式相同的并发数量
+        for mode, thread_num, prefilter in [
+            ('thread', 200, False), ('thread', 200, True), ('thread', 2000, False),
+            ('asyncio', None, False), ('asyncio', None, True)
+        ]:
+            mode_env = dict(env)
+            mode_env['VALIDATE_MODE'] = mode
+            mode_env['VALIDATE_PREFILTER'] = '1' if prefilter else '0'
+            if thread_num is not None:
+                mode_env['VALIDATE_THREAD_NUM'] = str(thread_num)
+            subprocess.run([sys.executable, __file__, '--mode', str(n)], env=mode_env, check=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--server':
+        fake_proxy_server(int(sys.argv[2]))
+    elif len(sys.argv) >= 2 and sys.argv[1] == '--mode':
+        run_mode(int(sys.argv[2]))
+    else:
+        n = int(sys.argv[1]) if len(sys.argv) >= 2 else 5000
+        delay_ms = int(sys.argv[2]) if len(sys.argv) >= 3 else 500
+        run(n, delay_ms)
@@ -0,0 +1,130 @@
+# encoding: utf-8
+
+"""
+验证器主循环的响应速度测试：模拟爬取器每隔一段时间写入一批新的代理(本地模拟代理，见benchValidator.py)，
+统计每个代理从写入数据库到验证结果写入数据库的时间，对比原来的轮询主循环(没有代理时睡眠PROC_VALIDATOR_SLEEP秒，
+验证结果由主循环转交给结果写入线程)与事件驱动的主循环(run_validator.main)
+不会访问外部网络，每次测试使用一个新的临时数据库，不会读写`data.db`
+用法：python test/benchValidatorLatency.py [批次数量] [每批代理数量]
+"""
+
+import sys, os
+import tempfile
+import subprocess
+import threading
+import random
+import time
+from queue import Queue
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+
+def legacy_main():
+    """
+    修改之前的验证器主循环(省略了统计和并发调整)
+    """
+    from db import conn
+    from proc import run_validator
+    from proc.result_sink import ResultSink
+    from config import PROC_VALIDATOR_SLEEP, VALIDATE_RESULT_BATCH_SIZE, VALIDATE_RESULT_FLUSH_MS
+
+    out_que = Queue()
+    running = [0]
+    running_lock = threading.Lock()
+
+    def on_commit(results):
+        with running_lock:
+            running[0] -= len(results)
+
+    sink = ResultSink(VALIDATE_RESULT_BATCH_SIZE, VALIDATE_RESULT_FLUSH_MS, on_commit=on_commit)
+    sink.start()
+    submit, capacity, _ = run_validator.create_validator(lambda *result: out_que.put(result))
+    while True:
+        while not out_que.empty():
+            sink.put(*out_que.get())
+        with running_lock:
+            free_cnt = capacity * 2 - running[0]
+        if free_cnt <= 0:
+            time.sleep(PROC_VALIDATOR_SLEEP)
+            continue
+        proxies = conn.getToValidate(free_cnt, lease_owner='legacy')
+        with running_lock:
+            running[0] += len(proxies)
+        for proxy in proxies:
+            submit(proxy)
+        if len(proxies) == 0:
+            time.sleep(PROC_VALIDATOR_SLEEP)
+
+def run_variant(variant, rounds, batch_size):
+    from db import conn
+    from proc import run_validator
+    from proc.wakeup import IngestSignal
+    from benchValidator import HTTP_PORT
+    import logging
+    logging.getLogger().setLevel('WARNING')
+
+    if variant == 'polling':
+        threading.Thread(target=legacy_main, daemon=True).start()
+    else:
+        signal = IngestSignal(1)
+        conn.set_ingest_signal(signal)
+        threading.Thread(target=run_validator.main, args=(None, 0, 1, signal), daemon=True).start()
+    time.sleep(1)
+
+    latencies = []
+    rng = random.Random(1)
+    for r in range(rounds):
+        time.sleep(rng.uniform(0.5, 2))
+        ips = [f'127.1.{r}.{i + 1}' for i in range(batch_size)]
+        ingest_time = time.perf_counter()
+        conn.pushNewFetchBatch('bench', [('http', ip, HTTP_PORT) for ip in ips])
+        pending = set(ips)
+        while len(pending) > 0 and time.perf_counter() - ingest_time < 30:
+            time.sleep(0.01)
+            with conn._read_conn() as c:
+                rows = c.execute(
+                    f'SELECT ip FROM proxies WHERE validate_date IS NOT NULL AND ip IN ({",".join(["?"] * len(pending))})',
+                    list(pending)
+                ).fetchall()
+            now = time.perf_counter()
+            for (ip, ) in rows:
+                pending.discard(ip)
+                latencies.append(now - ingest_time)
+
+    latencies.sort()
+    pick = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000
+    print(
+        f'{variant:<8} proxies={len(latencies):>5} ingest->result p50={pick(0.5):>7.0f}ms '
+        f'p95={pick(0.95):>7.0f}ms max={latencies[-1] * 1000:>7.0f}ms'
+    )
+    if variant == 'event':
+        stats = conn.getRuntimeStats().get('validator', {})
+        print(f'         stages={stats.get("stages")}')
+        print(f'         result_sink avg_wait_ms={stats.get("result_sink", {}).get("avg_wait_ms")} dispatch={stats.get("dispatch")}')
+
+def run(rounds=10, batch_size=50):
+    from benchValidator import KEYWORD
+    env = dict(os.environ)
+    env['VALIDATE_URL'] = 'http://10.255.255.1/'
+    env['VALIDATE_KEYWORD'] = KEYWORD
+    env['VALIDATE_METHOD'] = 'GET'
+    env['VALIDATE_TIMEOUT'] = '2'
+    env['STATS_REPORT_INTERVAL'] = '1'
+
+    bench_validator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchValidator.py')
+    server = subprocess.Popen([sys.executable, bench_validator, '--server', '100'], env=env)
+    try:
+        time.sleep(1)
+        for variant in ['polling', 'event']:
+            run_env = dict(env)
+            run_env['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+            subprocess.run([sys.executable, __file__, '--variant', variant, str(rounds), str(batch_size)], env=run_env, check=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--variant':
+        run_variant(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        rounds = int(sys.argv[1]) if len(sys.argv) >= 2 else 10
+        batch_size = int(sys.argv[2]) if len(sys.argv) >= 3 else 50
+        run(rounds, batch_size)
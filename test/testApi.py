@@ -0,0 +1,95 @@
+# encoding: utf-8
+
+import sys, os
+import csv
+import io
+import json
+import tempfile
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+from db import conn
+from api.api import app
+
+def run():
+    n = 2500 # 超过导出时每批的数量，并且不是整数倍
+    conn.pushNewFetchBatch('test', [('http', f'10.0.{i >> 8}.{i & 255}', 8080) for i in range(n)])
+    to_validate = conn.getToValidate(n)
+    conn.pushValidateResultBatch([(p, i % 2 == 0, i % 7 if i % 2 == 0 else None) for i, p in enumerate(to_validate)])
+    expected = [(p.protocol, p.ip, p.port) for p in conn.queryProxies(page_size=n)]
+    assert len(expected) == n
+
+    client = app.test_client()
+
+    # 按游标翻页
+    items = []
+    after = ''
+    while after is not None:
+        data = client.get('/admin/proxies', query_string=dict(after=after, page_size=500, total_mode='approx')).get_json()
+        assert data['success'] and data['total'] == n
+        items += data['items']
+        after = data['next_after']
+    assert [(p['protocol'], p['ip'], p['port']) for p in items] == expected
+    assert client.get('/admin/proxies', query_string=dict(after='xxx')).status_code == 400
+    assert client.get('/admin/proxies', query_string=dict(page=2, total_mode='none')).get_json()['total'] is None
+
+    # 三种格式的导出都应该包含全部代理，并且以流的形式返回
+    r = client.get('/admin/proxies/export.csv')
+    assert r.is_streamed
+    rows = list(csv.reader(io.StringIO(r.get_data(as_text=True))))
+    assert rows[0][:3] == ['protocol', 'ip', 'port']
+    assert [(row[0], row[1], int(row[2])) for row in rows[1:]] == expected
+
+    r = client.get('/admin/proxies/export.ndjson')
+    assert r.is_streamed
+    lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    assert [(item['protocol'], item['ip'], item['port']) for item in lines] == expected
+
+    r = client.get('/admin/proxies/export.txt', query_string=dict(validated='1'))
+    assert r.is_streamed
+    lines = r.get_data(as_text=True).splitlines()
+    assert lines == [f'{p[0]}://{p[1]}:{p[2]}' for p in expected[:n // 2]]
+
+    # 按延迟获取代理
+    conn.pushNewFetchBatch('latency', [('socks4', f'10.3.0.{i}', 1080) for i in range(3)])
+    for p in conn.getToValidate(n):
+        if p.fetcher_name == 'latency':
+            conn.pushValidateResult(p, True, [50, 500, 3000][int(p.ip.split('.')[-1])])
+    r = client.get('/fetch_socks4_all', query_string=dict(prefer='fast'))
+    assert r.get_data(as_text=True) == 'socks4://10.3.0.0:1080,socks4://10.3.0.1:1080,socks4://10.3.0.2:1080'
+    r = client.get('/fetch_socks4_all', query_string=dict(max_latency=1000))
+    assert sorted(r.get_data(as_text=True).split(',')) == ['socks4://10.3.0.0:1080', 'socks4://10.3.0.1:1080']
+    assert client.get('/fetch_socks4', query_string=dict(max_latency=10)).get_data(as_text=True) == ''
+    assert client.get('/fetch_random', query_string=dict(max_latency=1000, prefer='fast')).get_data(as_text=True) != ''
+    assert client.get('/fetch_random', query_string=dict(max_latency='abc')).status_code == 400
+    assert client.get('/fetch_all', query_string=dict(prefer='slow')).status_code == 400
+
+    # 系统页面显示验证器的并发数量
+    assert client.get('/admin/summary').get_json()['validator_concurrency'] is None
+    conn.pushRuntimeStats('validator', dict(concurrency=dict(limit=120, last_decision=dict(action='hold', reason='-'))))
+    assert client.get('/admin/summary').get_json()['validator_concurrency']['limit'] == 120
+    # 多个验证进程时为各进程之和
+    conn.pushRuntimeStats('validator-1', dict(concurrency=dict(limit=80, last_decision=None)))
+    concurrency = client.get('/admin/summary').get_json()['validator_concurrency']
+    assert concurrency['limit'] == 200 and len(concurrency['processes']) == 2
+
+    # 代理源页面显示每个代理源的缓存命中统计
+    from fetchers.SourceCache import SourceCache, source_key
+    tmp_dir = tempfile.mkdtemp()
+    os.environ['RAW_SOURCES_FILE'] = os.path.join(tmp_dir, 'raw_sources.txt')
+    os.environ['RAW_SOURCES_CACHE_FILE'] = os.path.join(tmp_dir, 'cache.json')
+    with open(os.environ['RAW_SOURCES_FILE'], 'w') as f:
+        f.write('# comment\nsocks5,https://example.com/a.txt\nhttps://example.com/b.txt\n')
+    cache = SourceCache(os.environ['RAW_SOURCES_CACHE_FILE'])
+    key = source_key('socks5', 'https://example.com/a.txt')
+    cache.record_miss(key, '"v1"', None, 'hash', 10)
+    cache.record_hit(key, 'not_modified')
+    cache.record_hit(key, 'not_modified')
+    cache.save([key])
+    stats = client.get('/admin/sources').get_json()['source_stats']
+    assert [(item['protocol'], item['url']) for item in stats] == [('socks5', 'https://example.com/a.txt'), ('http', 'https://example.com/b.txt')]
+    assert stats[0]['hits'] == 2 and stats[0]['misses'] == 1 and stats[0]['last_result'] == 'not_modified'
+    assert stats[1]['hits'] == 0 and stats[1]['hit_ratio'] is None
+
+if __name__ == '__main__':
+    print(u'请确保运行本脚本之前删除或备份`data.db`文件')
+    run()
+    print(u'测试通过')
@@ -3,6 +3,8 @@
 import sys,os
 sys.path.append(os.path.dirname(__file__) + os.sep + '../')
 from db import conn
+from db.Proxy import Proxy
+from db.schedule import get_policy
 
 def run():
     assert len(conn.getToValidate(10)) == 0
@@ -21,17 +23,17 @@ def run():
     assert proxies[3].ip == '127.0.0.4'
 
     p = conn.getToValidate(1)[0] # 设置一个代理通过验证
-    conn.pushValidateResult(p, True)
+    conn.pushValidateResult(p, True, 100)
     assert len(conn.getToValidate(10)) == 3
     p = conn.getToValidate(1)[0] # 设置一个代理没有通过验证
-    conn.pushValidateResult(p, False)
+    conn.pushValidateResult(p, False, None)
     assert len(conn.getToValidate(10)) == 2
     assert len(conn.getValidatedRandom(1)) == 1
     assert len(conn.getValidatedRandom(-1)) == 1
     p = conn.getValidatedRandom(1)[0]
     assert p.ip == '127.0.0.1'
     p = conn.getToValidate(1)[0] # 设置一个代理通过验证
-    conn.pushValidateResult(p, True)
+    conn.pushValidateResult(p, True, 100)
     assert len(conn.getValidatedRandom(1)) == 1
     assert len(conn.getValidatedRandom(-1)) == 2
 
@@ -40,6 +42,60 @@ def run():
     assert proxies_status['validated_proxies_cnt'] == 2
     assert proxies_status['pending_proxies_cnt'] == 1
 
+    # 批量写入：已存在的代理只更新来源，新代理直接插入
+    assert conn.pushNewFetchBatch('test2', [
+        ('http', '127.0.0.1', 8080),
+        ('http', '127.0.0.5', 8080),
+        ('http', '127.0.0.5', 8080),
+    ]) == 3
+    assert conn.pushNewFetchBatch('test2', []) == 0
+    proxies_status = conn.getProxiesStatus()
+    assert proxies_status['sum_proxies_cnt'] == 5
+    assert proxies_status['validated_proxies_cnt'] == 2
+    assert proxies_status['pending_proxies_cnt'] == 3
+    assert conn.getProxyCount('test2') == 2
+    assert len(conn.getValidatedRandom(-1)) == 2
+
+    # 批量写入验证结果
+    proxies = conn.getToValidate(10)
+    assert len(proxies) == 3
+    conn.pushValidateResultBatch([(proxies[0], True, 50), (proxies[1], False, None)])
+    assert len(conn.getToValidate(10)) == 1
+    assert len(conn.getValidatedRandom(-1)) == 2
+    conn.pushValidateResultBatch([])
+
+    # 领取待验证的代理之后，在结果写入之前不会被再次返回
+    conn.pushNewFetchBatch('test3', [('http', '127.0.0.6', 8080), ('http', '127.0.0.7', 8080)])
+    assert len(conn.getToValidate(10)) == 3
+    claimed = conn.getToValidate(2, lease_owner='test')
+    assert len(claimed) == 2
+    assert len(conn.getToValidate(10)) == 1
+    assert len(conn.getToValidate(10, lease_owner='test')) == 1
+    assert len(conn.getToValidate(10)) == 0
+    conn.pushValidateResultBatch([(claimed[0], False, None)])
+    assert len(conn.getToValidate(10)) == 0
+    # 租约过期之后可以被重新领取
+    conn.pushNewFetchBatch('test3', [('http', '127.0.0.8', 8080)])
+    assert len(conn.getToValidate(10, lease_owner='test', lease_seconds=-1)) == 1
+    assert len(conn.getToValidate(10)) == 1
+
+    # 触发器维护的统计应该与proxies表一致
+    assert conn.checkProxyStats() == []
+    assert conn.getProxyCount('test3') == 3
+    assert sum(item['total'] for item in conn.getProtocolStats()) == conn.getProxiesStatus()['sum_proxies_cnt']
+    with conn._write_conn() as c:
+        c.execute("UPDATE proxy_stats SET total_cnt=total_cnt+1 WHERE fetcher_name='test3'")
+        c.commit()
+    assert len(conn.checkProxyStats()) == 1
+    assert len(conn.checkProxyStats(repair=True)) == 1
+    assert conn.checkProxyStats() == []
+
+    conn.pushRuntimeStats('test', dict(cnt=1))
+    conn.pushRuntimeStats('test', dict(cnt=2))
+    stats = conn.getRuntimeStats()
+    assert stats['test']['cnt'] == 2
+    assert stats['test']['updated_at'] is not None
+
     fetchers = conn.getAllFetchers()
     for item in fetchers:
         # 所有爬取器都应该是默认参数
@@ -66,6 +122,122 @@ def run():
     assert f.last_proxies_cnt == 0
     assert f.last_fetch_date is None
 
+    # 按游标翻页的结果应该与按页码翻页的结果一致
+    conn.pushNewFetchBatch('test', [('http', f'10.0.0.{i}', 8080) for i in range(23)])
+    to_validate = conn.getToValidate(100)
+    conn.pushValidateResultBatch([(p, i % 3 != 0, i % 5 if i % 3 != 0 else None) for i, p in enumerate(to_validate)])
+    total = conn.countProxies()
+    assert total == conn.countProxies(keyword='.', approximate=True)
+    assert conn.countProxies(validated=True) + conn.countProxies(validated='false') == total
+    for filters in [dict(), dict(validated=True), dict(validated=False), dict(protocol='http', keyword='10.0.0.1')]:
+        by_page = []
+        page = 1
+        while True:
+            items = conn.queryProxies(page=page, page_size=4, **filters)
+            if len(items) == 0:
+                break
+            by_page += items
+            page += 1
+        by_cursor = []
+        after = None
+        while True:
+            items, after = conn.queryProxiesAfter(after=after, page_size=4, **filters)
+            by_cursor += items
+            if after is None:
+                break
+        assert [(p.protocol, p.ip, p.port) for p in by_page] == [(p.protocol, p.ip, p.port) for p in by_cursor]
+        assert len(by_page) == conn.countProxies(**filters)
+    try:
+        conn.queryProxiesAfter(after='not-a-cursor')
+        assert False
+    except ValueError:
+        pass
+
+    # 多个验证进程各自领取自己分片中的代理，合起来正好是全部待验证的代理
+    conn.pushNewFetchBatch('shard', [('http', f'10.2.0.{i}', 8080) for i in range(40)])
+    conn.pushNewFetch('shard', 'socks5', '10.2.1.1', 1080)
+    to_validate = set((p.protocol, p.ip, p.port) for p in conn.getToValidate(1000))
+    shards = [set((p.protocol, p.ip, p.port) for p in conn.getToValidate(1000, shard=(i, 3))) for i in range(3)]
+    assert all(len(shard) > 0 for shard in shards)
+    assert sum(len(shard) for shard in shards) == len(to_validate) and set.union(*shards) == to_validate
+    assert len(conn.getToValidate(1000, shard=(0, 1))) == len(to_validate)
+    conn.pushValidateResultBatch([(p, False, None) for p in conn.getToValidate(1000)])
+
+    # 验证历史会写入数据库
+    conn.pushNewFetch('history', 'http', '10.1.0.1', 8080)
+    p = [p for p in conn.getToValidate(100) if p.ip == '10.1.0.1'][0]
+    conn.pushValidateResult(p, True, 100)
+    conn.pushValidateResult(p, True, 200)
+    p = [p for p in conn.queryProxies(keyword='10.1.0.1')][0]
+    assert p.success_streak == 2 and p.uptime_ewma == 1 and abs(p.latency_ewma - 130) < 1e-6
+    conn.pushValidateResult(p, False, None)
+    p = [p for p in conn.queryProxies(keyword='10.1.0.1')][0]
+    assert p.success_streak == 0 and abs(p.uptime_ewma - 0.7) < 1e-6 and abs(p.latency_ewma - 130) < 1e-6
+
+    # 延迟分布：p50、p95反映近期的延迟，偶尔一次很慢只影响p95，并且会写入数据库
+    p = Proxy()
+    for latency in [120, 150, 130, 140, 3500, 160, 150, 130, 140, 150]:
+        p.validate(True, latency)
+    assert 100 <= p.latency_p50 <= 200 and p.latency_p95 > 1000
+    for _ in range(20):
+        p.validate(True, 150)
+    assert 100 <= p.latency_p50 <= 200 and p.latency_p95 <= 200
+    p.validate(False, None)
+    assert 100 <= p.latency_p50 <= 200 and p.latency_p95 <= 200
+    conn.pushNewFetchBatch('latency', [('socks4', f'10.3.0.{i}', 1080) for i in range(3)])
+    for p in conn.getToValidate(1000):
+        if p.fetcher_name == 'latency':
+            conn.pushValidateResult(p, True, [50, 500, 3000][int(p.ip.split('.')[-1])])
+    fast = conn.get_by_protocol('socks4', -1, prefer_fast=True)
+    assert [p.ip for p in fast] == ['10.3.0.0', '10.3.0.1', '10.3.0.2']
+    assert fast[0].latency_p50 <= 100 and 400 <= fast[1].latency_p95 <= 600
+    assert set(p.ip for p in conn.get_by_protocol('socks4', -1, max_latency=1000)) == {'10.3.0.0', '10.3.0.1'}
+    assert conn.get_by_protocol('socks4', 1, max_latency=10) == []
+    assert conn.get_by_protocol('socks4', 1, max_latency=100, prefer_fast=True)[0].ip == '10.3.0.0'
+    assert all(p.latency_p95 <= 600 for p in conn.getValidatedRandom(5, max_latency=600))
+
+    # 随机选择不受rowid空洞的影响：排在200个不可用代理之后的可用代理，被选中的概率与另一个可用代理相同
+    conn.pushNewFetchBatch('sample', [('socks5', f'10.4.{i >> 8}.{i & 255}', 1080) for i in range(202)])
+    for p in conn.getToValidate(1000):
+        if p.fetcher_name == 'sample':
+            conn.pushValidateResult(p, p.ip in ('10.4.0.0', '10.4.0.201'), 100)
+    picked = [conn.get_by_protocol('socks5', 1)[0].ip for _ in range(200)]
+    assert 60 <= picked.count('10.4.0.0') <= 140 and 60 <= picked.count('10.4.0.201') <= 140
+
+    # adaptive策略：连续成功的代理验证间隔逐渐变长，时好时坏的代理间隔较短，之前一直可用的代理失败之后很快会重新验证
+    adaptive = get_policy('adaptive')
+    stable = Proxy()
+    delays = []
+    for _ in range(30):
+        stable.validate(True, 100, adaptive)
+        delays.append((stable.to_validate_date - stable.validate_date).total_seconds() / 60)
+    assert delays[0] < delays[2] < delays[4] and 0.9 * 240 <= delays[-1] <= 1.1 * 240
+    flaky = Proxy()
+    for i in range(10):
+        flaky.validate(i % 2 == 0, 100, adaptive)
+    flaky.validate(True, 100, adaptive)
+    assert (flaky.to_validate_date - flaky.validate_date).total_seconds() / 60 < delays[-1] / 4
+    stable.validate(False, None, adaptive)
+    assert (stable.to_validate_date - stable.validate_date).total_seconds() / 60 < 5
+    dead = Proxy()
+    assert dead.validate(False, None, adaptive) == False
+    assert 9 <= (dead.to_validate_date - dead.validate_date).total_seconds() / 60 <= 11
+    # fixed策略与原来相同
+    fixed = get_policy('fixed')
+    p = Proxy()
+    p.validate(True, 100, fixed)
+    assert 10 <= (p.to_validate_date - p.validate_date).total_seconds() / 60 <= 60
+    for i in range(6):
+        should_remove = p.validate(False, None, fixed)
+        assert (p.to_validate_date - p.validate_date).total_seconds() / 60 == (i + 1) * 10
+    assert should_remove
+
+    conn.clearProxies()
+    assert conn.getProxiesStatus()['sum_proxies_cnt'] == 0
+    assert conn.getProtocolStats() == []
+    assert conn.getFetcherProxyStats() == {}
+    assert conn.checkProxyStats() == []
+
 if __name__ == '__main__':
     print(u'请确保运行本脚本之前删除或备份`data.db`文件')
     run()
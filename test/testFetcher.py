@@ -1,8 +1,279 @@
 # encoding: utf-8
 
 import sys,os
+import json
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 sys.path.append(os.path.dirname(__file__) + os.sep + '../')
 from fetchers import fetchers
+from fetchers.BaseFetcher import BaseFetcher
+from fetchers.FetcherSession import FetcherSession, set_shared_session, get_shared_session, BROWSER_HEADERS
+from fetchers.RawSourcesFetcher import RawSourcesFetcher
+
+def start_page_server():
+    """
+    本地模拟的代理网站：/N.html 返回一个包含两个代理的表格，第一页还包含后面几页的链接，/slow.html 很久才返回
+    返回 : (端口, 统计同时处理的请求数量、建立的连接数量以及收到的User-Agent的dict)
+    """
+    state = dict(active=0, max_active=0, connections=0, user_agents=set())
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # 支持keep-alive
+
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            super().setup()
+            with lock:
+                state['connections'] += 1
+
+        def do_GET(self):
+            with lock:
+                state['active'] += 1
+                state['max_active'] = max(state['max_active'], state['active'])
+                state['user_agents'].add(self.headers.get('User-Agent'))
+            try:
+                if self.path == '/slow.html':
+                    time.sleep(3)
+                page = int(self.path.strip('/').split('.')[0]) if self.path != '/slow.html' else 99
+                time.sleep(0.2)
+                rows = ''.join(f'<tr><td>10.0.{page}.{i}</td><td>{8000 + i}</td></tr>' for i in range(2))
+                links = ''.join(f'<a href="{n}.html">{n}</a>' for n in range(2, 7)) if page == 1 else ''
+                body = f'<html><body><table>{rows}<tr><td>IP</td><td>PORT</td></tr></table>{links}</body></html>'.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except ConnectionError:
+                pass # 客户端到了截止时间已经放弃了这个页面
+            finally:
+                with lock:
+                    state['active'] -= 1
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1], state
+
+def run_pages():
+    port, state = start_page_server()
+
+    class PagedFetcher(BaseFetcher):
+        page_concurrency = 2
+        row_selector = 'tr'
+
+        def page_urls(self):
+            yield f'http://127.0.0.1:{port}/1.html'
+
+        def parse_page(self, url, html):
+            from pyquery import PyQuery as pq
+            for a in pq(html)('a').items():
+                self.add_page(a.attr('href'), base_url=url)
+            return super().parse_page(url, html)
+
+        def parse_row(self, row):
+            tds = list(row('td').items())
+            return self.make_proxy('http', tds[0].text(), tds[1].text())
+
+    # 第一页中的链接也会被下载，同一个主机同时最多page_concurrency个请求，并且比逐个下载快
+    f = PagedFetcher()
+    start_time = time.time()
+    proxies = f.fetch()
+    cost = time.time() - start_time
+    assert len(proxies) == 6 * 2 and ('http', '10.0.3.1', 8001) in proxies
+    assert state['max_active'] == 2 and cost < 0.2 * 6
+    stats = f.fetch_stats()
+    assert stats['pages'] == 6 and stats['ok'] == 6 and all(t['ms'] >= 200 for t in stats['page_timings'])
+
+    # 到了截止时间时返回已经解析到的代理
+    class SlowFetcher(PagedFetcher):
+        fetch_deadline = 1
+
+        def page_urls(self):
+            yield f'http://127.0.0.1:{port}/slow.html'
+            yield f'http://127.0.0.1:{port}/2.html'
+
+        def parse_page(self, url, html):
+            return BaseFetcher.parse_page(self, url, html)
+
+    f = SlowFetcher()
+    start_time = time.time()
+    proxies = f.fetch()
+    assert time.time() - start_time < 1.5
+    assert sorted(proxies) == [('http', '10.0.2.0', 8000), ('http', '10.0.2.1', 8001)]
+    assert f.fetch_stats()['skipped'] == 1
+
+    # 共用的会话：同一个主机的连接被复用，默认带有浏览器的请求头
+    previous_session = get_shared_session()
+    session = FetcherSession(pool_maxsize=2)
+    set_shared_session(session)
+    state['connections'] = 0
+    f = PagedFetcher()
+    assert len(f.fetch()) == 6 * 2
+    assert len(PagedFetcher().fetch()) == 6 * 2
+    stats = session.take_stats()
+    assert stats['requests'] == 12 and stats['new_connections'] == state['connections'] <= 2
+    assert stats['reused'] >= 10 and stats['reuse_ratio'] > 0.8 and stats['handshake_saved_ms'] > 0
+    assert BROWSER_HEADERS['User-Agent'] in state['user_agents']
+    assert session.take_stats()['requests'] == 0
+    # 同一个主机同时下载的页面数量不超过会话中每个主机的连接数量
+    assert PagedFetcher().host_concurrency() == 2 and RawSourcesFetcher().host_concurrency() == 2
+    set_shared_session(previous_session)
+
+    # 所有页面都失败时抛出错误
+    class DeadFetcher(PagedFetcher):
+        def page_urls(self):
+            yield 'http://127.0.0.1:1/1.html'
+    try:
+        DeadFetcher().fetch()
+        assert False
+    except RuntimeError:
+        pass
+
+def run_raw_parse():
+    """
+    按块解析的结果与块的大小无关：代理被块的边界切开时，也能正确解析
+    """
+    f = RawSourcesFetcher()
+    lines = [f'10.4.{i >> 8}.{i & 255}:{1000 + i}' for i in range(500)] + ['socks4://10.4.9.9:1080', '999.1.1.1:80', '10.4.9.8:70000']
+    data = ('\n'.join(lines + lines[:100]) + '\n').encode('ascii')
+    expected = set()
+    f._parse_bytes(data, 'http', expected)
+    assert len(expected) == 501 and ('socks4', '10.4.9.9', 1080) in expected
+    for chunk_size in [1, 7, 64, len(data)]:
+        proxies = set()
+        f._parse_stream((data[i:i + chunk_size] for i in range(0, len(data), chunk_size)), 'http', proxies)
+        assert proxies == expected, chunk_size
+
+    # 没有换行的内容超过max_line_bytes时在分隔符处切开
+    f.max_line_bytes = 100
+    data = ' '.join(lines[:500]).encode('ascii')
+    proxies = set()
+    f._parse_stream((data[i:i + 50] for i in range(0, len(data), 50)), 'https', proxies)
+    assert len(proxies) == 500 and ('https', '10.4.0.0', 1000) in proxies
+
+    # 连分隔符都没有时强制切开，几MB的响应体也只占用max_line_bytes左右的内存
+    f.max_line_bytes = 4096
+    def chunks(unit, total):
+        data = unit * (16 * 1024 // len(unit))
+        for _ in range(total // len(data)):
+            yield data
+    for unit, expected_cnt in [(b'10.7.0.1:8080#10.7.0.2:8080#', 2), (b'0123456789', 0)]:
+        proxies = set()
+        tracemalloc.start()
+        f._parse_stream(chunks(unit, 8 * 1024 * 1024), 'http', proxies)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert len(proxies) == expected_cnt and peak < 256 * 1024, (unit, len(proxies), peak)
+
+def run_raw_sources():
+    """
+    RawSourcesFetcher的条件请求缓存：/etag.txt 支持ETag(返回304)，/plain.txt 没有ETag，内容由bodies控制
+    """
+    bodies = {'/etag.txt': b'10.1.0.1:8080\n10.1.0.2:8080\n', '/plain.txt': b'socks5://10.2.0.1:1080\n10.2.0.2:1080\n'}
+    requests_log = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.startswith('/slow'):
+                time.sleep(0.5 if self.path.startswith('/slow-') else 3)
+            body = bodies.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            etag = '"%d"' % hash(body)
+            requests_log.append((self.path, self.headers.get('If-None-Match')))
+            if self.path == '/etag.txt' and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            if self.path == '/etag.txt':
+                self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    tmp_dir = tempfile.mkdtemp()
+    sources_file = os.path.join(tmp_dir, 'raw_sources.txt')
+    cache_file = os.path.join(tmp_dir, 'cache.json')
+    with open(sources_file, 'w') as f:
+        # 同一个url按两种协议配置，缓存需要分别记录
+        f.write(f'http,{base}/etag.txt\nhttps,{base}/etag.txt\nhttp,{base}/plain.txt\n')
+    os.environ['RAW_SOURCES_FILE'] = sources_file
+    os.environ['RAW_SOURCES_CACHE_FILE'] = cache_file
+
+    def fetch_and_commit():
+        # 与爬取进程相同：代理写入数据库之后才调用commit保存缓存
+        fetcher = RawSourcesFetcher()
+        proxies = fetcher.fetch()
+        fetcher.commit()
+        return proxies
+
+    # 第一次全部解析，代理没有写入数据库(没有调用commit)时不保存缓存，下次仍然全部解析
+    proxies = RawSourcesFetcher().fetch()
+    assert len(proxies) == 2 * 2 + 2 and not os.path.exists(cache_file)
+    proxies = fetch_and_commit()
+    assert len(proxies) == 2 * 2 + 2 and ('socks5', '10.2.0.1', 1080) in proxies and ('https', '10.1.0.1', 8080) in proxies
+
+    # 没有变化：带ETag的源返回304，没有ETag的源内容哈希相同，都不再解析
+    requests_log.clear()
+    assert fetch_and_commit() == []
+    assert all(inm is not None for path, inm in requests_log if path == '/etag.txt')
+    with open(cache_file) as f:
+        entries = json.load(f)
+    assert entries[f'https,{base}/etag.txt']['last_result'] == 'not_modified'
+    assert entries[f'http,{base}/plain.txt']['last_result'] == 'unchanged'
+    assert all(e['hits'] == 1 and e['misses'] == 1 for e in entries.values())
+
+    # 内容变化之后重新解析，只返回变化的源中的代理
+    bodies['/plain.txt'] = b'10.2.0.3:1080\n'
+    assert fetch_and_commit() == [('http', '10.2.0.3', 1080)]
+
+    # 超过max_age之后即使没有变化也重新解析
+    os.environ['RAW_SOURCES_CACHE_MAX_AGE'] = '0'
+    assert len(fetch_and_commit()) == 2 * 2 + 1
+    del os.environ['RAW_SOURCES_CACHE_MAX_AGE']
+
+    # 删除的源不再保留缓存项，出错的源记录错误
+    with open(sources_file, 'w') as f:
+        f.write(f'{base}/missing.txt\n')
+    assert fetch_and_commit() == []
+    with open(cache_file) as f:
+        entries = json.load(f)
+    assert list(entries) == [f'http,{base}/missing.txt'] and entries[f'http,{base}/missing.txt']['last_result'] == 'error'
+
+    # 并发下载：4个各需要0.5秒的代理源同时下载，到了截止时间没有下载完的代理源被放弃，已经下载完的代理源仍然返回
+    for i in range(4):
+        bodies[f'/slow-{i}.txt'] = f'10.5.0.{i}:8080\n'.encode('ascii')
+    bodies['/slow.txt'] = b'10.6.0.1:8080\n'
+    with open(sources_file, 'w') as f:
+        f.write(''.join(f'{base}/slow-{i}.txt\n' for i in range(4)) + f'{base}/slow.txt\n')
+    f = RawSourcesFetcher()
+    f.fetch_deadline = 1.5
+    start_time = time.time()
+    proxies = f.fetch()
+    assert time.time() - start_time < 2
+    assert sorted(proxies) == [('http', f'10.5.0.{i}', 8080) for i in range(4)]
+    f.commit()
+    stats = f.fetch_stats()
+    assert stats['pages'] == 5 and stats['ok'] == 4 and stats['skipped'] == 1
+    assert all(t['rows'] == 1 and t['ms'] >= 500 for t in stats['page_timings'] if t['error'] is None)
+    with open(cache_file) as f:
+        entries = json.load(f)
+    assert entries[f'http,{base}/slow.txt']['last_result'] == 'timeout'
+    assert entries[f'http,{base}/slow-0.txt']['last_ms'] >= 500 and entries[f'http,{base}/slow-0.txt']['last_proxies_cnt'] == 1
+    server.shutdown()
 
 def run():
     proxies_cnt = dict()
@@ -23,4 +294,9 @@ def run():
     print(proxies_cnt)
 
 if __name__ == '__main__':
+    run_pages()
+    print(u'分页爬取测试通过')
+    run_raw_parse()
+    run_raw_sources()
+    print(u'代理源缓存测试通过')
     run()
@@ -0,0 +1,104 @@
+# encoding: utf-8
+
+import sys, os
+import sqlite3
+import tempfile
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+from db import conn
+from db.Proxy import Proxy, shard_key
+from db.migrations import migrate, get_version, LATEST_VERSION
+
+def query_plan(c, sql, params):
+    return ' '.join(row[-1] for row in c.execute('EXPLAIN QUERY PLAN ' + sql, params))
+
+def assert_uses_index(c, sql, params, index_name):
+    plan = query_plan(c, sql, params)
+    assert index_name in plan, f'{sql}\n{plan}'
+
+def check_indexes(c):
+    # 热点查询都应该使用对应的组合索引，而不是扫描全表
+    assert_uses_index(c, f"""
+        SELECT {conn.PROXY_COLUMNS} FROM proxies
+        WHERE to_validate_date<=? AND validated=? AND (lease_expire_date IS NULL OR lease_expire_date<=?)
+        ORDER BY to_validate_date LIMIT ?
+    """, ('2020-01-01', True, '2020-01-01', 10), 'proxies_validated_to_validate_date_index')
+    # 随机选择：可用代理的rowid范围只需要在索引中查找一次，拒绝采样按rowid精确查找，稀疏时只扫描索引
+    for where_sql, params, index_name in [
+        ('validated=?', (True,), 'COVERING INDEX proxies_validated_'),
+        ('protocol=? AND validated=?', ('http', True), 'COVERING INDEX proxies_protocol_validated_'),
+    ]:
+        for order in ['ASC', 'DESC']:
+            plan = query_plan(c, f'SELECT rowid FROM proxies WHERE {where_sql} ORDER BY rowid {order} LIMIT 1', params)
+            assert index_name in plan and 'TEMP B-TREE' not in plan, plan
+        # (validated)和(validated, latency_p95)两类索引都可以覆盖这个查询
+        assert_uses_index(c, f'SELECT rowid FROM proxies WHERE {where_sql}', params, index_name)
+        plan = query_plan(c, f'SELECT rowid, {conn.PROXY_COLUMNS} FROM proxies WHERE rowid IN (?,?) AND {where_sql}', (1, 2) + params)
+        assert 'INTEGER PRIMARY KEY (rowid=?)' in plan, plan
+    # (protocol, validated)和(protocol, validated, latency_p95)两个索引都可以覆盖这个查询
+    assert_uses_index(c, """
+        SELECT protocol, count(*), sum(CASE WHEN validated=1 THEN 1 ELSE 0 END)
+        FROM proxies GROUP BY protocol ORDER BY protocol
+    """, (), 'COVERING INDEX proxies_protocol_validated_')
+    assert_uses_index(c, 'SELECT count(*) FROM proxies WHERE fetcher_name=?',
+        ('test',), 'proxies_fetcher_name_validated_index')
+    assert_uses_index(c, """
+        SELECT fetcher_name, count(*), sum(CASE WHEN validated=1 THEN 1 ELSE 0 END)
+        FROM proxies GROUP BY fetcher_name
+    """, (), 'proxies_fetcher_name_validated_index')
+    assert_uses_index(c, 'SELECT count(*) FROM proxies WHERE to_validate_date<=?',
+        ('2020-01-01',), 'proxies_to_validate_date_index')
+    # queryProxiesAfter: 从游标的位置开始，在索引上按范围查找
+    order_sql = 'IFNULL(latency, -1) ASC, to_validate_date ASC, rowid ASC'
+    for range_sql, range_params, range_order_sql in [
+        ('IFNULL(latency, -1)=? AND to_validate_date=? AND rowid>?', (100, '2020-01-01', 1), 'rowid ASC'),
+        ('IFNULL(latency, -1)=? AND to_validate_date>?', (100, '2020-01-01'), 'to_validate_date ASC, rowid ASC'),
+        ('IFNULL(latency, -1)>?', (100,), order_sql),
+    ]:
+        plan = query_plan(c, f"""
+            SELECT rowid, {conn.PROXY_COLUMNS} FROM proxies WHERE validated=? AND {range_sql}
+            ORDER BY {range_order_sql} LIMIT ?
+        """, (True,) + range_params + (50,))
+        assert 'proxies_admin_order_index' in plan and 'TEMP B-TREE' not in plan, plan
+    # 按延迟选择代理: 只扫描索引中的一段，并且不需要额外排序
+    for sql, params, index_name in [
+        ('validated=? AND latency_p95>=? AND latency_p95<=?', (True, 0, 1000), 'proxies_validated_latency_index'),
+        ('protocol=? AND validated=? AND latency_p95>=?', ('http', True, 0), 'proxies_protocol_validated_latency_index'),
+    ]:
+        plan = query_plan(c, f'SELECT rowid FROM proxies WHERE {sql} ORDER BY latency_p95 LIMIT 20', params)
+        assert index_name in plan and 'COVERING' in plan and 'TEMP B-TREE' not in plan, plan
+
+def run():
+    # 新建的数据库应该已经执行了全部迁移
+    with conn._read_conn() as c:
+        assert get_version(c) == LATEST_VERSION
+        check_indexes(c)
+
+    # 旧版本的数据库(只有最初的表结构并且已经有数据)可以升级到最新版本，并且重复执行不会出错
+    path = os.path.join(tempfile.mkdtemp(), 'old.db')
+    c = sqlite3.connect(path)
+    for sql in Proxy.ddls:
+        c.execute(sql)
+    c.execute('CREATE INDEX proxies_fetcher_name_index ON proxies(fetcher_name)')
+    c.execute("INSERT INTO proxies VALUES ('test','http','127.0.0.1',8080,0,NULL,NULL,'2020-01-01 00:00:00',0)")
+    c.commit()
+    assert get_version(c) == 0
+    assert migrate(c) == LATEST_VERSION
+    assert migrate(c) == 0
+    assert get_version(c) == LATEST_VERSION
+    columns = [row[1] for row in c.execute('PRAGMA table_info(proxies)')]
+    assert 'lease_owner' in columns and 'lease_expire_date' in columns
+    assert 'success_streak' in columns and 'uptime_ewma' in columns and 'latency_ewma' in columns
+    assert c.execute('SELECT success_streak, uptime_ewma FROM proxies').fetchall() == [(0, None)]
+    assert c.execute('SELECT latency_hist, latency_p50, latency_p95 FROM proxies').fetchall() == [(None, None, None)]
+    assert c.execute('SELECT shard_key FROM proxies').fetchall() == [(shard_key('http', '127.0.0.1', 8080), )]
+    indexes = [row[1] for row in c.execute('PRAGMA index_list(proxies)')]
+    assert 'proxies_fetcher_name_index' not in indexes
+    assert c.execute('SELECT count(*) FROM proxies').fetchone()[0] == 1
+    assert c.execute('SELECT total_cnt, validated_cnt FROM proxy_stats').fetchall() == [(1, 0)]
+    check_indexes(c)
+    c.close()
+
+if __name__ == '__main__':
+    print(u'请确保运行本脚本之前删除或备份`data.db`文件')
+    run()
+    print(u'测试通过')
@@ -0,0 +1,368 @@
+# encoding: utf-8
+
+"""
+验证器测试：在本地启动模拟的HTTP/SOCKS4/SOCKS5代理，检查验证结果是否正确，不会访问外部网络
+"""
+
+import sys, os
+import asyncio
+import socket
+import threading
+import time
+import datetime
+from concurrent import futures
+sys.path.append(os.path.dirname(__file__) + os.sep + '../')
+
+os.environ['VALIDATE_URL'] = 'http://10.255.255.1/'
+os.environ['VALIDATE_KEYWORD'] = 'Example Domain'
+os.environ['VALIDATE_METHOD'] = 'GET'
+os.environ['VALIDATE_TIMEOUT'] = '1'
+os.environ['VALIDATE_MAX_FAILS'] = '1'
+os.environ['VALIDATE_MAX_BODY_BYTES'] = '65536'
+
+from db import conn
+from db.Proxy import Proxy
+from proc import async_validator, run_validator
+from proc.stage_stats import StageStats, transfer_stats
+from proc.wakeup import IngestSignal
+from proc.concurrency import AIMDController, AttemptStats, classify_error
+import errno
+import requests
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+PORTS = dict(
+    http=free_port(), chunked=free_port(), wrong=free_port(), silent=free_port(),
+    socks4=free_port(), socks5=free_port(), drip=free_port(), header_drip=free_port(), dead=free_port(),
+    large=free_port(), padded=free_port(), method=free_port(), flaky=free_port()
+)
+
+def start_fake_proxies():
+    """
+    http：返回包含关键字的网页；chunked：以chunked编码返回，关键字被拆分在两个chunk中；
+    wrong：返回不包含关键字的网页；silent：接受连接但不返回任何数据；
+    drip：每0.1秒返回一个字节，永远不会触发读取超时；header_drip：与drip相同，但是缓慢返回的是响应头；dead：没有监听；
+    large：关键字在1MB响应体的开头；padded：关键字在1MB响应体的末尾；method：在X-Method响应头中返回请求方法；
+    flaky：第奇数个连接不返回任何数据，第偶数个连接与http相同
+    """
+    flaky_cnt = [0]
+    body = b'<html><h1>Example Domain</h1></html>'
+
+    async def read_request(reader):
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        return request_line
+
+    def handler(kind):
+        async def handle(reader, writer):
+            try:
+                if kind == 'socks4':
+                    await reader.readexactly(8)
+                    while (await reader.readexactly(1)) != b'\x00':
+                        pass
+                    writer.write(b'\x00\x5a' + b'\x00' * 6)
+                elif kind == 'socks5':
+                    n_methods = (await reader.readexactly(2))[1]
+                    await reader.readexactly(n_methods)
+                    writer.write(b'\x05\x00')
+                    await reader.readexactly(4 + 4 + 2)
+                    writer.write(b'\x05\x00\x00\x01\x7f\x00\x00\x01\x00\x50')
+                if kind == 'flaky':
+                    flaky_cnt[0] += 1
+                if kind == 'silent' or (kind == 'flaky' and flaky_cnt[0] % 2 == 1):
+                    await asyncio.sleep(10)
+                    return
+                request_line = await read_request(reader)
+                if kind == 'chunked':
+                    writer.write(
+                        b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                        b'a\r\n<h1>Exampl\r\n9\r\ne Domain<\r\n0\r\n\r\n'
+                    )
+                elif kind == 'drip':
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 100000\r\n\r\n')
+                    for _ in range(100000):
+                        writer.write(b'x')
+                        await writer.drain()
+                        await asyncio.sleep(0.1)
+                elif kind == 'header_drip':
+                    writer.write(b'HTTP/1.1 200 OK\r\n')
+                    for i in range(100000):
+                        for byte in b'X-Drip: %d\r\n' % i:
+                            writer.write(bytes([byte]))
+                            await writer.drain()
+                            await asyncio.sleep(0.1)
+                elif kind in ('large', 'padded'):
+                    padding = b'x' * 1000000
+                    content = body + padding if kind == 'large' else padding + body
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(content) + content)
+                elif kind == 'method':
+                    method = request_line.split(b' ', 1)[0]
+                    writer.write(b'HTTP/1.1 200 OK\r\nX-Method: %s\r\nContent-Length: 0\r\n\r\n' % method)
+                elif kind == 'wrong':
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello')
+                else:
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+                await writer.drain()
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                writer.close()
+        return handle
+
+    loop = asyncio.new_event_loop()
+
+    async def main():
+        for kind, port in PORTS.items():
+            if kind != 'dead':
+                await asyncio.start_server(handler(kind), '127.0.0.1', port)
+
+    loop.run_until_complete(main())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+def make_proxy(protocol, kind):
+    p = Proxy()
+    p.protocol, p.ip, p.port = protocol, '127.0.0.1', PORTS[kind]
+    return p
+
+def run():
+    start_fake_proxies()
+    # (代理, 是否能通过第一阶段的连接检查, 是否能通过完整的验证)
+    cases = [
+        (make_proxy('http', 'http'), True, True),
+        (make_proxy('http', 'chunked'), True, True),
+        (make_proxy('socks4', 'socks4'), True, True),
+        (make_proxy('socks5', 'socks5'), True, True),
+        (make_proxy('http', 'wrong'), True, False),
+        (make_proxy('http', 'silent'), True, False),
+        (make_proxy('http', 'dead'), False, False),
+        (make_proxy('socks5', 'http'), False, False),
+        (make_proxy('socks5', 'silent'), False, False),
+    ]
+
+    # 逐个验证
+    for proxy, _, expected in cases:
+        success, latency = asyncio.run(async_validator.validate_proxy(proxy))
+        assert success == expected, (proxy.protocol, proxy.port)
+        assert (latency is not None) == expected
+
+    # 第一阶段：能连接的代理都会通过，只有无法连接、SOCKS握手失败的代理会被淘汰
+    for proxy, expected, _ in cases:
+        passed, _ = asyncio.run(async_validator.precheck_proxy(proxy))
+        assert passed == expected, (proxy.protocol, proxy.port)
+
+    # 线程方式的验证结果应该一致，并且除了共用的截止时间线程(第一次验证时创建)之外，不会创建额外的线程
+    run_validator.validate_once(make_proxy('http', 'http'))
+    thread_cnt = threading.active_count()
+    for proxy, _, expected in cases:
+        try:
+            success = run_validator.validate_once(proxy)
+        except Exception:
+            success = False
+        assert success == expected, (proxy.protocol, proxy.port)
+    assert threading.active_count() == thread_cnt
+
+    # 代理一直缓慢地返回响应体或者响应头时，两种方式都会在截止时间之前结束
+    for kind in ['drip', 'header_drip']:
+        start_time = time.time()
+        try:
+            run_validator.validate_once(make_proxy('http', kind), time.time() + 1)
+            assert False
+        except run_validator.ValidateTimeout:
+            pass
+        assert time.time() - start_time < 1.5, kind
+        start_time = time.time()
+        try:
+            asyncio.run(async_validator.validate_once(make_proxy('http', kind), 1))
+            assert False
+        except asyncio.TimeoutError:
+            pass
+        assert time.time() - start_time < 1.5, kind
+    # 验证尝试之间互不影响：截止时间只会中断自己的连接
+    start_time = time.time()
+    with futures.ThreadPoolExecutor(2) as executor:
+        slow = executor.submit(run_validator.validate_once, make_proxy('http', 'header_drip'), time.time() + 0.5)
+        ok = executor.submit(run_validator.validate_once, make_proxy('http', 'http'), time.time() + 3)
+        assert ok.result() is True
+        assert isinstance(slow.exception(), run_validator.ValidateTimeout)
+    assert time.time() - start_time < 1.5
+
+    # 找到关键字之后不再读取剩下的响应体，读取了VALIDATE_MAX_BODY_BYTES字节仍然没有找到关键字时认为验证失败
+    def check_transfer(validate, kind, expected):
+        before = transfer_stats.stats()
+        success = None
+        try:
+            success = validate(make_proxy('http', kind))
+        except Exception:
+            pass
+        after = transfer_stats.stats()
+        assert success == expected, kind
+        assert after['validations'] == before['validations'] + 1
+        read_bytes = after['bytes'] - before['bytes']
+        if expected:
+            assert after['stopped_at_keyword'] == before['stopped_at_keyword'] + 1
+            assert read_bytes < 65536, read_bytes
+        else:
+            assert after['stopped_at_cap'] == before['stopped_at_cap'] + 1
+            assert 65536 <= read_bytes < 65536 * 2, read_bytes
+    for validate in [run_validator.validate_once, lambda proxy: asyncio.run(async_validator.validate_once(proxy))]:
+        check_transfer(validate, 'large', True)
+        check_transfer(validate, 'padded', False)
+
+    # HEAD验证方式发送的是HEAD请求
+    for module in [async_validator, run_validator]:
+        module.VALIDATE_METHOD, module.VALIDATE_HEADER, module.VALIDATE_KEYWORD = 'HEAD', 'X-Method', 'HEAD'
+    assert asyncio.run(async_validator.validate_once(make_proxy('http', 'method')))
+    assert run_validator.validate_once(make_proxy('http', 'method'))
+    for module in [async_validator, run_validator]:
+        module.VALIDATE_METHOD, module.VALIDATE_HEADER, module.VALIDATE_KEYWORD = 'GET', 'location', 'Example Domain'
+
+    # 同时进行多次尝试：第一次尝试没有响应时，第二次尝试在VALIDATE_RACE_STAGGER_MS毫秒之后开始，不必等到第一次超时
+    for module in [async_validator, run_validator]:
+        module.VALIDATE_MAX_FAILS, module.VALIDATE_PROXY_BUDGET, module.VALIDATE_RACE_STAGGER_MS = 3, 3, 200
+    race_cases = [('flaky', True), ('http', True), ('wrong', False), ('dead', False), ('silent', False)]
+    for race in [run_validator.race_validate_proxy, lambda proxy: asyncio.run(async_validator.race_proxy(proxy))]:
+        for kind, expected in race_cases:
+            start_time = time.time()
+            success, latency = race(make_proxy('http', kind))
+            cost = time.time() - start_time
+            assert success == expected, kind
+            assert (latency is not None) == expected
+            # 所有尝试共用VALIDATE_TIMEOUT * 2秒的截止时间
+            assert cost < (0.8 if expected else 2.5), (kind, cost)
+    # 依次尝试时需要等待第一次尝试超时
+    start_time = time.time()
+    assert run_validator.validate_proxy(make_proxy('http', 'flaky'))[0]
+    assert time.time() - start_time >= 1
+    for module in [async_validator, run_validator]:
+        module.VALIDATE_MAX_FAILS, module.VALIDATE_PROXY_BUDGET = 1, 1
+
+    # 通过AsyncValidator并发验证
+    results = {}
+    done = threading.Event()
+    def on_result(proxy, success, latency):
+        results[id(proxy)] = success
+        if len(results) == len(cases):
+            done.set()
+    validator = async_validator.AsyncValidator(4, on_result)
+    validator.start()
+    for proxy, _, _ in cases:
+        validator.submit(proxy)
+    assert done.wait(30)
+    for proxy, _, expected in cases:
+        assert results[id(proxy)] == expected
+
+    # 验证失败的原因：requests包装的超时、本地socket错误
+    error = None
+    try:
+        requests.get(f'http://127.0.0.1:{PORTS["silent"]}/', timeout=0.2)
+    except Exception as e:
+        error = e
+    assert classify_error(error) == 'timeout'
+    wrapped = requests.exceptions.ConnectionError(OSError(errno.EMFILE, 'Too many open files'))
+    assert classify_error(wrapped) == 'local_error'
+    assert classify_error(async_validator.ProxyError('无效的状态行')) == 'error'
+    assert classify_error(asyncio.TimeoutError()) == 'timeout'
+
+    # AIMD：验证正常并且并发用满时加性增加，超时比例升高或者出现本地socket错误时乘性减少，始终在范围之内
+    stats = AttemptStats()
+    controller = AIMDController(10, 100, 20, initial=50, stats=stats)
+    def feed(success, timeout=0, local_error=0, latency=100):
+        for _ in range(success):
+            stats.record('success', latency)
+        for _ in range(timeout):
+            stats.record('timeout')
+        for _ in range(local_error):
+            stats.record('local_error')
+    feed(30, 10)
+    assert controller.adjust(50) == 70
+    feed(30, 10)
+    assert controller.adjust(10) == 70 # 并发没有用满
+    feed(30, 30)
+    assert controller.adjust(70) == 49 # 超时比例升高
+    feed(30, 10, 1)
+    assert controller.adjust(49) == 34 # 本地socket错误
+    feed(30, 10, latency=1000)
+    assert controller.adjust(34) == 23 # 延迟变长
+    feed(5)
+    assert controller.adjust(23) == 23 # 样本太少
+    for _ in range(10):
+        feed(30, 10)
+        controller.adjust(controller.limit)
+    assert controller.limit == 100
+    for _ in range(10):
+        feed(30, 0, 1)
+        controller.adjust(controller.limit)
+    assert controller.limit == 10
+    assert controller.stats()['decreases'] >= 3 and len(controller.stats()['recent_changes']) > 0
+    # 超过流水线容量的代理只会在队列中等待，自动调整的上限不超过容量
+    run_validator.VALIDATE_CONCURRENCY_MAX = 0
+    assert run_validator.create_controller(50).max_limit == 50
+    run_validator.VALIDATE_CONCURRENCY_MAX = 500
+    controller = run_validator.create_controller(50)
+    assert controller.max_limit == 50 and controller.limit == 50
+    assert run_validator.create_controller(5).min_limit == 5
+    run_validator.VALIDATE_CONCURRENCY_MAX = 0
+    run_validator.VALIDATE_AIMD = False
+    assert run_validator.create_controller(50) is None
+    run_validator.VALIDATE_AIMD = True
+
+    # worker利用率：2个worker中平均有1个在工作
+    stage = StageStats(workers=2)
+    stage.begin()
+    time.sleep(0.2)
+    stage.end()
+    stage.begin()
+    time.sleep(0.2)
+    assert 0.4 <= stage.stats()['utilization'] <= 0.6
+    time.sleep(0.1)
+    stats = stage.stats() # 只统计上次调用之后的时间
+    assert 0.45 <= stats['utilization'] <= 0.55 and stats['busy'] == 1
+    stage.end()
+
+    # 通知不会阻塞，多次通知只唤醒一次
+    signal = IngestSignal(2)
+    signal.notify()
+    signal.notify()
+    assert signal.wait(0, 0.1) and not signal.wait(0, 0.1)
+    assert signal.wait(1, 0.1)
+
+    # 验证器主循环：不再固定睡眠，代理到期或者爬取器写入了新的代理时马上开始验证，验证结果马上写入数据库
+    def validate_date(kind):
+        with conn._read_conn() as c:
+            return c.execute('SELECT validate_date FROM proxies WHERE port=?', (PORTS[kind],)).fetchone()[0]
+    def wait_validated(kind, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if validate_date(kind) is not None:
+                return True
+            time.sleep(0.02)
+        return False
+    run_validator.PROC_VALIDATOR_SLEEP = 60
+    run_validator.STATS_REPORT_INTERVAL = 60
+    run_validator.VALIDATE_AIMD = False
+    conn.pushNewFetchBatch('test', [('http', '127.0.0.1', PORTS['http'])])
+    with conn._write_conn() as c:
+        c.execute('UPDATE proxies SET to_validate_date=? WHERE port=?', (
+            datetime.datetime.now() + datetime.timedelta(seconds=1.5), PORTS['http']
+        ))
+        c.commit()
+    signal = IngestSignal(1)
+    conn.set_ingest_signal(signal)
+    threading.Thread(target=run_validator.main, args=(None, 0, 1, signal), daemon=True).start()
+    time.sleep(0.5)
+    assert validate_date('http') is None # 还没有到期
+    assert wait_validated('http', 3)
+    start_time = time.time()
+    conn.pushNewFetchBatch('test', [('http', '127.0.0.1', PORTS['chunked'])])
+    assert wait_validated('chunked', 3)
+    assert time.time() - start_time < 2
+
+if __name__ == '__main__':
+    run()
+    print(u'测试通过')